@@ -0,0 +1,73 @@
+import json
+import timeit
+import argparse
+import datetime
+
+from kuwa.executor.base_executor import AdvancedJSONEncoder
+from kuwa.executor.message import TextChunk, LogChunk, ExitCodeChunk
+from kuwa.executor import sse
+
+
+class LegacyTextChunk:
+    """
+    The chunk with __dict__, as before the slots were introduced.
+    """
+
+    def __init__(self, value, annotations=None, cost=None):
+        self.cost = cost
+        self.value = value
+        self.annotations = annotations if annotations is not None else []
+
+    def __jsonencode__(self):
+        return {
+            "type": "text",
+            "text": {"value": self.value, "annotations": self.annotations},
+        }
+
+
+class LegacyLogChunk:
+    """
+    The log chunk formatting the timestamp on construction.
+    """
+
+    def __init__(self, text, level="INFO", cost=None):
+        self.cost = cost
+        self.text = text
+        self.level = level
+        self.timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def legacy_frame(token):
+    chunks = [LegacyTextChunk(token)]
+    return f"data: {json.dumps({'finish_reason': None, 'delta': chunks}, cls=AdvancedJSONEncoder)}\n"
+
+
+def frame(token):
+    return sse.format_delta([TextChunk(token)])
+
+
+def main():
+    """
+    Measure the time to create a chunk and format its SSE frame, per chunk.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the per-chunk overhead of the SSE serialization.")
+    parser.add_argument("-n", type=int, default=200000, help="Number of chunks per round.")
+    parser.add_argument("-r", type=int, default=5, help="Number of rounds, the best one is reported.")
+    args = parser.parse_args()
+
+    cases = {
+        "text frame (legacy)": lambda: legacy_frame(" token"),
+        "text frame": lambda: frame(" token"),
+        "log chunk (legacy)": lambda: LegacyLogChunk("Loading"),
+        "log chunk": lambda: LogChunk("Loading"),
+        "exit code frame (json.dumps)": lambda: sse.format_sse({"finish_reason": None, "delta": [ExitCodeChunk(0)]}),
+        "exit code frame": lambda: sse.format_delta([ExitCodeChunk(0)]),
+    }
+    print(f"orjson backend: {'enabled' if sse.orjson is not None else 'not installed'}")
+    for name, case in cases.items():
+        best = min(timeit.repeat(case, number=args.n, repeat=args.r))
+        print(f"{name:<32}{best / args.n * 1e9:>10.0f} ns/chunk")
+
+
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,7 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from kuwa.executor import LLMExecutor, Modelfile
 from kuwa.executor.llm_executor import extract_user_attachment
+from kuwa.executor.message import UsageChunk
 from kuwa.executor.multi_modality import get_supported_image_mime, fetch_image_as_data_url
 from kuwa.executor.util import (
     expose_function_parameter,
@@ -96,6 +97,8 @@ class ChatGptExecutor(LLMExecutor):
     context_window: int = 0
     system_prompt: str = None
     generation_config: dict = {"temperature": 0.5}
+    # Whether the API accepts stream_options to report the usage
+    stream_usage: bool = True
 
     def __init__(self):
         super().__init__()
@@ -326,12 +329,16 @@ class ChatGptExecutor(LLMExecutor):
                 return
 
             # Trim the history to fit into the context window
-            while self.num_tokens_from_messages(msg) > self.context_window:
+            prompt_tokens = self.num_tokens_from_messages(msg)
+            while prompt_tokens > self.context_window:
                 msg = msg[1:]
                 if len(msg) == 0:
                     logging.debug("Aborted since the input message exceeds the limit.")
                     yield "[Sorry, The input message is too long!]"
                     return
+                prompt_tokens = self.num_tokens_from_messages(msg)
+            # Estimated locally, and replaced if the API reports the usage
+            yield UsageChunk(prompt_tokens=prompt_tokens)
 
             openai_token = openai_token.strip()
             openai.api_key = openai_token
@@ -341,13 +348,31 @@ class ChatGptExecutor(LLMExecutor):
             )
             self.proc = True
             logger.debug(f"msg: {msg}")
-            response = await client.chat.completions.create(
-                model=model_name, messages=msg, stream=True, **generation_config
-            )
+            request = dict(generation_config, model=model_name, messages=msg, stream=True)
+            include_usage = self.stream_usage and "stream_options" not in request
+            if include_usage:
+                request["stream_options"] = {"include_usage": True}
+            try:
+                response = await client.chat.completions.create(**request)
+            except openai.BadRequestError:
+                if not include_usage:
+                    raise
+                # Some OpenAI-compatible services reject the unknown parameters
+                del request["stream_options"]
+                response = await client.chat.completions.create(**request)
+                self.stream_usage = False
+                logger.info("The API doesn't accept stream_options, the usage is estimated locally.")
             async for i in response:
-                chunk = i.choices[0].delta.content
+                if getattr(i, "usage", None) is not None:
+                    yield UsageChunk(
+                        prompt_tokens=i.usage.prompt_tokens,
+                        completion_tokens=i.usage.completion_tokens,
+                    )
                 if not self.proc:
                     break
+                if not i.choices:
+                    continue
+                chunk = i.choices[0].delta.content
                 if not chunk:
                     continue
 
@@ -34,7 +34,7 @@ from kuwa.executor.util import (
     read_config,
     merge_config,
 )
-from kuwa.executor.message import LogChunk, LogLevel
+from kuwa.executor.message import LogChunk, LogLevel, UsageChunk
 from transformers.utils import is_vision_available
 
 if is_vision_available():
@@ -515,6 +515,7 @@ class HuggingfaceExecutor(LLMExecutor):
             model_inputs = self.fetch_and_process_image(
                 history=history, prompt=prompt
             ).to(self.model.device)
+        yield UsageChunk(prompt_tokens=model_inputs["input_ids"].shape[1])
         streamer = TextIteratorStreamer(
             self.tokenizer, skip_prompt=True, timeout=self.timeout
         )
@@ -536,6 +537,7 @@ class HuggingfaceExecutor(LLMExecutor):
             self.CSC.proc = thread
 
             buffer = ""
+            output = []
             for chunk in streamer:
                 buffer += chunk
                 for word in self.stop_words:
@@ -553,6 +555,7 @@ class HuggingfaceExecutor(LLMExecutor):
                     output_length = len(buffer) - self.buffer_length
                     if self.in_debug():
                         print(end=buffer[:output_length], flush=True)
+                    output.append(buffer[:output_length])
                     yield buffer[:output_length]
                     buffer = buffer[output_length:]
 
@@ -561,7 +564,10 @@ class HuggingfaceExecutor(LLMExecutor):
                     buffer = buffer.replace(word, "")
                 if self.in_debug():
                     print(end=buffer, flush=True)
+                output.append(buffer)
                 yield buffer  # Flush buffer
+            completion_tokens = self.tokenizer.encode("".join(output), add_special_tokens=False)
+            yield UsageChunk(completion_tokens=len(completion_tokens))
 
         except queue.Empty:
             message = 'The model produced no output. Increasing the executor\'s "--timeout" value may resolve this.\nIf the problem persists, a GPU out-of-memory or a model-specific issue is likely.'
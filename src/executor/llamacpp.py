@@ -15,6 +15,7 @@ import llama_cpp.llama_chat_format as llama_chat_format
 
 from kuwa.executor import LLMExecutor, Modelfile
 from kuwa.executor.llm_executor import rectify_chat_history
+from kuwa.executor.message import UsageChunk
 from kuwa.executor.util import (
     expose_function_parameter,
     read_config,
@@ -332,13 +333,7 @@ class LlamaCppExecutor(LLMExecutor):
                     system_prompt,
                     modelfile.template,
                 )
-                prompt_length = len(
-                    self.model.tokenize(
-                        text=prompt.encode("UTF-8", "ignore"),
-                        add_bos=False,
-                        special=False,
-                    )
-                )
+                prompt_length = self.count_tokens(prompt)
                 logging.debug(f"Prompt ({prompt_length} tokens): {prompt}")
                 if prompt_length <= self.limit:
                     break
@@ -348,6 +343,7 @@ class LlamaCppExecutor(LLMExecutor):
                     logging.debug("Aborted since the input message exceeds the limit.")
                     yield "[Sorry, The input message is too long!]"
                     return
+            yield UsageChunk(prompt_tokens=prompt_length)
 
             output_generator = self.model.create_completion(
                 LlamaHelper.deduplicate_bos_eos(self.model, prompt),
@@ -358,11 +354,14 @@ class LlamaCppExecutor(LLMExecutor):
             )
             self.serving_generator = output_generator
 
+            output = []
             for i in output_generator:
                 chunk = i["choices"][0]["text"]
                 if self.in_debug():
                     print(end=chunk, flush=True)
+                output.append(chunk)
                 yield chunk
+            yield UsageChunk(completion_tokens=self.count_tokens("".join(output)))
 
         except Exception as e:
             logger.error("Error occurs while processing request.")
@@ -370,6 +369,13 @@ class LlamaCppExecutor(LLMExecutor):
         finally:
             logger.debug("finished")
 
+    def count_tokens(self, text: str) -> int:
+        return len(
+            self.model.tokenize(
+                text=text.encode("UTF-8", "ignore"), add_bos=False, special=False
+            )
+        )
+
     async def abort(self):
         if not self.serving_generator:
             return "There's not running generation request to abort."
@@ -0,0 +1,75 @@
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionQueue:
+    """
+    Admit at most `limit` requests to be processed concurrently. The excess
+    requests wait in FIFO order for a slot instead of being rejected, so a
+    burst is served a bit later rather than failed. A request is rejected
+    only if `max_depth` requests are waiting already, or it has waited for
+    `max_wait_sec`.
+    The accounting happens in the event loop, so the counters need no lock.
+    """
+
+    def __init__(self, limit: int = 1, max_depth: int = 16, max_wait_sec: float = 30, metrics=None):
+        self.limit = limit
+        self.max_depth = max_depth
+        self.max_wait_sec = max_wait_sec
+        self.metrics = metrics
+        self.running = 0
+        self.waiting = 0
+        # Called with (running, waiting) whenever they change
+        self.on_change = None
+        self._semaphore = asyncio.Semaphore(limit)
+
+    def full(self) -> bool:
+        """
+        Whether a new request would be rejected right away.
+        """
+        return self.running >= self.limit and self.waiting >= self.max_depth
+
+    async def acquire(self) -> bool:
+        """
+        Wait for a slot. Return False if the request is rejected.
+        """
+        if self.full():
+            self.reject()
+            return False
+        start_time = time.monotonic()
+        self._set_waiting(self.waiting + 1)
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.max_wait_sec or None)
+        except asyncio.TimeoutError:
+            self.reject(f"waited for {self.max_wait_sec} seconds")
+            return False
+        finally:
+            self._set_waiting(self.waiting - 1)
+        self.running += 1
+        self._changed()
+        if self.metrics is not None:
+            self.metrics.queue_wait_seconds.observe(time.monotonic() - start_time)
+        return True
+
+    def release(self):
+        self.running -= 1
+        self._semaphore.release()
+        self._changed()
+
+    def _set_waiting(self, waiting: int):
+        self.waiting = waiting
+        if self.metrics is not None:
+            self.metrics.queue_depth.set(waiting)
+        self._changed()
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change(self.running, self.waiting)
+
+    def reject(self, reason: str = "the queue is full"):
+        logger.warning(f"Rejected a request since {reason}.")
+        if self.metrics is not None:
+            self.metrics.queue_rejected.inc()
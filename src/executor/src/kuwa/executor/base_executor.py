@@ -1,4 +1,5 @@
 import requests
+import os
 import sys
 import argparse
 import socket
@@ -7,11 +8,12 @@ import logging
 import atexit
 import signal
 import asyncio
+import threading
 import json
 import traceback
 from urllib.parse import urljoin
 from typing import Optional
-from functools import reduce
+from functools import reduce, partial
 from itertools import compress
 
 import uvicorn
@@ -20,7 +22,18 @@ from retry import retry
 from fastapi import FastAPI, Response, Request
 from fastapi.responses import JSONResponse, StreamingResponse
 
-from .metrics import ExecutorMetrics
+from .metrics import ExecutorMetrics, GenerationStats
+from .admission import AdmissionQueue
+from .workers import (
+    WorkerPool,
+    ABORT_SIGNAL,
+    fork_supported,
+    enable_multiprocess_metrics,
+    generate_multiprocess_metrics,
+)
+from .coalesce import coalesce_chunks
+from .sse import format_delta, format_sse
+from .channel import KernelChannel
 from .logger import ExecutorLoggerFactory
 from .message import BaseChunk, TextChunk, LogChunk, ExitCodeChunk, LogLevel
 
@@ -59,9 +72,17 @@ class BaseExecutor:
     executor_path: str = "/chat"
     access_codes: Optional[str] = []
 
-    concurrent_requests: int = 0
     concurrent_req_limit: int = 1
+    max_queue_size: int = 16
+    max_queue_wait_sec: float = 30
+    admission: Optional[AdmissionQueue] = None
+    workers: int = 1
+    worker_pool: Optional[WorkerPool] = None
+    coalesce_window_sec: float = 0.02
+    coalesce_max_bytes: int = 4096
+    heartbeat_interval_sec: float = 5
     ready: bool = False
+    abort_count: int = 0
 
     log_level: str = "INFO"
     metrics: Optional[ExecutorMetrics] = None
@@ -105,11 +126,53 @@ class BaseExecutor:
             default=self.kernel_url,
             help="Base URL of Kernel's executor management API",
         )
+        group.add_argument(
+            "--kernel_channel",
+            action="store_true",
+            help="Connect to the kernel through a persistent WebSocket channel instead of serving the kernel over HTTP. The kernel should be served with --asgi",
+        )
+        group.add_argument(
+            "--heartbeat_interval",
+            type=float,
+            default=self.heartbeat_interval_sec,
+            help="The interval in seconds to renew the registration. The kernel removes the executor after missing three heartbeats. Set to 0 to register permanently",
+        )
         group.add_argument(
             "--concurrent_req_limit",
+            type=int,
             default=self.concurrent_req_limit,
             help="The number of allowed concurrent requests.",
         )
+        group.add_argument(
+            "--max_queue_size",
+            type=int,
+            default=self.max_queue_size,
+            help="The maximum number of requests waiting for the concurrent requests to finish. The requests exceeding it are rejected",
+        )
+        group.add_argument(
+            "--max_queue_wait_sec",
+            type=float,
+            default=self.max_queue_wait_sec,
+            help="How long a request waits for the concurrent requests to finish before rejected. Set to 0 to wait without a limit",
+        )
+        group.add_argument(
+            "--workers",
+            type=int,
+            default=self.workers,
+            help="The number of the executor processes sharing the port, for the executors doing CPU-bound work in serve(). Each process runs setup() and serves --concurrent_req_limit requests. Not available on Windows",
+        )
+        group.add_argument(
+            "--coalesce_window",
+            type=float,
+            default=self.coalesce_window_sec,
+            help="The time window in seconds to merge the text chunks generated in a burst into one SSE frame. Set to 0 to send every chunk as it is",
+        )
+        group.add_argument(
+            "--coalesce_max_bytes",
+            type=int,
+            default=self.coalesce_max_bytes,
+            help="The maximum size of the text merged into one SSE frame",
+        )
         group.add_argument(
             "--log",
             type=str.upper,
@@ -137,6 +200,7 @@ class BaseExecutor:
         self.kernel_url = self.args.kernel_url
         self.ignore_kernel = self.args.ignore_kernel
         self.access_codes = self.args.access_code
+        self.heartbeat_interval_sec = self.args.heartbeat_interval
         if self.access_codes is None or len(self.access_codes) == 0:
             raise ValueError("Argument --access_code is mandatory.")
 
@@ -146,10 +210,34 @@ class BaseExecutor:
         self.https = self.args.https
         self.executor_path = self.args.executor_path
 
+        # Worker processes, which share the metrics
+        self.workers = self.args.workers
+        if self.workers > 1 and not fork_supported():
+            logger.warning("Multiple workers are not supported on this platform. Running in a single process.")
+            self.workers = 1
+        if self.workers > 1:
+            self.worker_pool = WorkerPool(self.workers, limit=self.args.concurrent_req_limit)
+            enable_multiprocess_metrics()
+
         # Metrics
         self.metrics = ExecutorMetrics(self.access_codes[0])
         self.metrics.state.state("idle")
 
+        # Merging of the output chunks
+        self.coalesce_window_sec = self.args.coalesce_window
+        self.coalesce_max_bytes = self.args.coalesce_max_bytes
+
+        # Admission of the concurrent requests
+        self.concurrent_req_limit = self.args.concurrent_req_limit
+        self.max_queue_size = self.args.max_queue_size
+        self.max_queue_wait_sec = self.args.max_queue_wait_sec
+        self.admission = AdmissionQueue(
+            limit=self.concurrent_req_limit,
+            max_depth=self.max_queue_size,
+            max_wait_sec=self.max_queue_wait_sec,
+            metrics=self.metrics,
+        )
+
         self._register_routes()
 
     def setup(self):
@@ -161,23 +249,7 @@ class BaseExecutor:
     def _register_routes(self):
         @self.app.post(self.executor_path)
         async def api(request: Request):
-            if self.concurrent_requests >= self.concurrent_req_limit:
-                return JSONResponse(
-                    {"msg": "Processing another request."}, status_code=429
-                )
-            content = await request.form()
-            header = request.headers
-            if not content:
-                logger.debug("Received empty request!")
-                return JSONResponse({"msg": "Received empty request!"}, status_code=400)
-            logger.debug(f"HTTP headers: {header}")
-            logger.debug(f"Raw form content: {content}")
-            resp = StreamingResponse(
-                self._serve(header=header, content=content),
-                media_type="text/event-stream",
-                headers={"Content-Type": "text/event-stream; charset=utf-8"},
-            )
-            return resp
+            return await self._handle_request(request)
 
         @self.app.get("/shutdown")
         async def shutdown(request: Request):
@@ -185,7 +257,11 @@ class BaseExecutor:
             Gracefully shut down the server.
             """
             logger.info("Shutdown requested")
-            signal.raise_signal(signal.SIGINT)
+            if self.worker_pool is not None:
+                # The master stops all the workers
+                os.kill(self.worker_pool.master_pid, signal.SIGINT)
+            else:
+                signal.raise_signal(signal.SIGINT)
             return JSONResponse({"msg": "Shutting down..."}, status_code=200)
 
         @self.app.get("/health")
@@ -195,18 +271,84 @@ class BaseExecutor:
         @self.app.get(urljoin(f"{self.executor_path}/", "./abort"))
         async def abort():
             if hasattr(self, "abort") and callable(self.abort):
-                return JSONResponse({"msg": await self.abort()})
+                if self.worker_pool is not None:
+                    self.worker_pool.signal_workers([pid for pid in self.worker_pool.pids if pid != os.getpid()])
+                return JSONResponse({"msg": await self._request_abort()})
             return JSONResponse({"msg": "No abort method configured"}, status_code=404)
 
         @self.app.get("/metrics")
         async def get_metrics():
+            if self.worker_pool is not None:
+                return Response(content=generate_multiprocess_metrics(), media_type="text/plain")
             return Response(
                 content=prometheus_client.generate_latest(), media_type="text/plain"
             )
 
+        if self.worker_pool is None:
+            return
+
+        # Each slot of the workers is registered as an endpoint
+        @self.app.post(urljoin(f"{self.executor_path}/", "./{slot:int}"))
+        async def api_slot(request: Request, slot: int):
+            if slot >= self.worker_pool.slots:
+                return JSONResponse({"msg": "No such slot."}, status_code=404)
+            return await self._handle_request(request, slot=slot)
+
+        @self.app.get(urljoin(f"{self.executor_path}/", "./{slot:int}/abort"))
+        async def abort_slot(slot: int):
+            if not hasattr(self, "abort") or not callable(self.abort):
+                return JSONResponse({"msg": "No abort method configured"}, status_code=404)
+            owner = self.worker_pool.slot_owner(slot) if slot < self.worker_pool.slots else 0
+            if owner not in (0, os.getpid()):
+                # Served by another worker
+                self.worker_pool.signal_workers([owner])
+                return JSONResponse({"msg": "Abort requested"})
+            return JSONResponse({"msg": await self._request_abort()})
+
+    async def _handle_request(self, request: Request, slot: Optional[int] = None):
+        if self.admission.full():
+            self.admission.reject()
+            return JSONResponse(
+                {"msg": "Too many requests are waiting."}, status_code=429
+            )
+        content = await request.form()
+        header = request.headers
+        if not content:
+            logger.debug("Received empty request!")
+            return JSONResponse({"msg": "Received empty request!"}, status_code=400)
+        logger.debug(f"HTTP headers: {header}")
+        logger.debug(f"Raw form content: {content}")
+        stream = self._serve(header=header, content=content)
+        if slot is not None:
+            stream = self._serve_slot(slot, stream)
+        resp = StreamingResponse(
+            stream,
+            media_type="text/event-stream",
+            headers={"Content-Type": "text/event-stream; charset=utf-8"},
+        )
+        return resp
+
+    async def _serve_slot(self, slot: int, stream):
+        """
+        Record this worker as the one serving the slot while streaming,
+        so the aborts of the slot reach it.
+        """
+        self.worker_pool.claim_slot(slot)
+        try:
+            async for frame in stream:
+                yield frame
+        finally:
+            await stream.aclose()
+            self.worker_pool.release_slot(slot)
+
     def run(self):
         self.args = self.parser.parse_args()
         self._setup()
+        if self.worker_pool is not None:
+            # The setup() is done by each worker after forked
+            atexit.register(self._shut_down)
+            self._start_workers()
+            return
         self.setup()
         atexit.register(self._shut_down)
         self._start_server()
@@ -215,6 +357,19 @@ class BaseExecutor:
         scheme = "https" if self.args.https else "http"
         return urljoin(f"{scheme}://{self.host}:{self.port}/", self.executor_path)
 
+    def get_reg_endpoints(self) -> list:
+        """
+        The endpoints registered to the kernel. With multiple workers, each
+        slot is registered as an endpoint, so the kernel dispatches as many
+        requests as the slots concurrently.
+        """
+        if self.worker_pool is None:
+            return [self.get_reg_endpoint()]
+        return [
+            urljoin(f"{self.get_reg_endpoint()}/", f"./{slot}")
+            for slot in range(self.worker_pool.slots)
+        ]
+
     def in_debug(self) -> bool:
         return self.log_level.upper() == "DEBUG"
 
@@ -238,33 +393,107 @@ class BaseExecutor:
             except requests.exceptions.ConnectionError:
                 logger.exception(f"Failed to unregister {access_code} from kernel")
 
+    def lease_sec(self) -> float:
+        """
+        The TTL of the registration, which is 0 for a permanent one.
+        """
+        return self.heartbeat_interval_sec * 3
+
+    @property
+    def concurrent_requests(self) -> int:
+        return self.admission.running if self.admission is not None else 0
+
+    def load_report(self) -> dict:
+        """
+        The load reported to the kernel with the heartbeats.
+        The master process reports the total load of the workers.
+        """
+        if self.worker_pool is not None and self.worker_pool.in_master():
+            running, waiting = self.worker_pool.total_load()
+            return {
+                "concurrent_requests": running,
+                "concurrent_req_limit": self.worker_pool.slots,
+                "queue_depth": waiting,
+            }
+        return {
+            "concurrent_requests": self.concurrent_requests,
+            "concurrent_req_limit": self.concurrent_req_limit,
+            "queue_depth": self.admission.waiting if self.admission is not None else 0,
+        }
+
     @retry(tries=5, delay=1, backoff=2, jitter=(0, 1), logger=logger)
-    def _try_register(self, access_code):
+    def _try_register(self, access_code, endpoint=None):
         resp = requests.post(
             url=urljoin(
                 self.kernel_url, f"{self.executor_iface_version}/worker/register"
             ),
-            data={"name": access_code, "endpoint": self.get_reg_endpoint()},
+            data={
+                "name": access_code,
+                "endpoint": endpoint or self.get_reg_endpoint(),
+                "lease_sec": self.lease_sec(),
+                # Matches the executor to the process started by the kernel, if any
+                "pid": os.getpid(),
+                **self.load_report(),
+            },
         )
         if not resp.ok or resp.text == "Failed":
             raise RuntimeWarning("The server failed to register to kernel.")
 
+    def _heartbeat(self):
+        """
+        Renew the registration periodically. Register again if the kernel
+        has forgotten this executor, e.g. the lease expired or the kernel restarted.
+        """
+        while self.registered:
+            time.sleep(self.heartbeat_interval_sec)
+            for access_code in self.access_codes:
+                for endpoint in self.get_reg_endpoints():
+                    try:
+                        resp = requests.post(
+                            url=urljoin(
+                                self.kernel_url, f"{self.executor_iface_version}/worker/heartbeat"
+                            ),
+                            data={
+                                "name": access_code,
+                                "endpoint": endpoint,
+                                "lease_sec": self.lease_sec(),
+                                **self.load_report(),
+                            },
+                            timeout=self.heartbeat_interval_sec,
+                        )
+                        if resp.ok and resp.text == "Failed":
+                            logger.warning(f'The registration of "{access_code}" is lost, registering again.')
+                            self._try_register(access_code, endpoint)
+                    except Exception as e:
+                        logger.warning(f"Failed to send the heartbeat of {access_code}: {e}")
+
+    def _register_to_kernel(self) -> bool:
+        """
+        Register the endpoints to the kernel and start the heartbeats.
+        """
+        try:
+            for access_code in self.access_codes:
+                for endpoint in self.get_reg_endpoints():
+                    self._try_register(access_code, endpoint)
+                logger.info(f'Registered with the name "{access_code}"')
+            self.registered = True
+            if self.heartbeat_interval_sec > 0:
+                threading.Thread(target=self._heartbeat, daemon=True).start()
+            return True
+
+        except Exception:
+            logger.exception("Failed to register to kernel.")
+            return False
+
     def _start_server(self):
         self.registered = False
-        if not self.ignore_kernel:
-            try:
-                for access_code in self.access_codes:
-                    self._try_register(access_code)
-                    logger.info(f'Registered with the name "{access_code}"')
-                self.registered = True
-
-            except Exception:
-                logger.exception("Failed to register to kernel.")
-
-                if not self.ignore_kernel:
-                    logger.info("The program will exit now.")
-                    sys.exit(0)
-        self.concurrent_requests = 0
+        if not self.ignore_kernel and self.args.kernel_channel:
+            # Registered through the channel once the server started
+            self.app.add_event_handler("startup", self._open_channel)
+        elif not self.ignore_kernel:
+            if not self._register_to_kernel():
+                logger.info("The program will exit now.")
+                sys.exit(0)
         uvicorn.run(
             self.app,
             host=self.host,
@@ -272,6 +501,67 @@ class BaseExecutor:
             log_config=ExecutorLoggerFactory(level=self.log_level).get_config(),
         )
 
+    def _start_workers(self):
+        """
+        Serve with the worker processes forked from this process, which
+        accept the connections of the same listening socket. This process
+        registers the slots of the workers to the kernel once they are
+        ready, and restarts the workers exiting unexpectedly.
+        """
+        self.registered = False
+        sock = self.worker_pool.bind(self.host, self.port)
+        config = uvicorn.Config(
+            self.app,
+            log_config=ExecutorLoggerFactory(level=self.log_level).get_config(),
+        )
+
+        def serve(index):
+            self.setup()
+            self.admission.on_change = partial(self.worker_pool.publish_load, index)
+            self.app.add_event_handler("startup", self._start_worker)
+            if not self.ignore_kernel and self.args.kernel_channel:
+                # Each worker is registered through its own channel
+                self.app.add_event_handler("startup", self._open_channel)
+            uvicorn.Server(config).run(sockets=[sock])
+
+        self.worker_pool.start(serve)
+        if not self.worker_pool.wait_ready():
+            logger.error("A worker exited during the setup. The program will exit now.")
+            self.worker_pool.stop()
+        elif not self.ignore_kernel and not self.args.kernel_channel:
+            if not self._register_to_kernel():
+                logger.info("The program will exit now.")
+                self.worker_pool.stop()
+        self.worker_pool.supervise()
+
+    async def _start_worker(self):
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(ABORT_SIGNAL, lambda: asyncio.ensure_future(self._abort_worker()))
+        self.worker_pool.mark_ready()
+
+    async def _request_abort(self):
+        """
+        Abort the requests in progress, and count the aborts so that the
+        truncated responses can be told apart.
+        """
+        self.abort_count += 1
+        return await self.abort()
+
+    async def _abort_worker(self):
+        """
+        Abort the requests of this worker as asked by another worker.
+        """
+        try:
+            logger.info(f"Aborted: {await self._request_abort()}")
+        except Exception:
+            logger.exception("Failed to abort.")
+
+    async def _open_channel(self):
+        url = urljoin(self.kernel_url, f"{self.executor_iface_version}/worker/channel")
+        url = "ws" + url[len("http"):] if url.startswith("http") else url
+        self.channel = KernelChannel(self, url, self.access_codes)
+        self.channel_task = asyncio.create_task(self.channel.run())
+
     def _update_statistics(self, duration_sec: float, total_output_length: int):
         """
         Update the internal statistical metrics.
@@ -283,8 +573,28 @@ class BaseExecutor:
             self.metrics.output_throughput_charters_per_second.observe(throughput)
 
     def _format_sse(self, data: dict):
-        json_data = json.dumps(data, cls=AdvancedJSONEncoder)
-        return f"data: {json_data}\n"
+        return format_sse(data)
+
+    async def _check_chunks(self, stream, stats: Optional[GenerationStats] = None):
+        """
+        Normalize the output of serve() to lists of chunks.
+        The usage reported by the executor is taken by the stats if given.
+        """
+        async for chunks in stream:
+            if isinstance(chunks, str):
+                chunks = TextChunk(chunks)
+            if not isinstance(chunks, list):
+                chunks = [chunks]
+            unsupported_chunk = [not isinstance(x, BaseChunk) for x in chunks]
+            if any(unsupported_chunk):
+                raise RuntimeError(
+                    f"Unsupported chunk type: {[type(x) for x in compress(chunks, unsupported_chunk)]}"
+                )
+            if stats is not None:
+                chunks = stats.observe(chunks)
+                if not chunks:
+                    continue
+            yield chunks
 
     async def _serve(self, header, content):
         """
@@ -292,26 +602,35 @@ class BaseExecutor:
         Interception of the request-response can be done in this layer.
         """
 
-        self.concurrent_requests += 1
+        # Wait for the concurrent requests to finish
+        if not await self.admission.acquire():
+            yield self._format_sse(
+                {
+                    "finish_reason": "exception",
+                    "delta": [
+                        LogChunk("The executor is busy. Please try again later.", level=LogLevel.WARNING),
+                        ExitCodeChunk(exit_code=ExitCodeChunk.FAILURE),
+                    ],
+                }
+            )
+            return
         self.metrics.state.state("busy")
+        stats = GenerationStats(self.metrics)
+        # Merge the small text chunks arriving in a burst into fewer SSE frames
+        frames = coalesce_chunks(
+            self._check_chunks(self.serve(header=header, content=content), stats),
+            window_sec=self.coalesce_window_sec,
+            max_bytes=self.coalesce_max_bytes,
+        )
         try:
             start_time = time.time()
             total_output_length = 0
             exit_code_chunks = [ExitCodeChunk(exit_code=ExitCodeChunk.OK)]
 
-            async for chunks in self.serve(header=header, content=content):
-                if isinstance(chunks, str):
-                    chunks = TextChunk(chunks)
-                if not isinstance(chunks, list):
-                    chunks = [chunks]
-                unsupported_chunk = [not isinstance(x, BaseChunk) for x in chunks]
-                if any(unsupported_chunk):
-                    raise RuntimeError(
-                        f"Unsupported chunk type: {[type(x) for x in compress(chunks, unsupported_chunk)]}"
-                    )
+            async for chunks in frames:
                 exit_code_chunks += list(filter(lambda x: isinstance(x, ExitCodeChunk), chunks))
                 total_output_length += reduce(lambda x, y: x + len(y), chunks, 0)
-                yield self._format_sse({"finish_reason": None, "delta": chunks})
+                yield format_delta(chunks)
 
                 # Yield control to the event loop.
                 # So that other coroutine, like aborting, can run.
@@ -319,16 +638,13 @@ class BaseExecutor:
 
             duration_sec = time.time() - start_time
             self._update_statistics(duration_sec, total_output_length)
+            stats.finish()
 
             yield self._format_sse(
                 {
                     "finish_reason": "stop",
                     "delta": exit_code_chunks[-1:],
-                    "usage": {
-                        "prompt_tokens": 0,  # [TODO]
-                        "completion_tokens": total_output_length,
-                        "total_tokens": total_output_length,
-                    },
+                    "usage": stats.usage(),
                 }
             )
 
@@ -349,17 +665,17 @@ class BaseExecutor:
                 {
                     "finish_reason": "exception",
                     "delta": display_messages,
-                    "usage": {
-                        "prompt_tokens": 0,  # [TODO]
-                        "completion_tokens": total_output_length,
-                        "total_tokens": total_output_length,
-                    },
+                    "usage": stats.usage(),
                 }
             )
 
         finally:
-            self.metrics.state.state("idle")
-            self.concurrent_requests -= 1
+            await frames.aclose()
+            # Count the tokens of the failed or aborted requests as well
+            stats.finish(completed=False)
+            self.admission.release()
+            if self.concurrent_requests == 0:
+                self.metrics.state.state("idle")
 
     async def serve(self, header, content):
         raise NotImplementedError('Executor should implement the "serve" method.')
@@ -0,0 +1,113 @@
+import json
+import asyncio
+import logging
+
+import websockets
+from starlette.datastructures import Headers, FormData
+
+logger = logging.getLogger(__name__)
+
+
+class KernelChannel:
+    """
+    A persistent WebSocket connection to the kernel, opened by the executor.
+    The registration, the heartbeats and the requests are carried over it, so
+    the kernel doesn't need to reach the executor, e.g. behind a NAT.
+    The connection is re-established and the executor registered again when
+    the channel is broken.
+    """
+
+    def __init__(
+        self,
+        executor,
+        url: str,
+        access_codes: list,
+        reconnect_delay_sec: float = 1,
+    ):
+        self.executor = executor
+        self.url = url
+        self.access_codes = access_codes
+        self.reconnect_delay_sec = reconnect_delay_sec
+        self.endpoint = None
+        self._websocket = None
+        self._tasks = {}
+
+    async def run(self):
+        while True:
+            try:
+                async with websockets.connect(self.url, max_size=None) as websocket:
+                    self._websocket = websocket
+                    await self.send({
+                        "type": "register",
+                        "access_codes": self.access_codes,
+                        "lease_sec": self.executor.lease_sec(),
+                    })
+                    heartbeat = asyncio.create_task(self._heartbeat())
+                    try:
+                        async for message in websocket:
+                            await self.handle(json.loads(message))
+                    finally:
+                        heartbeat.cancel()
+                        self._cancel_all()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"The channel to the kernel is broken: {e}")
+            self._websocket = None
+            self.endpoint = None
+            await asyncio.sleep(self.reconnect_delay_sec)
+
+    async def send(self, message: dict):
+        await self._websocket.send(json.dumps(message))
+
+    async def handle(self, message: dict):
+        message_type = message.get("type")
+        if message_type == "registered":
+            self.endpoint = message["endpoint"]
+            logger.info(f"Registered {self.access_codes} through the channel {self.endpoint}")
+        elif message_type == "request":
+            request_id = message["request_id"]
+            self._tasks[request_id] = asyncio.create_task(
+                self._serve(request_id, message.get("form", {}), message.get("headers", {}))
+            )
+        elif message_type == "cancel":
+            task = self._tasks.pop(message.get("request_id"), None)
+            if task is not None:
+                task.cancel()
+        elif message_type == "abort":
+            if hasattr(self.executor, "abort") and callable(self.executor.abort):
+                await self.executor._request_abort()
+
+    async def _serve(self, request_id: str, form: dict, headers: dict):
+        try:
+            if self.executor.admission.full():
+                self.executor.admission.reject()
+                await self.send({"type": "error", "request_id": request_id, "message": "Too many requests are waiting."})
+                return
+            stream = self.executor._serve(
+                header=Headers(headers=headers), content=FormData(form)
+            )
+            try:
+                async for chunk in stream:
+                    await self.send({"type": "chunk", "request_id": request_id, "data": chunk})
+            finally:
+                await stream.aclose()
+            await self.send({"type": "end", "request_id": request_id})
+        except asyncio.CancelledError:
+            logger.debug(f"Request {request_id} is cancelled by the kernel")
+        except Exception:
+            logger.exception(f"Failed to serve the request {request_id} from the channel")
+        finally:
+            self._tasks.pop(request_id, None)
+
+    async def _heartbeat(self):
+        # Keep the connection alive even if the lease is disabled
+        interval_sec = self.executor.heartbeat_interval_sec or 5
+        while True:
+            await self.send({"type": "heartbeat", **self.executor.load_report()})
+            await asyncio.sleep(interval_sec)
+
+    def _cancel_all(self):
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks = {}
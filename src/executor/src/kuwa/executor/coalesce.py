@@ -0,0 +1,100 @@
+import asyncio
+from typing import AsyncIterator, List
+
+from .message import BaseChunk, TextChunk
+
+
+def is_mergeable(chunk: BaseChunk) -> bool:
+    # The annotations refer to the positions in the text, so they are kept as is.
+    return type(chunk) is TextChunk and not chunk.annotations
+
+
+def merge_text(chunks: List[BaseChunk]) -> List[BaseChunk]:
+    """
+    Merge the consecutive plain TextChunks, keeping the order of the other chunks.
+    """
+    merged = []
+    run = []
+    for chunk in chunks + [None]:
+        if chunk is not None and is_mergeable(chunk):
+            run.append(chunk)
+            continue
+        if len(run) == 1:
+            merged.append(run[0])
+        elif run:
+            cost = None
+            if any(c.cost is not None for c in run):
+                cost = sum(len(c) for c in run)
+            merged.append(TextChunk("".join(c.value for c in run), cost=cost))
+        run = []
+        if chunk is not None:
+            merged.append(chunk)
+    return merged
+
+
+async def coalesce_chunks(
+    chunks: AsyncIterator[List[BaseChunk]], window_sec: float = 0.02, max_bytes: int = 4096
+) -> AsyncIterator[List[BaseChunk]]:
+    """
+    Group the chunks into fewer frames. The plain text arriving within
+    window_sec after the last frame, up to max_bytes, is merged into one
+    frame. A slow stream isn't delayed, since the text arriving after the
+    window is sent right away. The other kinds of chunks, e.g. LogChunk and
+    ExitCodeChunk, are sent right away along with the text before them.
+    Arguments:
+        chunks: The lists of chunks from the executor.
+        window_sec: The time window to merge the text. 0 to disable the merging.
+        max_bytes: The maximum size of the text held back.
+    """
+    if window_sec <= 0:
+        async for item in chunks:
+            yield item
+        return
+
+    loop = asyncio.get_running_loop()
+    iterator = chunks.__aiter__()
+    pending = []
+    pending_bytes = 0
+    last_flush = float("-inf")
+    next_item = None
+    try:
+        while True:
+            if next_item is None:
+                next_item = asyncio.ensure_future(iterator.__anext__())
+            timeout = None
+            if pending:
+                timeout = max(last_flush + window_sec - loop.time(), 0)
+            done, _ = await asyncio.wait({next_item}, timeout=timeout)
+            if not done:
+                # The window elapsed while waiting for the next chunk
+                yield merge_text(pending)
+                pending, pending_bytes, last_flush = [], 0, loop.time()
+                continue
+            item, next_item = next_item, None
+            try:
+                item = item.result()
+            except StopAsyncIteration:
+                break
+            except Exception:
+                if pending:
+                    yield merge_text(pending)
+                    pending = []
+                raise
+            flush = False
+            for chunk in item:
+                pending.append(chunk)
+                if is_mergeable(chunk):
+                    pending_bytes += len(chunk.value.encode("utf-8"))
+                else:
+                    flush = True
+            if flush or pending_bytes >= max_bytes or loop.time() >= last_flush + window_sec:
+                yield merge_text(pending)
+                pending, pending_bytes, last_flush = [], 0, loop.time()
+        if pending:
+            yield merge_text(pending)
+    finally:
+        if next_item is not None:
+            next_item.cancel()
+            await asyncio.wait({next_item})
+        if hasattr(iterator, "aclose"):
+            await iterator.aclose()
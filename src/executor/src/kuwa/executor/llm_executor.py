@@ -1,13 +1,17 @@
 import re
 import json
+import asyncio
 import logging
 import requests
 import time
 from fnmatch import fnmatch
 from collections.abc import Iterable
+from typing import Optional
 from .base_executor import BaseExecutor
 from .modelfile import Modelfile
 from .cache import lru_cache_with_ttl
+from .message import UsageChunk
+from .response_cache import ResponseCache, make_key, to_frame
 
 logger = logging.getLogger(__name__)
 
@@ -17,6 +21,55 @@ class LLMExecutor(BaseExecutor):
     The specialized class for serving LLM process.
     """
 
+    response_cache_ttl_sec: float = 0
+    response_cache_max_bytes: int = 64 * 2**20
+    response_cache_dir: Optional[str] = None
+    response_cache_disk_max_bytes: int = 1024 * 2**20
+    response_cache: Optional[ResponseCache] = None
+
+    def _create_parser(self):
+        parser = super()._create_parser()
+        group = parser.add_argument_group("Response Cache Options")
+        group.add_argument(
+            "--response_cache_ttl",
+            type=float,
+            default=self.response_cache_ttl_sec,
+            help="Replay the response generated for the same chat history, Modelfile and generation config within the seconds. Only for the deterministic bots, e.g. with greedy decoding. Set to 0 to disable",
+        )
+        group.add_argument(
+            "--response_cache_max_bytes",
+            type=int,
+            default=self.response_cache_max_bytes,
+            help="The maximum size of the responses cached in memory",
+        )
+        group.add_argument(
+            "--response_cache_dir",
+            default=self.response_cache_dir,
+            help="The directory to cache the responses on disk as well, which is kept across restarts",
+        )
+        group.add_argument(
+            "--response_cache_disk_max_bytes",
+            type=int,
+            default=self.response_cache_disk_max_bytes,
+            help="The maximum size of the responses cached on disk",
+        )
+        return parser
+
+    def _setup(self):
+        super()._setup()
+        self.response_cache_ttl_sec = self.args.response_cache_ttl
+        self.response_cache_max_bytes = self.args.response_cache_max_bytes
+        self.response_cache_dir = self.args.response_cache_dir
+        self.response_cache_disk_max_bytes = self.args.response_cache_disk_max_bytes
+        if self.response_cache_ttl_sec > 0:
+            self.response_cache = ResponseCache(
+                ttl_sec=self.response_cache_ttl_sec,
+                max_bytes=self.response_cache_max_bytes,
+                disk_dir=self.response_cache_dir,
+                disk_max_bytes=self.response_cache_disk_max_bytes,
+                metrics=self.metrics,
+            )
+
     async def serve(self, header, content):
         param = dict(content)
         history = json.loads(param.pop("input", "[]"))
@@ -24,6 +77,11 @@ class LLMExecutor(BaseExecutor):
         history = rectify_chat_history(history)
         modelfile = Modelfile.from_json(param.pop("modelfile", "[]"))
         modelfile.parameters["_lang"] = header.get("Accept-Language")
+        cache_key = None
+        cache_control = header.get("Cache-Control", "")
+        if self.response_cache is not None and "no-cache" not in cache_control and "no-store" not in cache_control:
+            # Keyed before the per-user parameters are added
+            cache_key = make_key(history, modelfile, getattr(self, "generation_config", None))
         kuwa_api_base_url = header.get("X-Kuwa-Api-Base-Urls")
         if kuwa_api_base_url is not None:
             kuwa_api_base_url = kuwa_api_base_url.split(";")
@@ -33,8 +91,29 @@ class LLMExecutor(BaseExecutor):
 
         logger.debug(f"History: {history}")
         logger.debug(f"Modelfile: {modelfile}")
+        if cache_key is None:
+            async for chunk in self.llm_compute(history=history, modelfile=modelfile):
+                yield chunk
+            return
+
+        frames = await asyncio.to_thread(self.response_cache.get, cache_key)
+        if frames is not None:
+            logger.debug("Replaying the cached response.")
+            yield UsageChunk(prompt_tokens=0, completion_tokens=0)
+            for chunks in frames:
+                yield chunks
+            return
+
+        # Only the responses generated to the end without an abort are cached
+        abort_count = self.abort_count
+        frames = []
         async for chunk in self.llm_compute(history=history, modelfile=modelfile):
+            frame = to_frame(chunk)
+            if frame:
+                frames.append(frame)
             yield chunk
+        if self.abort_count == abort_count:
+            await asyncio.to_thread(self.response_cache.put, cache_key, frames)
 
     async def llm_compute(self, history: list[dict], modelfile: Modelfile):
         raise NotImplementedError(
@@ -3,11 +3,15 @@ from enum import Enum
 from .util import is_rfc3339
 import datetime
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
 
 class BaseChunk:
+    # The chunks are created per token, so they are kept without __dict__.
+    __slots__ = ("cost",)
+
     def __init__(self, cost: int | None = None):
         self.cost = cost
 
@@ -22,6 +26,8 @@ class BaseChunk:
 
 
 class TextChunk(BaseChunk):
+    __slots__ = ("value", "annotations")
+
     def __init__(
         self, value: str, annotations: Optional[List] = None, cost: int | None = None
     ):
@@ -41,6 +47,8 @@ class TextChunk(BaseChunk):
 
 
 class ImageURLChunk(BaseChunk):
+    __slots__ = ("image_url",)
+
     def __init__(self, image_url: str, cost: int | None = None):
         super().__init__(cost)
         self.image_url = image_url
@@ -54,6 +62,8 @@ class ImageURLChunk(BaseChunk):
 
 
 class AudioURLChunk(BaseChunk):
+    __slots__ = ("audio_url",)
+
     def __init__(self, audio_url: str, cost: int | None = None):
         super().__init__(cost)
         self.audio_url = audio_url
@@ -81,6 +91,8 @@ class LogLevel(Enum):
 
 
 class LogChunk(BaseChunk):
+    __slots__ = ("text", "level", "_timestamp")
+
     def __init__(
         self,
         text: str,
@@ -98,11 +110,20 @@ class LogChunk(BaseChunk):
             )
             timestamp = None
 
-        # Use the current timestamp
-        if timestamp is None:
-            timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        # Use the current timestamp, formatted when it's read
+        self._timestamp = time.time() if timestamp is None else timestamp
+
+    @property
+    def timestamp(self) -> str:
+        if not isinstance(self._timestamp, str):
+            self._timestamp = datetime.datetime.fromtimestamp(
+                self._timestamp, datetime.timezone.utc
+            ).isoformat()
+        return self._timestamp
 
-        self.timestamp = timestamp
+    @timestamp.setter
+    def timestamp(self, timestamp: str):
+        self._timestamp = timestamp
 
     def __jsonencode__(self):
         return {
@@ -119,6 +140,8 @@ class LogChunk(BaseChunk):
 
 
 class ProgressChunk(BaseChunk):
+    __slots__ = ("position", "total", "desc", "postfix")
+
     def __init__(
         self,
         position: int,
@@ -149,6 +172,8 @@ class ProgressChunk(BaseChunk):
 
 
 class RefusalChunk(BaseChunk):
+    __slots__ = ("text",)
+
     def __init__(self, text: str, cost: int | None = None):
         super().__init__(cost)
         self.text = text
@@ -161,6 +186,8 @@ class RefusalChunk(BaseChunk):
 
 
 class ExitCodeChunk(BaseChunk):
+    __slots__ = ("exit_code",)
+
     OK = 0
     COMPLETE = 0
     INCOMPLETE = 1
@@ -174,3 +201,36 @@ class ExitCodeChunk(BaseChunk):
 
     def calculate_cost(self):
         return 0
+
+
+class UsageChunk(BaseChunk):
+    """
+    The number of tokens consumed by the request, reported by the executor.
+    The framework takes the latest reported counts as the usage of the
+    request instead of sending the chunk to the client, so a count can be
+    reported once it's known, e.g. the prompt tokens before the generation.
+    """
+
+    __slots__ = ("prompt_tokens", "completion_tokens")
+
+    def __init__(
+        self,
+        prompt_tokens: int | None = None,
+        completion_tokens: int | None = None,
+        cost: int | None = None,
+    ):
+        super().__init__(cost)
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+
+    def __jsonencode__(self):
+        return {
+            "type": "usage",
+            "usage": {
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+            },
+        }
+
+    def calculate_cost(self):
+        return 0
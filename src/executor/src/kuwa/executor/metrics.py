@@ -1,5 +1,9 @@
+import math
+import time
 import prometheus_client
 
+from .message import TextChunk, UsageChunk
+
 
 class ExecutorMetrics:
     metrics_template = {
@@ -12,6 +16,42 @@ class ExecutorMetrics:
             "type": "Counter",
             "description": "Number of failed requests.",
         },
+        "queue_depth": {
+            "type": "Gauge",
+            "description": "Number of requests waiting for a slot.",
+            "multiprocess_mode": "livesum",
+        },
+        "queue_wait_seconds": {
+            "type": "Histogram",
+            "description": "Time a request waited for a slot with unit: Seconds.",
+            "buckets": [
+                0.001,
+                0.01,
+                0.05,
+                0.1,
+                0.25,
+                0.5,
+                1.0,
+                2.5,
+                5.0,
+                10.0,
+                30.0,
+                60.0,
+                float("inf"),
+            ],
+        },
+        "queue_rejected": {
+            "type": "Counter",
+            "description": "Number of requests rejected since the queue is full or the wait timed out.",
+        },
+        "response_cache_hits": {
+            "type": "Counter",
+            "description": "Number of requests served from the response cache.",
+        },
+        "response_cache_misses": {
+            "type": "Counter",
+            "description": "Number of requests not found in the response cache.",
+        },
         "process_time_seconds": {
             "type": "Histogram",
             "description": "Time consumed to process single request with unit: Seconds.",
@@ -38,6 +78,76 @@ class ExecutorMetrics:
                 float("inf"),
             ],
         },
+        "time_to_first_chunk_seconds": {
+            "type": "Histogram",
+            "description": "Time from starting to process a request to the first output text with unit: Seconds.",
+            "buckets": [
+                0.01,
+                0.025,
+                0.05,
+                0.1,
+                0.25,
+                0.5,
+                0.75,
+                1.0,
+                2.5,
+                5.0,
+                10.0,
+                30.0,
+                60.0,
+                float("inf"),
+            ],
+        },
+        "inter_chunk_latency_seconds": {
+            "type": "Histogram",
+            "description": "Time between the consecutive chunks of output text with unit: Seconds.",
+            "buckets": [
+                0.001,
+                0.005,
+                0.01,
+                0.02,
+                0.03,
+                0.05,
+                0.075,
+                0.1,
+                0.25,
+                0.5,
+                1.0,
+                2.5,
+                float("inf"),
+            ],
+        },
+        "prompt_tokens": {
+            "type": "Counter",
+            "description": "Number of the prompt tokens processed.",
+        },
+        "completion_tokens": {
+            "type": "Counter",
+            "description": "Number of the completion tokens generated.",
+        },
+        "output_throughput_tokens_per_second": {
+            "type": "Histogram",
+            "description": "The throughput of output tokens with unit: Tokens/Second.",
+            "buckets": [
+                1,
+                5,
+                10,
+                20,
+                30,
+                40,
+                50,
+                60,
+                70,
+                80,
+                90,
+                100,
+                150,
+                200,
+                300,
+                500,
+                float("inf"),
+            ],
+        },
         "output_length_charters": {
             "type": "Histogram",
             "description": "The length of the output text with unit: Charters.",
@@ -114,3 +224,95 @@ class ExecutorMetrics:
                 **spec,
             ).labels(self.executor_name)
             setattr(self, name, metric)
+
+
+class GenerationStats:
+    """
+    The token usage and the latency of a request, measured on the chunks
+    from the executor before they are merged into SSE frames.
+    The completion tokens are estimated from the characters of the text,
+    unless the executor reports the usage with UsageChunk.
+    Arguments:
+        metrics: The ExecutorMetrics to record to.
+    """
+
+    def __init__(self, metrics: ExecutorMetrics | None = None):
+        self.metrics = metrics
+        self.start_time = time.monotonic()
+        self.first_chunk_time = None
+        self.last_chunk_time = None
+        self.ascii_chars = 0
+        self.other_chars = 0
+        self.prompt_tokens = None
+        self.completion_tokens = None
+        self.finished = False
+
+    def observe(self, chunks: list) -> list:
+        """
+        Record the arrival of the chunks.
+        Return:
+            The chunks without the UsageChunks.
+        """
+        output = []
+        text_chunks = 0
+        for chunk in chunks:
+            if isinstance(chunk, UsageChunk):
+                if chunk.prompt_tokens is not None:
+                    self.prompt_tokens = chunk.prompt_tokens
+                if chunk.completion_tokens is not None:
+                    self.completion_tokens = chunk.completion_tokens
+                continue
+            if isinstance(chunk, TextChunk) and chunk.value:
+                text_chunks += 1
+                ascii_chars = len(chunk.value.encode("ascii", "ignore"))
+                self.ascii_chars += ascii_chars
+                self.other_chars += len(chunk.value) - ascii_chars
+            output.append(chunk)
+        if text_chunks == 0:
+            return output
+
+        now = time.monotonic()
+        if self.metrics is not None:
+            if self.first_chunk_time is None:
+                self.metrics.time_to_first_chunk_seconds.observe(now - self.start_time)
+            else:
+                self.metrics.inter_chunk_latency_seconds.observe(now - self.last_chunk_time)
+        if self.first_chunk_time is None:
+            self.first_chunk_time = now
+        self.last_chunk_time = now
+        return output
+
+    def estimated_completion_tokens(self) -> int:
+        """
+        A rough estimate when the executor doesn't report the usage. An English
+        token is about 4 characters, while a CJK character is about a token.
+        """
+        return math.ceil(self.ascii_chars / 4) + self.other_chars
+
+    def usage(self) -> dict:
+        prompt_tokens = self.prompt_tokens or 0
+        completion_tokens = self.completion_tokens
+        if completion_tokens is None:
+            completion_tokens = self.estimated_completion_tokens()
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    def finish(self, completed: bool = True):
+        """
+        Record the token usage, and the throughput if the request is completed.
+        Only the first call takes effect.
+        """
+        if self.finished or self.metrics is None:
+            return
+        self.finished = True
+        usage = self.usage()
+        self.metrics.prompt_tokens.inc(usage["prompt_tokens"])
+        self.metrics.completion_tokens.inc(usage["completion_tokens"])
+        duration_sec = time.monotonic() - self.start_time
+        if completed and duration_sec > 0 and usage["completion_tokens"] > 0:
+            self.metrics.output_throughput_tokens_per_second.observe(
+                usage["completion_tokens"] / duration_sec
+            )
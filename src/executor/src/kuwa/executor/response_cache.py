@@ -0,0 +1,274 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+from .sse import encode_chunk
+from .message import (
+    BaseChunk,
+    TextChunk,
+    ImageURLChunk,
+    AudioURLChunk,
+    LogChunk,
+    LogLevel,
+    ProgressChunk,
+    RefusalChunk,
+    ExitCodeChunk,
+    UsageChunk,
+)
+
+logger = logging.getLogger(__name__)
+
+# The chunk types which can be stored, decoded from their __jsonencode__ output
+CHUNK_DECODERS = {
+    "text": lambda d: TextChunk(d["text"]["value"], annotations=d["text"]["annotations"]),
+    "image_url": lambda d: ImageURLChunk(d["image_url"]),
+    "audio_url": lambda d: AudioURLChunk(d["audio_url"]),
+    "log": lambda d: LogChunk(d["log"]["text"], level=LogLevel[d["log"]["level"]], timestamp=d["log"]["timestamp"]),
+    "progress": lambda d: ProgressChunk(**d["progress"]),
+    "refusal": lambda d: RefusalChunk(d["refusal"]["text"]),
+    "exit_code": lambda d: ExitCodeChunk(d["exit_code"]),
+}
+STORABLE_CHUNKS = (TextChunk, ImageURLChunk, AudioURLChunk, LogChunk, ProgressChunk, RefusalChunk, ExitCodeChunk)
+
+
+def make_key(history: list, modelfile, generation_config=None) -> str:
+    """
+    The hash of the inputs deciding the response of a deterministic bot.
+    Arguments:
+        history: The chat history in the OpenAI format.
+        modelfile: The parsed Modelfile.
+        generation_config: The generation config of the executor.
+    """
+    fields = dict(vars(modelfile))
+    fields["parameters"] = dict(modelfile.parameters)
+    normalized = json.dumps(
+        {
+            "history": [
+                {k: " ".join(v.split()) if k == "content" and isinstance(v, str) else v for k, v in r.items()}
+                for r in history
+            ],
+            "modelfile": fields,
+            "generation_config": generation_config,
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def to_frame(item) -> List[BaseChunk]:
+    """
+    Normalize an item generated by llm_compute() to a list of chunks.
+    The usage isn't stored, since a replay consumes no tokens.
+    """
+    if isinstance(item, str):
+        return [TextChunk(item)]
+    if not isinstance(item, list):
+        item = [item]
+    return [c for c in item if not isinstance(c, UsageChunk)]
+
+
+def encode_chunks(frames: List[List[BaseChunk]]) -> bytes:
+    return ("[" + ", ".join("[" + ", ".join(map(encode_chunk, f)) + "]" for f in frames) + "]").encode("utf-8")
+
+
+def decode_chunks(frames: list) -> List[List[BaseChunk]]:
+    return [[CHUNK_DECODERS[c["type"]](c) for c in frame] for frame in frames]
+
+
+def storable(frames: List[List[BaseChunk]]) -> bool:
+    """
+    Whether the response can be replayed. The responses of the chunk types
+    unknown to the decoder, or failed with the FAILURE exit code, are not stored.
+    """
+    chunks = [c for frame in frames for c in frame]
+    if any(type(c) not in STORABLE_CHUNKS for c in chunks):
+        return False
+    exit_codes = [c.exit_code for c in chunks if isinstance(c, ExitCodeChunk)]
+    return not exit_codes or exit_codes[-1] != ExitCodeChunk.FAILURE
+
+
+class CacheEntry:
+    def __init__(self, frames, size, expires_at):
+        self.frames = frames
+        self.size = size
+        self.expires_at = expires_at
+
+
+class ResponseCache:
+    """
+    Cache the chunks generated for the same inputs, for the executors
+    serving deterministic bots, e.g. classification with greedy decoding.
+    The entries are kept in memory, and in a directory if given, which
+    survives the restarts and is shared by the workers. Each tier evicts
+    the entries in LRU order to keep the total size under its limit.
+    Arguments:
+        ttl_sec: The TTL of the entries in seconds.
+        max_bytes: The maximum total size of the entries in memory.
+        disk_dir: The directory of the on-disk tier. None to disable it.
+        disk_max_bytes: The maximum total size of the entries on disk.
+        metrics: The ExecutorMetrics counting the hits and misses.
+    """
+
+    def __init__(
+        self,
+        ttl_sec: float = 600,
+        max_bytes: int = 64 * 2**20,
+        disk_dir: Optional[str] = None,
+        disk_max_bytes: int = 1024 * 2**20,
+        metrics=None,
+    ):
+        self.ttl_sec = ttl_sec
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        self._disk_entries = OrderedDict()
+        self._disk_size = 0
+        if self.disk_dir is not None:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._scan_disk()
+
+    def _scan_disk(self):
+        files = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.is_file() and entry.name.endswith(".json"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name[: -len(".json")], stat.st_size))
+        for _, key, size in sorted(files):
+            self._disk_entries[key] = size
+            self._disk_size += size
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def get(self, key: str) -> Optional[List[List[BaseChunk]]]:
+        """
+        Return the cached frames of chunks, or None on miss.
+        """
+        frames = self._get_memory(key)
+        if frames is None and self.disk_dir is not None:
+            frames = self._get_disk(key)
+        if self.metrics is not None:
+            (self.metrics.response_cache_misses if frames is None else self.metrics.response_cache_hits).inc()
+        return frames
+
+    def _get_memory(self, key):
+        with self.lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at <= time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry.frames
+
+    def _get_disk(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                content = f.read()
+            entry = json.loads(content)
+            expires_at = entry["expires_at"]
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Failed to read the cached response {key}: {e}")
+            return None
+        if expires_at <= time.time():
+            self._remove_disk(key)
+            return None
+        try:
+            frames = decode_chunks(entry["frames"])
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning(f"Failed to decode the cached response {key}: {e}")
+            return None
+        # Mark as recently used, and keep a copy in memory
+        try:
+            os.utime(self._path(key))
+        except OSError:
+            pass
+        with self.lock:
+            self._disk_size -= self._disk_entries.pop(key, 0)
+            self._disk_entries[key] = len(content)
+            self._disk_size += len(content)
+        self._put_memory(key, frames, len(content), expires_at)
+        return frames
+
+    def put(self, key: str, frames: List[List[BaseChunk]]):
+        if not storable(frames):
+            return
+        data = encode_chunks(frames)
+        expires_at = time.time() + self.ttl_sec
+        self._put_memory(key, frames, len(data), expires_at)
+        if self.disk_dir is not None:
+            self._put_disk(key, data, expires_at)
+
+    def _put_memory(self, key, frames, size, expires_at):
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = CacheEntry(frames, size, expires_at)
+            self._size += size
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _put_disk(self, key, data, expires_at):
+        # A fixed precision keeps the size of an entry independent of the time
+        content = b'{"expires_at": ' + f"{expires_at:.3f}".encode("utf-8") + b', "frames": ' + data + b"}"
+        if len(content) > self.disk_max_bytes:
+            return
+        try:
+            # Written to a temporary file first, so the readers never see a partial entry
+            fd, temp_path = tempfile.mkstemp(dir=self.disk_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.replace(temp_path, self._path(key))
+        except OSError as e:
+            logger.warning(f"Failed to write the cached response {key}: {e}")
+            return
+        with self.lock:
+            self._disk_size -= self._disk_entries.pop(key, 0)
+            self._disk_entries[key] = len(content)
+            self._disk_size += len(content)
+            evicted = []
+            while self._disk_size > self.disk_max_bytes:
+                oldest, size = self._disk_entries.popitem(last=False)
+                self._disk_size -= size
+                evicted.append(oldest)
+        for oldest in evicted:
+            self._unlink(oldest)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._size -= entry.size
+
+    def _remove_disk(self, key):
+        with self.lock:
+            self._disk_size -= self._disk_entries.pop(key, 0)
+        self._unlink(key)
+
+    def _unlink(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def size(self) -> tuple:
+        """
+        The total size of the entries in memory and on disk.
+        """
+        with self.lock:
+            return self._size, self._disk_size
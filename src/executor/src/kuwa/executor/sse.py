@@ -0,0 +1,81 @@
+import json
+from json.encoder import encode_basestring_ascii as encode_string
+from typing import List
+
+from .message import (
+    BaseChunk,
+    TextChunk,
+    LogChunk,
+    ExitCodeChunk,
+)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(obj):
+    if hasattr(obj, "__jsonencode__"):
+        return obj.__jsonencode__()
+    if isinstance(obj, set):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj) -> str:
+    """
+    Serialize an object to JSON, with orjson if it's installed.
+    The chunks are serialized with their __jsonencode__ method.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default).decode("utf-8")
+    return json.dumps(obj, default=_default)
+
+
+def _encode_text(chunk: TextChunk) -> str:
+    if chunk.annotations:
+        return dumps(chunk.__jsonencode__())
+    return '{"type": "text", "text": {"value": ' + encode_string(chunk.value) + ', "annotations": []}}'
+
+
+def _encode_log(chunk: LogChunk) -> str:
+    return (
+        '{"type": "log", "log": {"text": ' + encode_string(chunk.text)
+        + ', "level": "' + str(chunk.level)
+        + '", "timestamp": ' + encode_string(chunk.timestamp) + '}}'
+    )
+
+
+def _encode_exit_code(chunk: ExitCodeChunk) -> str:
+    if type(chunk.exit_code) is not int:
+        return dumps(chunk.__jsonencode__())
+    return '{"type": "exit_code", "exit_code": ' + str(chunk.exit_code) + '}'
+
+
+# The templates of the built-in chunk types. The subclasses may override
+# __jsonencode__, so they are matched by the exact type.
+CHUNK_ENCODERS = {
+    TextChunk: _encode_text,
+    LogChunk: _encode_log,
+    ExitCodeChunk: _encode_exit_code,
+}
+
+
+def encode_chunk(chunk: BaseChunk) -> str:
+    encoder = CHUNK_ENCODERS.get(type(chunk))
+    if encoder is None:
+        return dumps(chunk.__jsonencode__())
+    return encoder(chunk)
+
+
+def format_delta(chunks: List[BaseChunk]) -> str:
+    """
+    The SSE frame of the chunks in the middle of a response, formatted from
+    templates instead of building and serializing the intermediate dictionaries.
+    """
+    return 'data: {"finish_reason": null, "delta": [' + ", ".join(map(encode_chunk, chunks)) + "]}\n"
+
+
+def format_sse(data: dict) -> str:
+    return f"data: {dumps(data)}\n"
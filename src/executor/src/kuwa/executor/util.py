@@ -138,6 +138,10 @@ def merge_config(base: dict, top: dict) -> dict:
     return base
 
 
+# Regular expression for RFC3339 timestamps (with optional fractional seconds and time zone)
+RFC3339_PATTERN = re.compile(r"^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d{1,6})?)(Z|[+-]\d{2}:\d{2})$")
+
+
 def is_rfc3339(timestamp_string):
     """
     Validates if a timestamp string conforms to RFC3339.  Handles both Z and +/- offsets.
@@ -149,17 +153,14 @@ def is_rfc3339(timestamp_string):
         True if the string is a valid RFC3339 timestamp, False otherwise.
     """
 
-    # Regular expression for RFC3339 timestamps (with optional fractional seconds and time zone)
-    pattern = r"^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d{1,6})?)(Z|[+-]\d{2}:\d{2})$"
-
-    match = re.match(pattern, timestamp_string)
+    match = RFC3339_PATTERN.match(timestamp_string)
 
     if not match:
         return False
 
     # Basic structure is valid, perform further checks for leap years and valid date ranges.
     year, month, day = map(int, match.group(1).split("T")[0].split("-"))
-    hour, minute, second = map(int, match.group(1).split("T")[1].split(":")[:3])
+    hour, minute, second = map(int, match.group(1).split("T")[1].split(".")[0].split(":")[:3])
 
     if not (
         1 <= month <= 12
@@ -0,0 +1,234 @@
+import os
+import time
+import atexit
+import shutil
+import signal
+import socket
+import logging
+import tempfile
+from multiprocessing.sharedctypes import RawArray
+
+import prometheus_client
+from prometheus_client import multiprocess
+
+logger = logging.getLogger(__name__)
+
+# The signal asking a worker to abort its requests
+ABORT_SIGNAL = getattr(signal, "SIGUSR1", None)
+
+
+def fork_supported() -> bool:
+    return hasattr(os, "fork") and ABORT_SIGNAL is not None
+
+
+def enable_multiprocess_metrics():
+    """
+    Keep the metrics in files shared by the processes, so any of them can
+    report the metrics of all the workers. Called before the first metric
+    is created.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        path = tempfile.mkdtemp(prefix="kuwa-executor-metrics-")
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = path
+        # Only the master runs the exit handlers
+        atexit.register(shutil.rmtree, path, ignore_errors=True)
+    prometheus_client.values.ValueClass = prometheus_client.values.get_value_class()
+
+
+def generate_multiprocess_metrics() -> bytes:
+    """
+    The metrics aggregated across the worker processes.
+    The Enum metrics, e.g. the state, are only kept per process and are left out.
+    """
+    registry = prometheus_client.CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return prometheus_client.generate_latest(registry)
+
+
+class WorkerPool:
+    """
+    Pre-fork the worker processes accepting the connections of the same
+    listening socket, and restart them if they exit unexpectedly.
+    The workers are forked by a supervisor process, which is forked before
+    the master starts any thread, e.g. the heartbeats. Forking a process
+    with threads could leave the locks held by the other threads, e.g. of
+    the logging or the connection pools, locked forever in the child.
+    Each worker serves `limit` requests at a time. The kernel sees
+    `workers * limit` slots, each of them registered as an endpoint, and
+    the worker serving a slot is recorded in the shared memory, so that an
+    abort received by any worker reaches the one serving the slot.
+    Arguments:
+        workers: The number of the worker processes.
+        limit: The number of concurrent requests of a worker.
+    """
+
+    def __init__(self, workers: int, limit: int = 1):
+        self.workers = workers
+        self.slots = workers * limit
+        self.master_pid = os.getpid()
+        self.index = None
+        self.stopping = False
+        self.pids = RawArray("i", workers)
+        self.load = RawArray("i", workers * 2)
+        self.slot_owners = RawArray("i", self.slots)
+        self.ready = RawArray("i", workers)
+        # Whether the pool became ready once, and whether the setup failed
+        self.status = RawArray("i", 2)
+        self.supervisor_pid = None
+
+    def in_master(self) -> bool:
+        return self.index is None
+
+    def bind(self, host: str, port: int) -> socket.socket:
+        family = socket.AF_INET6 if host and ":" in host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(2048)
+        sock.set_inheritable(True)
+        return sock
+
+    def start(self, target):
+        """
+        Fork the supervisor, which forks the workers running target(index).
+        Called before the master starts any thread.
+        """
+        pid = os.fork()
+        if pid != 0:
+            self.supervisor_pid = pid
+            return
+        exit_code = 0
+        try:
+            for index in range(self.workers):
+                self._spawn(index, target)
+            self._supervise_workers(target)
+        except BaseException:
+            logger.exception("The supervisor of the workers failed.")
+            exit_code = 1
+        finally:
+            # Skip the exit handlers of the master
+            os._exit(exit_code)
+
+    def _spawn(self, index: int, target):
+        pid = os.fork()
+        if pid != 0:
+            self.pids[index] = pid
+            logger.info(f"Started worker {index} with pid {pid}")
+            return
+        self.index = index
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, signal.SIG_DFL)
+        exit_code = 0
+        try:
+            target(index)
+        except BaseException:
+            logger.exception(f"Worker {index} failed.")
+            exit_code = 1
+        finally:
+            # Skip the exit handlers of the master, e.g. unregistering from the kernel
+            os._exit(exit_code)
+
+    def supervise(self):
+        """
+        Wait in the master process until the workers are stopped.
+        """
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda signum, frame: self.stop())
+        while True:
+            try:
+                os.waitpid(self.supervisor_pid, 0)
+            except InterruptedError:
+                continue
+            except ChildProcessError:
+                pass
+            break
+
+    def _supervise_workers(self, target):
+        """
+        Wait for the workers in the supervisor process, restarting the ones
+        exiting unexpectedly, until they are stopped.
+        """
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda signum, frame: self.stop())
+        while True:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+                multiprocess.mark_process_dead(pid)
+            if pid not in self.pids:
+                continue
+            index = list(self.pids).index(pid)
+            if not self.status[0] and not self.ready[index]:
+                # Exited during the setup before the pool is ready
+                self.status[1] = 1
+                self.stop()
+            self.pids[index] = 0
+            self.ready[index] = 0
+            self.publish_load(index, 0, 0)
+            for slot, owner in enumerate(self.slot_owners):
+                if owner == pid:
+                    self.slot_owners[slot] = 0
+            if self.stopping:
+                continue
+            logger.warning(f"Worker {index} (pid {pid}) exited with status {status}. Restarting it.")
+            time.sleep(1)
+            if not self.stopping:
+                self._spawn(index, target)
+
+    def wait_ready(self, interval_sec: float = 0.1) -> bool:
+        """
+        Wait for the workers to finish the setup.
+        Return:
+            False if any of the workers exited before it's ready.
+        """
+        while not all(self.ready):
+            if self.status[1] or os.waitpid(self.supervisor_pid, os.WNOHANG)[0] != 0:
+                return False
+            time.sleep(interval_sec)
+        self.status[0] = 1
+        return True
+
+    def mark_ready(self):
+        self.ready[self.index] = 1
+
+    def stop(self):
+        if self.stopping:
+            return
+        self.stopping = True
+        logger.info("Stopping the workers.")
+        if self.supervisor_pid is not None:
+            # In the master, the supervisor stops the workers
+            self.signal_workers([self.supervisor_pid], signal.SIGTERM)
+        else:
+            self.signal_workers(list(self.pids), signal.SIGTERM)
+
+    def signal_workers(self, pids, signum=ABORT_SIGNAL):
+        for pid in pids:
+            if pid <= 0:
+                continue
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def publish_load(self, index: int, running: int, waiting: int):
+        self.load[index * 2] = running
+        self.load[index * 2 + 1] = waiting
+
+    def total_load(self) -> tuple:
+        """
+        The number of the running and the waiting requests of all the workers.
+        """
+        return sum(self.load[0::2]), sum(self.load[1::2])
+
+    def claim_slot(self, slot: int):
+        self.slot_owners[slot] = os.getpid()
+
+    def release_slot(self, slot: int):
+        if self.slot_owners[slot] == os.getpid():
+            self.slot_owners[slot] = 0
+
+    def slot_owner(self, slot: int) -> int:
+        return self.slot_owners[slot]
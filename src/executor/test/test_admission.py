@@ -0,0 +1,55 @@
+import asyncio
+import unittest
+import logging
+from kuwa.executor.admission import AdmissionQueue
+
+
+class TestAdmissionQueue(unittest.IsolatedAsyncioTestCase):
+    async def test_wait_for_slot(self):
+        queue = AdmissionQueue(limit=1, max_depth=4, max_wait_sec=5)
+        self.assertTrue(await queue.acquire())
+        waiter = asyncio.create_task(queue.acquire())
+        await asyncio.sleep(0.01)
+        self.assertEqual((queue.running, queue.waiting), (1, 1))
+        queue.release()
+        self.assertTrue(await waiter)
+        self.assertEqual((queue.running, queue.waiting), (1, 0))
+        queue.release()
+        self.assertEqual(queue.running, 0)
+
+    async def test_fifo(self):
+        queue = AdmissionQueue(limit=1, max_depth=4, max_wait_sec=5)
+        await queue.acquire()
+        order = []
+        async def request(i):
+            await queue.acquire()
+            order.append(i)
+            queue.release()
+        tasks = [asyncio.create_task(request(i)) for i in range(3)]
+        await asyncio.sleep(0.01)
+        queue.release()
+        await asyncio.gather(*tasks)
+        self.assertEqual(order, [0, 1, 2])
+
+    async def test_queue_full(self):
+        queue = AdmissionQueue(limit=1, max_depth=1, max_wait_sec=5)
+        await queue.acquire()
+        waiter = asyncio.create_task(queue.acquire())
+        await asyncio.sleep(0.01)
+        self.assertTrue(queue.full())
+        self.assertFalse(await queue.acquire())
+        queue.release()
+        self.assertTrue(await waiter)
+
+    async def test_timeout(self):
+        queue = AdmissionQueue(limit=1, max_depth=4, max_wait_sec=0.05)
+        await queue.acquire()
+        self.assertFalse(await queue.acquire())
+        self.assertEqual((queue.running, queue.waiting), (1, 0))
+        queue.release()
+        self.assertTrue(await queue.acquire())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
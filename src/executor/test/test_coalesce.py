@@ -0,0 +1,105 @@
+import asyncio
+import unittest
+import logging
+from kuwa.executor.coalesce import coalesce_chunks, merge_text
+from kuwa.executor.message import TextChunk, LogChunk, ExitCodeChunk
+
+
+def describe(frames):
+    return [[c.value if isinstance(c, TextChunk) else type(c).__name__ for c in frame] for frame in frames]
+
+
+async def stream(items, delay_sec=0):
+    for item in items:
+        if delay_sec:
+            await asyncio.sleep(delay_sec)
+        yield item if isinstance(item, list) else [item]
+
+
+async def collect(chunks, **kwargs):
+    return [frame async for frame in coalesce_chunks(chunks, **kwargs)]
+
+
+class TestMergeText(unittest.TestCase):
+    def test_keep_order(self):
+        chunks = [TextChunk("a"), TextChunk("b"), LogChunk("log"), TextChunk("c"), ExitCodeChunk(0)]
+        self.assertEqual(describe([merge_text(chunks)]), [["ab", "LogChunk", "c", "ExitCodeChunk"]])
+
+    def test_annotations(self):
+        annotated = TextChunk("b", annotations=[{"type": "file_citation"}])
+        merged = merge_text([TextChunk("a"), annotated, TextChunk("c")])
+        self.assertEqual(describe([merged]), [["a", "b", "c"]])
+        self.assertIs(merged[1], annotated)
+
+    def test_cost(self):
+        merged = merge_text([TextChunk("ab", cost=1), TextChunk("c")])
+        self.assertEqual(len(merged[0]), 2)
+        self.assertEqual(len(merge_text([TextChunk("ab"), TextChunk("c")])[0]), 3)
+
+
+class TestCoalesceChunks(unittest.IsolatedAsyncioTestCase):
+    async def test_burst(self):
+        tokens = [TextChunk(str(i)) for i in range(100)]
+        frames = await collect(stream(tokens), window_sec=10)
+        # The first token is sent right away, and the rest in the same window are merged
+        self.assertEqual(describe(frames), [["0"], ["".join(str(i) for i in range(1, 100))]])
+
+    async def test_slow_stream(self):
+        tokens = [TextChunk(str(i)) for i in range(3)]
+        frames = await collect(stream(tokens, delay_sec=0.05), window_sec=0.01)
+        self.assertEqual(describe(frames), [["0"], ["1"], ["2"]])
+
+    async def test_window(self):
+        async def chunks():
+            yield [TextChunk("a")]
+            yield [TextChunk("b")]
+            await asyncio.sleep(0.2)
+            yield [TextChunk("c")]
+        frames = await collect(chunks(), window_sec=0.05)
+        # "b" is sent once the window elapsed without waiting for "c"
+        self.assertEqual(describe(frames), [["a"], ["b"], ["c"]])
+
+    async def test_max_bytes(self):
+        tokens = [TextChunk("xx") for _ in range(5)]
+        frames = await collect(stream(tokens), window_sec=10, max_bytes=4)
+        self.assertEqual(describe(frames), [["xx"], ["xxxx"], ["xxxx"]])
+
+    async def test_non_text(self):
+        items = [TextChunk("a"), TextChunk("b"), TextChunk("c"), LogChunk("log"), TextChunk("d"), ExitCodeChunk(0)]
+        frames = await collect(stream(items), window_sec=10)
+        self.assertEqual(describe(frames), [["a"], ["bc", "LogChunk"], ["d", "ExitCodeChunk"]])
+
+    async def test_disabled(self):
+        tokens = [TextChunk(str(i)) for i in range(3)]
+        frames = await collect(stream(tokens), window_sec=0)
+        self.assertEqual(describe(frames), [["0"], ["1"], ["2"]])
+
+    async def test_error(self):
+        async def chunks():
+            yield [TextChunk("a")]
+            yield [TextChunk("b")]
+            raise ValueError("broken")
+        frames = []
+        with self.assertRaises(ValueError):
+            async for frame in coalesce_chunks(chunks(), window_sec=10):
+                frames.append(frame)
+        self.assertEqual(describe(frames), [["a"], ["b"]])
+
+    async def test_close(self):
+        closed = asyncio.Event()
+        async def chunks():
+            try:
+                while True:
+                    yield [TextChunk("x")]
+                    await asyncio.sleep(0.01)
+            finally:
+                closed.set()
+        frames = coalesce_chunks(chunks(), window_sec=0.05)
+        await frames.__anext__()
+        await frames.aclose()
+        self.assertTrue(closed.is_set())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
@@ -0,0 +1,89 @@
+import time
+import unittest
+import logging
+from types import SimpleNamespace
+from kuwa.executor.metrics import GenerationStats
+from kuwa.executor.message import TextChunk, LogChunk, UsageChunk
+
+
+class Recorder:
+    def __init__(self):
+        self.values = []
+
+    def observe(self, value):
+        self.values.append(value)
+
+    def inc(self, value=1):
+        self.values.append(value)
+
+
+def fake_metrics():
+    names = [
+        "time_to_first_chunk_seconds",
+        "inter_chunk_latency_seconds",
+        "prompt_tokens",
+        "completion_tokens",
+        "output_throughput_tokens_per_second",
+    ]
+    return SimpleNamespace(**{name: Recorder() for name in names})
+
+
+class TestGenerationStats(unittest.TestCase):
+    def test_estimated_usage(self):
+        stats = GenerationStats()
+        stats.observe([TextChunk("Hello"), TextChunk(" world")])
+        stats.observe([LogChunk("Loading")])
+        self.assertEqual(
+            stats.usage(),
+            {"prompt_tokens": 0, "completion_tokens": 3, "total_tokens": 3},
+        )
+        stats.observe([TextChunk("你好")])
+        self.assertEqual(stats.usage()["completion_tokens"], 5)
+
+    def test_reported_usage(self):
+        stats = GenerationStats()
+        output = stats.observe([UsageChunk(prompt_tokens=12), TextChunk("Hi")])
+        self.assertEqual([type(c) for c in output], [TextChunk])
+        stats.observe([UsageChunk(completion_tokens=3)])
+        # The latest report wins
+        stats.observe([UsageChunk(prompt_tokens=10)])
+        self.assertEqual(
+            stats.usage(),
+            {"prompt_tokens": 10, "completion_tokens": 3, "total_tokens": 13},
+        )
+
+    def test_latency(self):
+        metrics = fake_metrics()
+        stats = GenerationStats(metrics)
+        stats.observe([LogChunk("Loading")])
+        self.assertEqual(metrics.time_to_first_chunk_seconds.values, [])
+        time.sleep(0.01)
+        stats.observe([TextChunk("a")])
+        stats.observe([TextChunk("b")])
+        stats.observe([TextChunk("c")])
+        self.assertEqual(len(metrics.time_to_first_chunk_seconds.values), 1)
+        self.assertGreater(metrics.time_to_first_chunk_seconds.values[0], 0)
+        self.assertEqual(len(metrics.inter_chunk_latency_seconds.values), 2)
+
+    def test_finish(self):
+        metrics = fake_metrics()
+        stats = GenerationStats(metrics)
+        stats.observe([UsageChunk(prompt_tokens=5), TextChunk("abcd"), TextChunk("efgh")])
+        stats.finish()
+        stats.finish(completed=False)
+        self.assertEqual(metrics.prompt_tokens.values, [5])
+        self.assertEqual(metrics.completion_tokens.values, [2])
+        self.assertEqual(len(metrics.output_throughput_tokens_per_second.values), 1)
+
+    def test_finish_incomplete(self):
+        metrics = fake_metrics()
+        stats = GenerationStats(metrics)
+        stats.observe([TextChunk("a")])
+        stats.finish(completed=False)
+        self.assertEqual(metrics.completion_tokens.values, [1])
+        self.assertEqual(metrics.output_throughput_tokens_per_second.values, [])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import time
+import tempfile
+import unittest
+import logging
+from kuwa.executor.modelfile import Modelfile
+from kuwa.executor.response_cache import ResponseCache, make_key, to_frame
+from kuwa.executor.message import TextChunk, LogChunk, LogLevel, ExitCodeChunk, UsageChunk
+
+
+class CustomChunk(TextChunk):
+    pass
+
+
+def describe(frames):
+    return [[c.__jsonencode__() for c in frame] for frame in frames]
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.frames = [
+            [TextChunk("Positive")],
+            [LogChunk("Done", level=LogLevel.WARNING), ExitCodeChunk(ExitCodeChunk.INCOMPLETE)],
+        ]
+
+    def test_key(self):
+        history = [{"role": "user", "content": "Hello  world"}]
+        modelfile = Modelfile.from_json('[{"name": "parameter", "args": "llm_temperature 0"}]')
+        key = make_key(history, modelfile)
+        self.assertEqual(make_key([{"role": "user", "content": "Hello world "}], modelfile), key)
+        self.assertNotEqual(make_key(history, Modelfile.from_json("[]")), key)
+        self.assertNotEqual(make_key(history, modelfile, {"temperature": 1}), key)
+
+    def test_memory(self):
+        cache = ResponseCache(ttl_sec=60)
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", self.frames)
+        self.assertEqual(describe(cache.get("a")), describe(self.frames))
+
+    def test_ttl(self):
+        cache = ResponseCache(ttl_sec=0.05)
+        cache.put("a", self.frames)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.size(), (0, 0))
+
+    def test_lru(self):
+        cache = ResponseCache(ttl_sec=60)
+        cache.put("a", self.frames)
+        size = cache.size()[0]
+        cache = ResponseCache(ttl_sec=60, max_bytes=size * 2)
+        cache.put("a", self.frames)
+        cache.put("b", self.frames)
+        cache.get("a")
+        cache.put("c", self.frames)
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.size()[0], size * 2)
+
+    def test_not_stored(self):
+        cache = ResponseCache(ttl_sec=60)
+        cache.put("failed", [[TextChunk("Error")], [ExitCodeChunk(ExitCodeChunk.FAILURE)]])
+        cache.put("custom", [[CustomChunk("x")]])
+        self.assertIsNone(cache.get("failed"))
+        self.assertIsNone(cache.get("custom"))
+
+    def test_disk(self):
+        with tempfile.TemporaryDirectory() as disk_dir:
+            ResponseCache(ttl_sec=60, disk_dir=disk_dir).put("a", self.frames)
+            # Found by another process, e.g. after a restart
+            cache = ResponseCache(ttl_sec=60, disk_dir=disk_dir)
+            frames = cache.get("a")
+            self.assertEqual(describe(frames), describe(self.frames))
+            self.assertEqual(frames[1][0].level, LogLevel.WARNING)
+            self.assertGreater(cache.size()[0], 0)
+
+    def test_disk_lru(self):
+        with tempfile.TemporaryDirectory() as disk_dir:
+            cache = ResponseCache(ttl_sec=60, disk_dir=disk_dir)
+            cache.put("a", self.frames)
+            size = cache.size()[1]
+            cache = ResponseCache(ttl_sec=60, max_bytes=0, disk_dir=disk_dir, disk_max_bytes=size * 2)
+            cache.put("b", self.frames)
+            cache.get("a")
+            cache.put("c", self.frames)
+            self.assertEqual(sorted(os.listdir(disk_dir)), ["a.json", "c.json"])
+            self.assertEqual(cache.size(), (0, size * 2))
+
+    def test_to_frame(self):
+        self.assertEqual(describe([to_frame("Hi")]), describe([[TextChunk("Hi")]]))
+        self.assertEqual(to_frame([UsageChunk(prompt_tokens=1)]), [])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
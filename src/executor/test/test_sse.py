@@ -0,0 +1,59 @@
+import json
+import unittest
+import logging
+from kuwa.executor.base_executor import AdvancedJSONEncoder
+from kuwa.executor.message import TextChunk, LogChunk, LogLevel, ExitCodeChunk, ProgressChunk
+from kuwa.executor.util import is_rfc3339
+from kuwa.executor.sse import format_delta, format_sse, encode_chunk
+
+
+def legacy_format(data):
+    return f"data: {json.dumps(data, cls=AdvancedJSONEncoder)}\n"
+
+
+class CustomTextChunk(TextChunk):
+    def __jsonencode__(self):
+        return {"type": "custom", "value": self.value}
+
+
+class TestSSE(unittest.TestCase):
+    def test_format_delta(self):
+        chunks = [
+            TextChunk('Hello "world"\n'),
+            TextChunk("你好"),
+            TextChunk("cited", annotations=[{"type": "file_citation"}]),
+            LogChunk("Loading", level=LogLevel.WARNING),
+            ProgressChunk(1, 10),
+            ExitCodeChunk(ExitCodeChunk.OK),
+        ]
+        expected = legacy_format({"finish_reason": None, "delta": chunks})
+        frame = format_delta(chunks)
+        self.assertTrue(frame.startswith("data: ") and frame.endswith("\n"))
+        self.assertEqual(json.loads(frame[len("data: "):]), json.loads(expected[len("data: "):]))
+
+    def test_identical_text_frame(self):
+        chunks = [TextChunk("token"), ExitCodeChunk(0)]
+        self.assertEqual(format_delta(chunks), legacy_format({"finish_reason": None, "delta": chunks}))
+
+    def test_subclass(self):
+        self.assertEqual(json.loads(encode_chunk(CustomTextChunk("a"))), {"type": "custom", "value": "a"})
+
+    def test_format_sse(self):
+        data = {"finish_reason": "stop", "delta": [ExitCodeChunk(0)], "usage": {"total_tokens": 1}}
+        self.assertEqual(json.loads(format_sse(data)[len("data: "):]), json.loads(legacy_format(data)[len("data: "):]))
+
+
+class TestChunk(unittest.TestCase):
+    def test_slots(self):
+        self.assertFalse(hasattr(TextChunk("a"), "__dict__"))
+        self.assertFalse(hasattr(ExitCodeChunk(0), "__dict__"))
+
+    def test_log_timestamp(self):
+        self.assertTrue(is_rfc3339(LogChunk("a").timestamp))
+        self.assertEqual(LogChunk("a", timestamp="2024-01-01T00:00:00Z").timestamp, "2024-01-01T00:00:00Z")
+        self.assertNotEqual(LogChunk("a", timestamp="yesterday").timestamp, "yesterday")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
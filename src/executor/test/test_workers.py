@@ -0,0 +1,85 @@
+import os
+import time
+import unittest
+import logging
+from multiprocessing.sharedctypes import RawArray
+from kuwa.executor.workers import WorkerPool, fork_supported
+
+
+class TestWorkerPool(unittest.TestCase):
+    def test_load(self):
+        pool = WorkerPool(2, limit=2)
+        self.assertEqual(pool.slots, 4)
+        pool.publish_load(0, 2, 1)
+        pool.publish_load(1, 1, 3)
+        self.assertEqual(pool.total_load(), (3, 4))
+
+    def test_slot_owner(self):
+        pool = WorkerPool(2)
+        pool.claim_slot(1)
+        self.assertEqual(pool.slot_owner(1), os.getpid())
+        self.assertEqual(pool.slot_owner(0), 0)
+        pool.release_slot(1)
+        self.assertEqual(pool.slot_owner(1), 0)
+
+    @unittest.skipUnless(fork_supported(), "fork is not supported")
+    def test_start_and_stop(self):
+        pool = WorkerPool(2)
+
+        def serve(index):
+            pool.publish_load(index, 1, 0)
+            pool.mark_ready()
+            time.sleep(30)
+
+        pool.start(serve)
+        self.assertTrue(pool.wait_ready())
+        self.assertTrue(pool.in_master())
+        self.assertEqual(pool.total_load(), (2, 0))
+        pool.stop()
+        pool.supervise()
+        self.assertEqual(list(pool.pids), [0, 0])
+        self.assertEqual(pool.total_load(), (0, 0))
+
+    @unittest.skipUnless(fork_supported(), "fork is not supported")
+    def test_restart(self):
+        pool = WorkerPool(1)
+        starts = RawArray("i", 1)
+
+        def serve(index):
+            starts[0] += 1
+            pool.mark_ready()
+            if starts[0] == 1:
+                # Crash once after the setup
+                os._exit(1)
+            time.sleep(30)
+
+        pool.start(serve)
+        try:
+            self.assertTrue(pool.wait_ready())
+            deadline = time.monotonic() + 5
+            while starts[0] < 2 and time.monotonic() < deadline:
+                time.sleep(0.1)
+            self.assertEqual(starts[0], 2)
+            self.assertNotEqual(pool.pids[0], 0)
+        finally:
+            pool.stop()
+            pool.supervise()
+        self.assertEqual(list(pool.pids), [0])
+
+    @unittest.skipUnless(fork_supported(), "fork is not supported")
+    def test_failed_setup(self):
+        pool = WorkerPool(1)
+
+        def serve(index):
+            raise RuntimeError("broken")
+
+        pool.start(serve)
+        self.assertFalse(pool.wait_ready())
+        # Reap the supervisor
+        os.waitpid(pool.supervisor_pid, 0)
+        self.assertEqual(list(pool.pids), [0])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
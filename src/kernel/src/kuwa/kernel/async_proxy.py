@@ -0,0 +1,189 @@
+import time
+import asyncio
+import logging
+import aiohttp
+from urllib.parse import parse_qsl
+from uvicorn.middleware.wsgi import WSGIMiddleware
+from .variable import *
+from .safety_middleware import safety_guard_installed
+from .channel import is_channel_endpoint
+
+logger = logging.getLogger(__name__)
+
+# Headers that shouldn't be forwarded to the executor
+HOP_BY_HOP_HEADERS = {
+    b"host", b"content-length", b"connection", b"keep-alive", b"transfer-encoding",
+    b"te", b"trailer", b"upgrade", b"proxy-authorization", b"proxy-authenticate",
+}
+
+class AsyncCompletionsProxy:
+    """
+    An ASGI application serving the kernel with asyncio.
+    The chat completions are relayed to the executors through a shared
+    aiohttp session, which keeps the connections to each executor alive, so
+    a long generation occupies a coroutine rather than an OS thread. Other
+    routes, and the completions that the Safety Guard needs to inspect, are
+    served by the Flask application in a thread pool.
+    Arguments:
+        flask_app: The Flask application of the kernel.
+        completions_path: The path of the chat completions API.
+        pool_size_per_endpoint: The maximum number of connections kept to an executor.
+        wsgi_workers: The number of threads serving the Flask application.
+        channel_path: The path accepting the WebSocket channels of the executors.
+    """
+
+    def __init__(self, flask_app, completions_path, pool_size_per_endpoint=100, wsgi_workers=256, channel_path=None):
+        self.wsgi_app = WSGIMiddleware(flask_app, workers=wsgi_workers)
+        self.completions_path = completions_path
+        self.channel_path = channel_path
+        self.pool_size_per_endpoint = pool_size_per_endpoint
+        self.session = None
+        reasons = [
+            reason for reason, enabled in [
+                ("the Safety Guard is installed", safety_guard_installed()),
+                ("--coalesce_requests is set", completion_coalescer.enabled),
+                ("--response_cache_ttl is set", response_cache.enabled()),
+            ] if enabled
+        ]
+        self.relay_natively = not reasons
+        if reasons:
+            logger.warning(
+                f"The chat completions are served by the thread pool since {', '.join(reasons)}. "
+                "Each generation occupies one of the --wsgi_workers threads."
+            )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] == "websocket":
+            if scope["path"] == self.channel_path:
+                return await executor_channels.serve(scope, receive, send)
+            return await send({"type": "websocket.close"})
+        if (
+            self.relay_natively
+            and scope["type"] == "http"
+            and scope["method"] == "POST"
+            and scope["path"] == self.completions_path
+            and dict(scope["headers"]).get(b"content-type", b"").startswith(b"application/x-www-form-urlencoded")
+        ):
+            return await self.completions(scope, receive, send)
+        return await self.wsgi_app(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.session = self.create_session()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.session is not None:
+                    await self.session.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def create_session(self):
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.pool_size_per_endpoint)
+        # Same as the read timeout of the synchronous path.
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=5000)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout, auto_decompress=False)
+
+    async def completions(self, scope, receive, send):
+        # Forward SSE stream to the READY state LLM API, If no exist then return empty message
+        # Parameters: name, input, history_id, user_id
+        body, disconnected = await read_body(receive)
+        if disconnected:
+            return
+        form = dict(parse_qsl(body.decode("utf-8"), keep_blank_values=True))
+        llm_name = form.get("name")
+        # The scheduler might block on its lock or on the I/O of a shared state backend
+        dest = await asyncio.to_thread(scheduler.lookup, llm_name, form.get("history_id"), form.get("user_id"))
+        if dest is None:
+            return await send_text(send, "")
+        if self.session is None:
+            self.session = self.create_session()
+
+        headers = [(k.decode("latin-1"), v.decode("latin-1")) for k, v in scope["headers"] if k not in HOP_BY_HOP_HEADERS]
+        start_time = time.monotonic()
+        response = None
+        chunks = None
+        disconnect_watcher = None
+        # The reservation is released however the relay ends
+        try:
+            try:
+                if is_channel_endpoint(dest[0]):
+                    channel = executor_channels.get(dest[0])
+                    if channel is None:
+                        raise aiohttp.ClientConnectionError(f"The channel {dest[0]} is closed")
+                    chunks = channel.stream(form, dict(headers))
+                else:
+                    response = await self.session.post(dest[0], data=body, headers=headers)
+                    chunks = response.content.iter_any()
+            except aiohttp.ClientConnectionError:
+                #POST Failed, unregister this LLM
+                kernel_metrics.proxy_failed.labels(llm_name).inc()
+                await asyncio.to_thread(scheduler.unregister, llm_name, endpoint=dest[0])
+                record_journal.unregister(llm_name, endpoint=dest[0])
+                return await send_text(send, "")
+
+            await asyncio.to_thread(scheduler.occupy, dest)
+            disconnect_watcher = asyncio.create_task(wait_disconnect(receive))
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"text/plain")],
+            })
+            first_chunk = True
+            async for chunk in chunks:
+                if disconnect_watcher.done():
+                    logger.info(f"Client of {llm_name} disconnected, stop relaying from {dest[0]}")
+                    break
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                if first_chunk:
+                    kernel_metrics.proxy_time_to_first_byte_seconds.labels(llm_name).observe(time.monotonic() - start_time)
+                    first_chunk = False
+                kernel_metrics.proxy_relayed_bytes.labels(llm_name).inc(len(chunk))
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        except Exception as e:
+            kernel_metrics.proxy_failed.labels(llm_name).inc()
+            logger.warning(f"Error during relaying from {dest[0]}: {e}")
+        finally:
+            kernel_metrics.proxy_stream_duration_seconds.labels(llm_name).observe(time.monotonic() - start_time)
+            if disconnect_watcher is not None:
+                disconnect_watcher.cancel()
+            if response is not None:
+                if response.content.at_eof():
+                    # Return the connection to the pool
+                    response.release()
+                else:
+                    response.close()
+            elif chunks is not None:
+                # Cancel the request on the channel if not finished
+                await chunks.aclose()
+            await asyncio.to_thread(scheduler.release, llm_name, dest)
+
+async def read_body(receive):
+    """
+    Read the whole request body. Return the body and whether the client has disconnected.
+    """
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return b"", True
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            return b"".join(chunks), False
+
+async def wait_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+async def send_text(send, text, status=200):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"text/html; charset=utf-8")],
+    })
+    await send({"type": "http.response.body", "body": text.encode("utf-8")})
@@ -0,0 +1,197 @@
+import json
+import uuid
+import queue
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+CHANNEL_SCHEME = "channel://"
+
+def is_channel_endpoint(endpoint):
+    return endpoint.startswith(CHANNEL_SCHEME)
+
+class ChannelClosedError(ConnectionError):
+    pass
+
+class ExecutorChannel:
+    """
+    A persistent WebSocket connection opened by an executor. The requests
+    are dispatched to the executor and the chunks are streamed back over it,
+    each tagged with a request ID.
+    Messages from the kernel:
+        request: {request_id, form, headers}
+        cancel: {request_id}, the client of the request has left.
+        abort: Abort the generation in progress.
+        registered: {endpoint}
+    Messages from the executor:
+        register: {access_codes, lease_sec}
+        heartbeat: {concurrent_requests, concurrent_req_limit, queue_depth}, renews the lease.
+        chunk: {request_id, data}
+        end: {request_id}
+        error: {request_id, message}
+    """
+
+    def __init__(self, send, loop):
+        self.channel_id = uuid.uuid4().hex
+        self.endpoint = f"{CHANNEL_SCHEME}{self.channel_id}/chat"
+        self.access_codes = []
+        self.lease_sec = 0
+        self.loop = loop
+        self.load = {}
+        self._send = send
+        self._pending = {}
+
+    async def send(self, message):
+        await self._send({"type": "websocket.send", "text": json.dumps(message)})
+
+    async def open_request(self, form, headers, callback):
+        """
+        Dispatch a request. The messages of the request are passed to the callback.
+        """
+        request_id = uuid.uuid4().hex
+        self._pending[request_id] = callback
+        await self.send({"type": "request", "request_id": request_id, "form": form, "headers": headers})
+        return request_id
+
+    async def close_request(self, request_id):
+        if self._pending.pop(request_id, None) is not None:
+            await self.send({"type": "cancel", "request_id": request_id})
+
+    def dispatch(self, message):
+        callback = self._pending.get(message.get("request_id"))
+        if callback is None:
+            return
+        if message["type"] != "chunk":
+            del self._pending[message["request_id"]]
+        callback(message)
+
+    async def stream(self, form, headers):
+        """
+        Yield the chunks of a request. Used in the event loop of the channel.
+        """
+        messages = asyncio.Queue()
+        request_id = await self.open_request(form, headers, messages.put_nowait)
+        try:
+            while True:
+                message = await messages.get()
+                if message["type"] == "chunk":
+                    yield message["data"]
+                elif message["type"] == "error":
+                    raise ChannelClosedError(message.get("message"))
+                else:
+                    return
+        finally:
+            await self.close_request(request_id)
+
+    def stream_sync(self, form, headers, timeout=5000):
+        """
+        Yield the chunks of a request. Used in the threads serving the Flask application.
+        """
+        messages = queue.Queue()
+        request_id = asyncio.run_coroutine_threadsafe(
+            self.open_request(form, headers, messages.put), self.loop
+        ).result(timeout=10)
+        try:
+            while True:
+                message = messages.get(timeout=timeout)
+                if message["type"] == "chunk":
+                    yield message["data"]
+                elif message["type"] == "error":
+                    raise ChannelClosedError(message.get("message"))
+                else:
+                    return
+        finally:
+            asyncio.run_coroutine_threadsafe(self.close_request(request_id), self.loop)
+
+    async def abort(self):
+        await self.send({"type": "abort"})
+        return "aborted"
+
+    def close(self):
+        for callback in self._pending.values():
+            callback({"type": "error", "message": "The channel is closed."})
+        self._pending = {}
+
+class ChannelRegistry:
+    """
+    Accept the channels of the executors on the ASGI server. An executor
+    registered through a channel is recorded with the endpoint
+    "channel://<channel ID>/chat", and unregistered once the channel closes
+    or its lease expires.
+    Arguments:
+        scheduler: The executor scheduler.
+        leases: The LeaseTable renewed by the heartbeats.
+    """
+
+    def __init__(self, scheduler, leases=None):
+        self.scheduler = scheduler
+        self.leases = leases
+        self.channels = {}
+
+    def get(self, endpoint):
+        return self.channels.get(endpoint)
+
+    async def serve(self, scope, receive, send):
+        message = await receive()
+        if message["type"] != "websocket.connect":
+            return
+        await send({"type": "websocket.accept"})
+        channel = ExecutorChannel(send, asyncio.get_running_loop())
+        try:
+            while True:
+                message = await receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                try:
+                    data = json.loads(message.get("text") or message.get("bytes") or "")
+                except json.JSONDecodeError:
+                    logger.warning(f"Received a broken message from {channel.endpoint}")
+                    continue
+                await self.handle(channel, data)
+        finally:
+            self.channels.pop(channel.endpoint, None)
+            await asyncio.to_thread(self.unregister, channel)
+            channel.close()
+
+    async def handle(self, channel, message):
+        # The scheduler and the leases might block on their locks or on the
+        # I/O of a shared state backend, so they are called in threads.
+        message_type = message.get("type")
+        if message_type == "register":
+            channel.access_codes = list(message.get("access_codes", []))
+            channel.lease_sec = float(message.get("lease_sec") or 0)
+            self.channels[channel.endpoint] = channel
+            await asyncio.to_thread(self.register, channel)
+            await channel.send({"type": "registered", "endpoint": channel.endpoint})
+        elif message_type == "heartbeat":
+            channel.load = {
+                k: message[k] for k in ("concurrent_requests", "concurrent_req_limit", "queue_depth")
+                if k in message
+            }
+            await asyncio.to_thread(self.renew, channel)
+        elif message_type in ("chunk", "end", "error"):
+            channel.dispatch(message)
+
+    def register(self, channel):
+        for access_code in channel.access_codes:
+            self.scheduler.register(access_code, channel.endpoint)
+            logger.info(f"A new {access_code} is registered through {channel.endpoint}")
+        self.renew(channel)
+
+    def renew(self, channel):
+        if self.leases is None or channel.lease_sec <= 0:
+            return
+        for access_code in channel.access_codes:
+            if not self.leases.renew(access_code, channel.endpoint, channel.lease_sec, channel.load):
+                # The lease expired while the channel is still open, e.g. a long network stall
+                self.scheduler.register(access_code, channel.endpoint)
+                self.leases.renew(access_code, channel.endpoint, channel.lease_sec, channel.load)
+                logger.info(f"{access_code} is registered again through {channel.endpoint}")
+
+    def unregister(self, channel):
+        for access_code in channel.access_codes:
+            self.scheduler.unregister(access_code, endpoint=channel.endpoint)
+            if self.leases is not None:
+                self.leases.revoke(access_code, channel.endpoint)
+            logger.info(f"{access_code} at {channel.endpoint} is unregistered since the channel closed")
@@ -0,0 +1,139 @@
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class SharedStream:
+    """
+    The chunks of an upstream completion, replayed to every subscriber.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.subscribers = 0
+        self.condition = threading.Condition()
+
+    def append(self, chunk):
+        """
+        Add a chunk. Return False if every subscriber has left.
+        """
+        with self.condition:
+            self.chunks.append(chunk)
+            self.condition.notify_all()
+            return self.subscribers > 0
+
+    def finish(self):
+        with self.condition:
+            self.done = True
+            self.condition.notify_all()
+
+    def replay(self):
+        """
+        Return a Subscription yielding the relayed chunks from the beginning,
+        then the new ones until the stream is done.
+        """
+        return Subscription(self)
+
+    def unsubscribe(self):
+        with self.condition:
+            self.subscribers -= 1
+
+    def _read(self):
+        index = 0
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: index < len(self.chunks) or self.done)
+                chunks = self.chunks[index:]
+                done = self.done
+            index += len(chunks)
+            yield from chunks
+            if done:
+                return
+
+class Subscription:
+    """
+    An iterator over a SharedStream. The subscriber is counted out once it's
+    exhausted or closed, even if it's closed or collected before it starts,
+    which the finally clause of a generator wouldn't catch.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.chunks = stream._read()
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.chunks)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.chunks.close()
+        self.stream.unsubscribe()
+
+    def __del__(self):
+        self.close()
+
+class StreamCoalescer:
+    """
+    Share one upstream stream among the identical completions in flight.
+    A completion is identical to another if the access code, the input and
+    the modelfile are the same. Only the first one is forwarded to the
+    executor, the later ones subscribe to its stream and receive the chunks
+    relayed so far before the new ones.
+    Arguments:
+        enabled: Whether to coalesce the completions. It's disabled by default
+        since the completions might be sampled differently on purpose.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self._inflight = {}
+
+    @staticmethod
+    def digest(form):
+        h = hashlib.sha256()
+        for field in ["name", "input", "modelfile"]:
+            h.update((form.get(field) or "").encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def join(self, key):
+        """
+        Subscribe to the in-flight stream of the key, or create one.
+        Return the stream and whether the caller is the first one, which
+        should fill the stream and call finish() afterward.
+        """
+        with self.lock:
+            stream = self._inflight.get(key)
+            leader = stream is None
+            if leader:
+                stream = SharedStream()
+                self._inflight[key] = stream
+            with stream.condition:
+                stream.subscribers += 1
+            return stream, leader
+
+    def finish(self, key, stream):
+        """
+        Mark the stream as done. Later requests will be forwarded again.
+        """
+        with self.lock:
+            if self._inflight.get(key) is stream:
+                del self._inflight[key]
+        stream.finish()
+
+    def inflight(self):
+        with self.lock:
+            return len(self._inflight)
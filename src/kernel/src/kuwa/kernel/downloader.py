@@ -0,0 +1,211 @@
+import os
+import time
+import queue
+import logging
+import threading
+import requests
+from urllib.parse import urlparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from huggingface_hub import HfApi, hf_hub_url, get_hf_file_metadata, constants
+from huggingface_hub.utils import build_hf_headers
+from huggingface_hub.file_download import repo_folder_name
+
+logger = logging.getLogger(__name__)
+
+class RateLimiter:
+    """
+    A token bucket shared by the download threads to cap the total bandwidth.
+    Arguments:
+        bytes_per_sec: The bandwidth cap. None or 0 for unlimited.
+    """
+
+    def __init__(self, bytes_per_sec=None):
+        self.bytes_per_sec = bytes_per_sec
+        self.lock = threading.Lock()
+        self._allowance = 0
+        self._last = time.monotonic()
+
+    def consume(self, size):
+        if not self.bytes_per_sec:
+            return
+        with self.lock:
+            now = time.monotonic()
+            # Allow bursts of up to one second
+            self._allowance = min(self.bytes_per_sec, self._allowance + (now - self._last) * self.bytes_per_sec)
+            self._last = now
+            self._allowance -= size
+            wait_sec = -self._allowance / self.bytes_per_sec
+        if wait_sec > 0:
+            time.sleep(wait_sec)
+
+class DownloadJob:
+    """
+    Download a model into the Hugging Face cache with parallel file fetches.
+    The files are written to the same "blobs/<etag>.incomplete" files as the
+    huggingface_hub library, so an aborted or crashed download is resumed
+    from where it stopped by either of them.
+    Arguments:
+        model_name: The repository ID of the model.
+        cache_dir: The Hugging Face hub cache directory.
+        max_workers: The number of files fetched concurrently.
+        rate_limiter: The RateLimiter shared by the downloads.
+        revision: The revision to download, defaults to the main branch.
+        token: The Hugging Face token, defaults to the logged-in one.
+        progress_interval_sec: The minimal interval between the progress events.
+    """
+
+    chunk_size = 2 ** 20
+
+    def __init__(self, model_name, cache_dir, max_workers=8, rate_limiter=None, revision=None, token=None, progress_interval_sec=1):
+        self.model_name = model_name
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.revision = revision
+        self.token = token
+        self.progress_interval_sec = progress_interval_sec
+        self.repo_dir = os.path.join(cache_dir, repo_folder_name(repo_id=model_name, repo_type="model"))
+        self.start_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.state = "pending"
+        self.total_bytes = 0
+        self.downloaded_bytes = 0
+        self.events = queue.Queue()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+        self._last_progress = 0
+
+    def start(self, target=None):
+        self.thread = threading.Thread(target=target or self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def emit(self, message):
+        self.events.put(message)
+
+    def to_dict(self):
+        return {
+            "model_name": self.model_name,
+            "start_time": self.start_time,
+            "state": self.state,
+            "downloaded_bytes": self.downloaded_bytes,
+            "total_bytes": self.total_bytes,
+        }
+
+    def run(self):
+        self.state = "downloading"
+        try:
+            commit, files = self.list_files()
+            self.total_bytes = sum(size or 0 for _, size in files)
+            self.emit(f"Downloading {len(files)} files ({self.total_bytes} bytes) of {self.model_name} at revision {commit}")
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                futures = [pool.submit(self.fetch, commit, filename, size) for filename, size in files]
+                for future in as_completed(futures):
+                    if future.exception() is not None:
+                        # Stop the other files
+                        self.stop_event.set()
+                        raise future.exception()
+            if self.stop_event.is_set():
+                self.state = "aborted"
+                self.emit(f"Download stopped at {self.downloaded_bytes}/{self.total_bytes} bytes, the partial files are kept to resume later")
+                return
+            ref_file = os.path.join(self.repo_dir, "refs", self.revision or "main")
+            os.makedirs(os.path.dirname(ref_file), exist_ok=True)
+            with open(ref_file, "w") as f:
+                f.write(commit)
+            self.state = "complete"
+            self.emit(f"Model downloaded and cached at: {self.cache_dir}")
+        except Exception as e:
+            logger.exception(f"Failed to download {self.model_name}")
+            self.state = "failed"
+            self.emit(f"Download failed: {e}")
+        finally:
+            self.events.put(None)
+
+    def list_files(self):
+        """
+        Return the commit hash of the revision and the files with their sizes.
+        """
+        info = HfApi().model_info(self.model_name, revision=self.revision, files_metadata=True, token=self.token)
+        return info.sha, [(s.rfilename, s.size) for s in info.siblings]
+
+    def file_location(self, commit, filename):
+        """
+        Return the URL and the ETag of a file.
+        """
+        metadata = get_hf_file_metadata(hf_hub_url(self.model_name, filename, revision=commit), token=self.token)
+        return metadata.location, metadata.etag
+
+    def fetch(self, commit, filename, size):
+        if self.stop_event.is_set():
+            return
+        pointer = os.path.join(self.repo_dir, "snapshots", commit, filename)
+        if os.path.exists(pointer):
+            self.progress(size or 0)
+            return
+        url, etag = self.file_location(commit, filename)
+        blob = os.path.join(self.repo_dir, "blobs", etag)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        if os.path.exists(blob):
+            self.progress(size or 0)
+        elif not self.fetch_blob(url, blob, size):
+            return
+        os.makedirs(os.path.dirname(pointer), exist_ok=True)
+        try:
+            os.symlink(os.path.relpath(blob, os.path.dirname(pointer)), pointer)
+        except OSError:
+            # Symbolic links are not supported, e.g. on Windows without the developer mode
+            os.replace(blob, pointer)
+        self.emit(f"Downloaded {filename}")
+
+    def fetch_blob(self, url, blob, size=None):
+        """
+        Download a file, resuming the incomplete one. Return False if stopped.
+        Arguments:
+            size: The expected size of the file, if known.
+        """
+        incomplete = f"{blob}.incomplete"
+        resume_size = os.path.getsize(incomplete) if os.path.exists(incomplete) else 0
+        headers = build_hf_headers(token=self.token)
+        if urlparse(url).netloc != urlparse(constants.ENDPOINT).netloc:
+            # Don't leak the token to the CDN
+            headers.pop("authorization", None)
+        if resume_size > 0:
+            headers["Range"] = f"bytes={resume_size}-"
+        with requests.get(url, headers=headers, stream=True, timeout=30) as response:
+            if resume_size > 0 and response.status_code == 416:
+                if resume_size == size:
+                    # Completely downloaded but interrupted before being renamed
+                    self.progress(resume_size)
+                    os.replace(incomplete, blob)
+                    return True
+                logger.warning(f"The incomplete {blob} doesn't match the remote file, downloading it again")
+                os.remove(incomplete)
+                return self.fetch_blob(url, blob, size)
+            response.raise_for_status()
+            if resume_size > 0 and response.status_code != 206:
+                # The server doesn't support resuming
+                resume_size = 0
+            self.progress(resume_size)
+            with open(incomplete, "ab" if resume_size > 0 else "wb") as f:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    if self.stop_event.is_set():
+                        return False
+                    self.rate_limiter.consume(len(chunk))
+                    f.write(chunk)
+                    self.progress(len(chunk))
+        os.replace(incomplete, blob)
+        return True
+
+    def progress(self, size):
+        with self.lock:
+            self.downloaded_bytes += size
+            now = time.monotonic()
+            if now - self._last_progress < self.progress_interval_sec:
+                return
+            self._last_progress = now
+        percentage = self.downloaded_bytes / self.total_bytes * 100 if self.total_bytes else 100
+        self.emit(f"Progress: {self.downloaded_bytes}/{self.total_bytes} bytes ({percentage:.1f}%)")
@@ -3,6 +3,7 @@ from urllib.parse import urlparse
 from flask import make_response
 from json import dumps
 from .variable import *
+from .channel import is_channel_endpoint
 
 logger = logging.getLogger(__name__)
 
@@ -24,9 +25,9 @@ def get_base_url(url):
     return base_url
     
 # Define an asynchronous health check function
-async def async_health_check(url, session):
+async def async_health_check(url, session, timeout=20):
     try:
-        async with session.get(url, timeout=20) as resp:
+        async with session.get(url, timeout=timeout) as resp:
             return resp.status == 204
     except aiohttp.ClientConnectionError:
         return False
@@ -40,30 +41,69 @@ async def check_all_health(endpoints):
         results = await asyncio.gather(*tasks.values())
         return dict(zip(tasks.keys(), results))
 
+async def async_abort(url, session):
+    try:
+        async with session.get(url) as resp:
+            return "aborted" if resp.status == 200 else "failed"
+    except aiohttp.ClientError:
+        return "failed"
+    except asyncio.exceptions.TimeoutError:
+        return "timeout"
+
+async def async_abort_channel(endpoint, timeout):
+    # The channel is served by the event loop of the ASGI server
+    channel = executor_channels.get(endpoint)
+    if channel is None:
+        return "failed"
+    try:
+        future = asyncio.run_coroutine_threadsafe(channel.abort(), channel.loop)
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+    except asyncio.exceptions.TimeoutError:
+        return "timeout"
+    except Exception:
+        return "failed"
+
+# Concurrently aborts the jobs on the endpoints within an overall deadline
+async def abort_all(endpoints, timeout=3):
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        tasks = {
+            endpoint: async_abort_channel(endpoint, timeout) if is_channel_endpoint(endpoint) else async_abort(endpoint + "/abort", session)
+            for endpoint in endpoints
+        }
+        results = await asyncio.gather(*tasks.values())
+        return dict(zip(tasks.keys(), results))
+
 # Refactored load_records function
 def load_records(var, keep_state=False):
     logger.info(f"Loading records, Here's before\n{data}")
     logger.info(f"Here's new records\n{var}")
 
-    # Collect all endpoints to check health
+    # Collect all endpoints to check health. The executors connected through
+    # channels will register again once they reconnect.
+    var = {i: [k for k in o if not is_channel_endpoint(k[0])] for i, o in var.items()}
     endpoints_to_check = [k[0] for i, o in var.items() for k in o]
 
     # Run asynchronous health check for all endpoints
     health_results = asyncio.run(check_all_health(endpoints_to_check))
 
-    for i, o in var.items():
-        data[i] = []
-        for k in o:
-            formatted_endpoint = endpoint_formatter(k[0])
+    with scheduler.lock:
+        for i, o in var.items():
+            # Replace rather than modify the list, since the readers don't hold the lock
+            records = []
+            for k in o:
+                formatted_endpoint = endpoint_formatter(k[0])
 
-            # Check if this endpoint passed the health check
-            if health_results.get(k[0], False):
-                data[i].append(k if keep_state else [formatted_endpoint, "READY", -1, -1])
-            else:
-                logger.info(f"Health check failed for {i} at {k[0]}, removed")
+                # Check if this endpoint passed the health check
+                if health_results.get(k[0], False):
+                    records.append(list(k) if keep_state else [formatted_endpoint, "READY", -1, -1])
+                else:
+                    logger.info(f"Health check failed for {i} at {k[0]}, removed")
 
-        # Remove empty entries
-        if len(data[i]) == 0:
-            del data[i]
+            # Remove empty entries
+            if len(records) == 0:
+                data.pop(i, None)
+            else:
+                data[i] = records
+        scheduler.rebuild()
 
     logger.info(f"Records loaded, Here's After\n{data}")
\ No newline at end of file
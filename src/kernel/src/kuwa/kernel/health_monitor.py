@@ -0,0 +1,189 @@
+import time
+import asyncio
+import logging
+import threading
+import aiohttp
+from .variable import *
+from .functions import async_health_check, get_base_url
+from .routing import parse_histogram
+from .channel import is_channel_endpoint
+from .state import SUSPEND_HEALTH
+
+logger = logging.getLogger(__name__)
+
+class EndpointHealth:
+    """
+    The circuit breaker of an executor endpoint.
+    States:
+        healthy: Passed the probes.
+        degraded: Passed the probes but responded slower than the threshold.
+        open: Failed consecutive probes. The endpoint is suspended from scheduling
+        until it passes consecutive probes again.
+    """
+
+    def __init__(self):
+        self.state = "healthy"
+        self.failures = 0
+        self.successes = 0
+        self.latency_sec = None
+        self.last_probe = None
+        self.opened_at = None
+        self.histogram = None
+
+    def to_dict(self):
+        return {
+            "state": self.state,
+            "latency_sec": self.latency_sec,
+            "consecutive_failures": self.failures,
+            "last_probe": self.last_probe,
+        }
+
+class HealthMonitor:
+    """
+    Probe the /health API of every registered executor periodically and
+    suspend the failing ones from scheduling before a user request hits them.
+    The probe latency is fed to the routing statistics of the scheduler, so
+    the slow executors are avoided. The /metrics API of the healthy executors
+    is scraped as well, and the average time to the first chunk since the
+    last scrape is fed to the routing statistics in place of the probe latency
+    once an executor exposes it.
+    Arguments:
+        scheduler: The executor scheduler.
+        journal: The record journal to persist the removal of endpoints.
+        timeout_sec: The timeout of a single probe.
+        slow_threshold_sec: An endpoint responding slower than this is degraded.
+        failure_threshold: Number of consecutive failed probes to open the circuit.
+        recovery_threshold: Number of consecutive passed probes to close the circuit.
+        remove_after_sec: Unregister an endpoint whose circuit stays open this long.
+        latency_smoothing: The weight of the latest probe in the average latency.
+    """
+
+    def __init__(
+        self,
+        scheduler,
+        journal=None,
+        timeout_sec=5,
+        slow_threshold_sec=1,
+        failure_threshold=3,
+        recovery_threshold=2,
+        remove_after_sec=600,
+        latency_smoothing=0.3,
+    ):
+        self.scheduler = scheduler
+        self.journal = journal
+        self.timeout_sec = timeout_sec
+        self.slow_threshold_sec = slow_threshold_sec
+        self.failure_threshold = failure_threshold
+        self.recovery_threshold = recovery_threshold
+        self.remove_after_sec = remove_after_sec
+        self.latency_smoothing = latency_smoothing
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    # The histogram in the executor metrics representing the latency.
+    # The time to the first chunk doesn't grow with the length of the output.
+    latency_histogram = "executor_framework_time_to_first_chunk_seconds"
+
+    def run_once(self):
+        """
+        Probe all the registered endpoints once. Executed by the background scheduler.
+        """
+        endpoints = self.scheduler.endpoints()
+        results = asyncio.run(self.probe_all(endpoints.keys()))
+        now = time.time()
+        with self.lock:
+            # Forget the unregistered endpoints.
+            for endpoint in set(self.endpoints.keys()) - set(endpoints.keys()):
+                del self.endpoints[endpoint]
+                self.scheduler.stats.forget(endpoint)
+            for endpoint, (healthy, latency, histogram) in results.items():
+                health = self.endpoints.setdefault(endpoint, EndpointHealth())
+                health.last_probe = now
+                if healthy:
+                    self._on_success(endpoint, health, latency)
+                    self._observe_histogram(endpoint, health, histogram)
+                else:
+                    self._on_failure(endpoint, health, endpoints[endpoint], now)
+
+    async def probe_all(self, endpoints):
+        async with aiohttp.ClientSession() as session:
+            tasks = {endpoint: self.probe(endpoint, session) for endpoint in endpoints}
+            results = await asyncio.gather(*tasks.values())
+            return dict(zip(tasks.keys(), results))
+
+    async def probe(self, endpoint, session):
+        if is_channel_endpoint(endpoint):
+            # The executor is alive as long as its channel is open. The
+            # channels held by other kernels sharing the state are left to them.
+            return executor_channels.get(endpoint) is not None or self.scheduler.state.shared, 0.0, None
+        start_time = time.monotonic()
+        healthy = await async_health_check(get_base_url(endpoint) + "/health", session, timeout=self.timeout_sec)
+        latency = time.monotonic() - start_time
+        histogram = await self.scrape(endpoint, session) if healthy else None
+        return healthy, latency, histogram
+
+    async def scrape(self, endpoint, session):
+        try:
+            async with session.get(get_base_url(endpoint) + "/metrics", timeout=self.timeout_sec) as resp:
+                if resp.status != 200:
+                    return None
+                return parse_histogram(await resp.text(), self.latency_histogram)
+        except (aiohttp.ClientError, asyncio.exceptions.TimeoutError):
+            return None
+
+    def _observe_histogram(self, endpoint, health, histogram):
+        if histogram is None:
+            return
+        previous, health.histogram = health.histogram, histogram
+        if previous is None:
+            return
+        total, count = histogram[0] - previous[0], histogram[1] - previous[1]
+        # The count decreases if the executor restarted.
+        if count > 0:
+            self.scheduler.stats.observe_latency(endpoint, total / count)
+
+    def _on_success(self, endpoint, health, latency):
+        health.failures = 0
+        health.successes += 1
+        if health.latency_sec is None:
+            health.latency_sec = latency
+        else:
+            health.latency_sec = (1 - self.latency_smoothing) * health.latency_sec + self.latency_smoothing * latency
+        self.scheduler.stats.observe_probe_latency(endpoint, latency)
+        if health.state == "open":
+            if health.successes < self.recovery_threshold:
+                return
+            health.opened_at = None
+            self.scheduler.resume(endpoint, SUSPEND_HEALTH)
+            logger.info(f"{endpoint} recovered, resumed scheduling")
+        health.state = "degraded" if health.latency_sec > self.slow_threshold_sec else "healthy"
+
+    def _on_failure(self, endpoint, health, access_codes, now):
+        health.successes = 0
+        health.failures += 1
+        if health.state != "open" and health.failures >= self.failure_threshold:
+            health.state = "open"
+            health.opened_at = now
+            self.scheduler.suspend(endpoint, SUSPEND_HEALTH)
+            logger.warning(f"{endpoint} failed {health.failures} health checks, suspended scheduling")
+        elif health.state == "open" and now - health.opened_at >= self.remove_after_sec:
+            for access_code in access_codes:
+                self.scheduler.unregister(access_code, endpoint=endpoint)
+                if self.journal is not None:
+                    self.journal.unregister(access_code, endpoint=endpoint)
+            del self.endpoints[endpoint]
+            logger.warning(f"{endpoint} stayed unhealthy for {self.remove_after_sec} seconds, unregistered")
+
+    def latency(self, endpoint):
+        """
+        The average probe latency of an endpoint in seconds, or None if not probed yet.
+        """
+        with self.lock:
+            health = self.endpoints.get(endpoint)
+            return health.latency_sec if health is not None else None
+
+    def status(self):
+        with self.lock:
+            return {endpoint: health.to_dict() for endpoint, health in self.endpoints.items()}
+
+health_monitor = HealthMonitor(scheduler, journal=record_journal)
@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+def folder_size(path):
+    """
+    The total size of the regular files under a directory. The symbolic
+    links in the snapshots are not counted twice.
+    """
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            file_path = os.path.join(root, name)
+            if not os.path.islink(file_path):
+                total += os.path.getsize(file_path)
+    return total
+
+class ModelInventory:
+    """
+    The models in the Hugging Face cache kept in memory, so that listing
+    them doesn't rescan the cache directory. The inventory is updated when a
+    model is downloaded or removed, and rescanned periodically for the
+    changes made outside the kernel.
+    Arguments:
+        cache_dir: The Hugging Face hub cache directory.
+        usage_file: The JSON file persisting the last-used time of the models.
+    """
+
+    def __init__(self, cache_dir, usage_file=None):
+        self.cache_dir = cache_dir
+        self.usage_file = usage_file
+        self.lock = threading.Lock()
+        self.models = {}
+        self.scanned = False
+        self._last_used = self._load_usage()
+
+    def _load_usage(self):
+        if not self.usage_file or not os.path.exists(self.usage_file):
+            return {}
+        try:
+            with open(self.usage_file, "r") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"Failed to load the model usage: {e}")
+            return {}
+
+    def _save_usage(self):
+        if not self.usage_file:
+            return
+        tmp_file = f"{self.usage_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self._last_used, f)
+        os.replace(tmp_file, self.usage_file)
+
+    def _inspect(self, folder_name):
+        path = os.path.join(self.cache_dir, folder_name)
+        revision = None
+        ref_file = os.path.join(path, "refs", "main")
+        if os.path.exists(ref_file):
+            with open(ref_file, "r") as f:
+                revision = f.read().strip()
+        last_modified = os.path.getmtime(path)
+        return {
+            "name": folder_name,
+            "size_bytes": folder_size(path),
+            "revision": revision,
+            "last_modified": last_modified,
+            "last_used": self._last_used.get(folder_name, last_modified),
+        }
+
+    def scan(self):
+        """
+        Rescan the whole cache directory. Executed by the background scheduler.
+        """
+        folders = [
+            d for d in os.listdir(self.cache_dir)
+            if os.path.isdir(os.path.join(self.cache_dir, d)) and not d.startswith('.')
+        ] if os.path.exists(self.cache_dir) else []
+        models = {}
+        for folder_name in folders:
+            try:
+                models[folder_name] = self._inspect(folder_name)
+            except OSError as e:
+                # Removed during scanning
+                logger.debug(f"Failed to inspect {folder_name}: {e}")
+        with self.lock:
+            self.models = models
+            self.scanned = True
+
+    def refresh(self, folder_name):
+        """
+        Update a single model after it's downloaded.
+        """
+        if not os.path.isdir(os.path.join(self.cache_dir, folder_name)):
+            return self.forget(folder_name)
+        model = self._inspect(folder_name)
+        with self.lock:
+            self.models[folder_name] = model
+
+    def forget(self, folder_name):
+        with self.lock:
+            self.models.pop(folder_name, None)
+            if self._last_used.pop(folder_name, None) is not None:
+                self._save_usage()
+
+    def touch(self, folder_name):
+        """
+        Record that a model is used now.
+        """
+        now = time.time()
+        with self.lock:
+            self._last_used[folder_name] = now
+            if folder_name in self.models:
+                self.models[folder_name]["last_used"] = now
+            self._save_usage()
+
+    def list(self):
+        if not self.scanned:
+            self.scan()
+        with self.lock:
+            return [dict(m) for m in sorted(self.models.values(), key=lambda m: m["name"])]
+
+    def prune(self, max_bytes, keep=(), dry_run=False):
+        """
+        Remove the least recently used models until the total size is under max_bytes.
+        Arguments:
+            max_bytes: The target total size of the cached models.
+            keep: The models which shouldn't be removed, e.g. the ones in use.
+            dry_run: Only return the models to be removed.
+        Return:
+            The removed models.
+        """
+        models = self.list()
+        total = sum(m["size_bytes"] for m in models)
+        removed = []
+        for model in sorted(models, key=lambda m: m["last_used"]):
+            if total <= max_bytes:
+                break
+            if model["name"] in keep:
+                continue
+            if not dry_run:
+                shutil.rmtree(os.path.join(self.cache_dir, model["name"]), ignore_errors=True)
+                shutil.rmtree(os.path.join(self.cache_dir, ".locks", model["name"]), ignore_errors=True)
+                self.forget(model["name"])
+                logger.info(f"Pruned {model['name']} of {model['size_bytes']} bytes")
+            total -= model["size_bytes"]
+            removed.append(model)
+        return removed
@@ -0,0 +1,134 @@
+import os
+import json
+import gzip
+import pickle
+import logging
+import threading
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+class RecordJournal:
+    """
+    Persist the executor records as a snapshot plus an append-only journal.
+    Registering or unregistering an executor appends one line to the journal
+    instead of rewriting the whole record file, and compact() folds the
+    journal into a new snapshot periodically.
+    Arguments:
+        snapshot_file: The gzip-pickled records, compatible with save_variable_to_file().
+        journal_file: The journal of events, one JSON object per line.
+    """
+
+    def __init__(self, snapshot_file, journal_file):
+        self.snapshot_file = snapshot_file
+        self.journal_file = journal_file
+        self.rotated_journal_file = f"{journal_file}.old"
+        self.lock = threading.Lock()
+        self.compaction_lock = threading.Lock()
+        self.pending_events = 0
+        self._file = None
+
+    def register(self, name, endpoint):
+        self._append({"op": "register", "name": name, "endpoint": endpoint})
+
+    def unregister(self, name, base_url=None, endpoint=None):
+        self._append({"op": "unregister", "name": name, "base_url": base_url, "endpoint": endpoint})
+
+    def _append(self, event):
+        line = json.dumps(event) + "\n"
+        with self.lock:
+            if self._file is None:
+                self._file = open(self.journal_file, "a", encoding="utf-8")
+            self._file.write(line)
+            self._file.flush()
+            self.pending_events += 1
+
+    def load(self):
+        """
+        Read the snapshot and replay the journal on it.
+        """
+        records = {}
+        if os.path.exists(self.snapshot_file):
+            with gzip.open(self.snapshot_file, "rb") as file:
+                records = pickle.load(file)
+        replayed = 0
+        for journal_file in [self.rotated_journal_file, self.journal_file]:
+            if not os.path.exists(journal_file):
+                continue
+            with open(journal_file, "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        event = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line might be incomplete if the kernel crashed during writing.
+                        logger.warning(f"Skipped a broken journal entry: {line!r}")
+                        continue
+                    self.apply(records, event)
+                    replayed += 1
+        logger.info(f"Replayed {replayed} journal entries")
+        return records
+
+    @staticmethod
+    def apply(records, event):
+        name = event["name"]
+        if event["op"] == "register":
+            group = records.setdefault(name, [])
+            if event["endpoint"] not in [r[0] for r in group]:
+                group.append([event["endpoint"], "READY", -1, -1])
+        elif event["op"] == "unregister" and name in records:
+            def matched(record):
+                if event.get("endpoint") is not None:
+                    return record[0] == event["endpoint"]
+                parsed_url = urlparse(record[0])
+                return f"{parsed_url.scheme}://{parsed_url.netloc}" == event["base_url"]
+            records[name] = [r for r in records[name] if not matched(r)]
+            if records[name] == []:
+                del records[name]
+
+    def compact(self, records, lock=None):
+        """
+        Write the records as the new snapshot and discard the journal.
+        Arguments:
+            records: The current records.
+            lock: The lock protecting the records. It's only held while copying
+            the records and rotating the journal, the snapshot is written after
+            releasing it.
+        """
+        with self.compaction_lock:
+            self._compact(records, lock)
+
+    def _compact(self, records, lock):
+        with lock or threading.Lock():
+            snapshot = {name: [list(r) for r in group] for name, group in records.items()}
+            with self.lock:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                # Keep the events until the snapshot is written. A rotated
+                # journal left by an interrupted compaction is extended.
+                if os.path.exists(self.journal_file) and os.path.exists(self.rotated_journal_file):
+                    with open(self.journal_file, "r", encoding="utf-8") as src, \
+                         open(self.rotated_journal_file, "a", encoding="utf-8") as dst:
+                        dst.write(src.read())
+                    os.remove(self.journal_file)
+                elif os.path.exists(self.journal_file):
+                    os.replace(self.journal_file, self.rotated_journal_file)
+                self.pending_events = 0
+
+        tmp_file = f"{self.snapshot_file}.tmp"
+        with gzip.open(tmp_file, "wb") as file:
+            pickle.dump(snapshot, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self.snapshot_file)
+        if os.path.exists(self.rotated_journal_file):
+            os.remove(self.rotated_journal_file)
+        logger.info(f"Records compacted, {sum(len(g) for g in snapshot.values())} executors saved")
+
+    def compact_if_needed(self, records, lock=None):
+        if self.pending_events > 0:
+            self.compact(records, lock)
+
+    def close(self):
+        with self.lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,209 @@
+import os
+import time
+import uuid
+import logging
+import threading
+import subprocess
+from collections import deque
+from .state import SUSPEND_WARM
+
+logger = logging.getLogger(__name__)
+
+class LaunchJob:
+    """
+    An executor process started by the kernel.
+    States:
+        starting: The process is loading the model.
+        ready: The executor registered itself and is serving.
+        warm: The executor registered itself but is held in the warm pool.
+        exited: The process exited.
+    """
+
+    def __init__(self, access_code, command, warm=False):
+        self.job_id = uuid.uuid4().hex
+        self.access_code = access_code
+        self.command = command
+        self.warm = warm
+        self.state = "starting"
+        self.endpoint = None
+        self.process = None
+        self.returncode = None
+        self.started_at = time.time()
+        self.startup_time_sec = None
+        self.output = deque(maxlen=50)
+
+    def launched(self, pid):
+        """
+        Whether the process of the PID is the launched one or its descendant,
+        which is in the process group of the launched one, e.g. started by a
+        wrapper script.
+        """
+        if self.process is None or pid is None:
+            return False
+        if self.process.pid == pid:
+            return True
+        try:
+            return os.getpgid(pid) == self.process.pid
+        except (AttributeError, OSError):
+            return False
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "access_code": self.access_code,
+            "state": self.state,
+            "pid": self.process.pid if self.process else None,
+            "endpoint": self.endpoint,
+            "started_at": self.started_at,
+            "startup_time_sec": self.startup_time_sec,
+            "returncode": self.returncode,
+            "output": list(self.output),
+        }
+
+class ExecutorLauncher:
+    """
+    Start executor processes without waiting for them, and track them until
+    they register to the kernel. Optionally keep a pool of pre-loaded
+    executors per access code, which are registered but suspended from
+    scheduling, so that starting another executor only takes resuming one.
+    The registering executors are matched to the jobs by the PID they report.
+    Arguments:
+        scheduler: The executor scheduler.
+        popen: The function to spawn the processes.
+        max_exited_jobs: The number of exited jobs kept for inspection.
+    """
+
+    def __init__(self, scheduler, popen=subprocess.Popen, max_exited_jobs=100):
+        self.scheduler = scheduler
+        self.popen = popen
+        self.max_exited_jobs = max_exited_jobs
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.warm_pool_size = {}
+        self._commands = {}
+
+    def start(self, access_code, command, use_warm_pool=True):
+        """
+        Start an executor. A warm executor of the access code is taken if available.
+        Return the job.
+        """
+        with self.lock:
+            job = self._take_warm(access_code) if use_warm_pool else None
+            if job is not None:
+                # Under the lock so that it won't interleave with the registration
+                self.scheduler.resume(job.endpoint, SUSPEND_WARM)
+        if job is not None:
+            logger.info(f"Took the warm executor {job.endpoint} of {access_code}")
+            self._fill_warm_pool(access_code)
+            return job
+        return self._spawn(access_code, command)
+
+    def set_warm_pool(self, access_code, command, size):
+        """
+        Keep the given number of warm executors of an access code.
+        """
+        with self.lock:
+            self.warm_pool_size[access_code] = size
+            self._commands[access_code] = command
+        self._fill_warm_pool(access_code)
+
+    def stop(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        if job.process is not None and job.returncode is None:
+            job.process.terminate()
+        return job
+
+    def register(self, access_code, endpoint, pid=None):
+        """
+        Register an executor to the scheduler. If it's started by a job, the
+        job is marked as ready, and a warm one is registered suspended in the
+        same step so that no job is dispatched to it.
+        Arguments:
+            pid: The PID reported by the executor.
+        Return:
+            False if the endpoint is already registered.
+        """
+        with self.lock:
+            job = self._find_job(access_code, endpoint, pid)
+            warm = job is not None and job.warm
+            if not self.scheduler.register(access_code, endpoint, suspend_reason=SUSPEND_WARM if warm else None):
+                return False
+            if job is None or job.state != "starting":
+                # Not launched by the kernel, or registered again, e.g. after the lease expired
+                return True
+            job.endpoint = endpoint
+            job.startup_time_sec = time.time() - job.started_at
+            job.state = "warm" if warm else "ready"
+        logger.info(f"Executor of {access_code} registered at {endpoint} after {job.startup_time_sec:.1f} seconds")
+        return True
+
+    def list(self):
+        with self.lock:
+            return [job.to_dict() for job in self.jobs.values()]
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def _spawn(self, access_code, command, warm=False):
+        job = LaunchJob(access_code, command, warm=warm)
+        job.process = self.popen(
+            command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, start_new_session=True
+        )
+        with self.lock:
+            self.jobs[job.job_id] = job
+        threading.Thread(target=self._watch, args=(job,), daemon=True).start()
+        logger.info(f"Started {'a warm' if warm else 'an'} executor of {access_code} with PID {job.process.pid}")
+        return job
+
+    def _watch(self, job):
+        # Drain the output so that the process won't block on a full pipe
+        for line in iter(job.process.stdout.readline, ""):
+            job.output.append(line.rstrip())
+        job.returncode = job.process.wait()
+        with self.lock:
+            was_warm = job.state == "warm"
+            job.state = "exited"
+            exited = [j for j in self.jobs.values() if j.state == "exited"]
+            for j in sorted(exited, key=lambda j: j.started_at)[:-self.max_exited_jobs or None]:
+                del self.jobs[j.job_id]
+        if was_warm:
+            self._fill_warm_pool(job.access_code)
+        logger.info(f"Executor of {job.access_code} with PID {job.process.pid} exited with {job.returncode}")
+
+    def _find_job(self, access_code, endpoint, pid):
+        for job in self.jobs.values():
+            if job.access_code != access_code or job.state == "exited":
+                continue
+            if job.endpoint == endpoint or (job.state == "starting" and job.launched(pid)):
+                return job
+        return None
+
+    def _take_warm(self, access_code):
+        for job in self.jobs.values():
+            if job.access_code == access_code and job.state == "warm":
+                job.state = "ready"
+                job.warm = False
+                return job
+        return None
+
+    def _fill_warm_pool(self, access_code):
+        with self.lock:
+            pooled = sum(
+                1 for j in self.jobs.values()
+                if j.access_code == access_code and j.warm and j.state in ("starting", "warm")
+            )
+            missing = self.warm_pool_size.get(access_code, 0) - pooled
+            command = self._commands.get(access_code)
+            # Stop the surplus ones, the registered ones first since the others are still loading
+            surplus = sorted(
+                (j for j in self.jobs.values() if j.access_code == access_code and j.warm and j.state in ("starting", "warm")),
+                key=lambda j: j.state != "warm",
+            )[:max(-missing, 0)]
+        for job in surplus:
+            job.process.terminate()
+        for _ in range(max(missing, 0)):
+            self._spawn(access_code, command, warm=True)
@@ -0,0 +1,100 @@
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class Lease:
+    def __init__(self, access_code, endpoint, ttl_sec):
+        self.access_code = access_code
+        self.endpoint = endpoint
+        self.ttl_sec = ttl_sec
+        self.expires_at = time.time() + ttl_sec
+        self.load = {}
+
+    def to_dict(self):
+        return {
+            "access_code": self.access_code,
+            "endpoint": self.endpoint,
+            "ttl_sec": self.ttl_sec,
+            "expires_in_sec": max(self.expires_at - time.time(), 0),
+            "load": self.load,
+        }
+
+class LeaseTable:
+    """
+    The registrations of the executors held as leases. An executor renews
+    its lease with heartbeats, and the registration is removed once the
+    lease expires, e.g. the executor was killed or its host is down.
+    The registrations without a lease are kept until unregistered.
+    The expiration times are kept in the state backend of the scheduler, so
+    the heartbeats received by any of the kernels sharing the state renew
+    the lease. The reported load is kept by the kernel receiving it.
+    Arguments:
+        scheduler: The executor scheduler.
+        journal: The record journal to persist the removal of the expired executors.
+        metrics: The KernelMetrics to count the expired leases.
+    """
+
+    def __init__(self, scheduler, journal=None, metrics=None):
+        self.scheduler = scheduler
+        self.journal = journal
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.leases = {}
+
+    def renew(self, access_code, endpoint, ttl_sec, load=None):
+        """
+        Grant or renew the lease of a registered executor.
+        Return False if the executor isn't registered, so it should register again.
+        """
+        key = (access_code, endpoint)
+        with self.lock:
+            if not self.scheduler.is_registered(access_code, endpoint):
+                self.leases.pop(key, None)
+                with self.scheduler.lock:
+                    self.scheduler.state.revoke_lease(access_code, endpoint)
+                return False
+            lease = self.leases.get(key)
+            if lease is None:
+                lease = self.leases[key] = Lease(access_code, endpoint, ttl_sec)
+            lease.ttl_sec = ttl_sec
+            lease.expires_at = time.time() + ttl_sec
+            if load is not None:
+                lease.load = load
+            with self.scheduler.lock:
+                self.scheduler.state.renew_lease(access_code, endpoint, lease.expires_at)
+            return True
+
+    def revoke(self, access_code, endpoint):
+        with self.lock:
+            self.leases.pop((access_code, endpoint), None)
+            with self.scheduler.lock:
+                self.scheduler.state.revoke_lease(access_code, endpoint)
+
+    def expire(self, now=None):
+        """
+        Unregister the executors whose lease expired. Executed by the background scheduler.
+        Return the expired leases.
+        """
+        now = now or time.time()
+        with self.scheduler.lock:
+            expired_keys = self.scheduler.state.expire_leases(now)
+        with self.lock:
+            expired = [self.leases.pop(k, None) or Lease(*k, 0) for k in expired_keys]
+            # Drop the local copies of the leases renewed through the other kernels
+            for k in [k for k, l in self.leases.items() if l.expires_at <= now]:
+                del self.leases[k]
+        for lease in expired:
+            if not self.scheduler.unregister(lease.access_code, endpoint=lease.endpoint):
+                continue
+            if self.journal is not None:
+                self.journal.unregister(lease.access_code, endpoint=lease.endpoint)
+            if self.metrics is not None:
+                self.metrics.lease_expired.labels(lease.access_code).inc()
+            logger.warning(f"The lease of {lease.access_code} at {lease.endpoint} expired, unregistered")
+        return expired
+
+    def list(self):
+        with self.lock:
+            return [lease.to_dict() for lease in self.leases.values()]
@@ -1,20 +1,27 @@
 # -#- coding: UTF-8 -*-
-import time, re, os, click, requests, sys
+import time, re, os, click, requests, sys, uvicorn
 import logging.config
 import argparse
 from datetime import datetime
-from flask import Flask
+import prometheus_client
+from flask import Flask, Response
 from flask_sse import ServerSentEventsBlueprint
 from apscheduler.schedulers.background import BackgroundScheduler
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from . import variable
 from .variable import *
-from .functions import load_records, load_variable_from_file, save_variable_to_file
+from .functions import load_records
 from .logger import KernelLoggerFactory
-from .safety_middleware import update_safety_guard
+from .safety_middleware import update_safety_guard, prewarm_safety_guards
+from .health_monitor import health_monitor
+from .routing import ROUTING_POLICIES
+from .response_cache import HttpEmbedder
+from .state import create_state_backend
 from .routes.executor import executor
 from .routes.model import model
 from .routes.chat import chat
+from .async_proxy import AsyncCompletionsProxy
 
 logger = logging.getLogger(__name__)
 
@@ -22,50 +29,132 @@ KUWA_KERNEL_API_VERSION="v1.0"
 MEGABYTE = (2 ** 20)
 MAX_PART_SIZE = 512 * MEGABYTE
 
+def create_app():
+    # Init Flask Apps
+    app = Flask(__name__)
+    app.config["REDIS_URL"] = "redis://localhost:6379/0"
+    app.config['MAX_CONTENT_LENGTH'] = None
+    app.config['MAX_FORM_MEMORY_SIZE'] = MAX_PART_SIZE
+    sse = ServerSentEventsBlueprint('sse', __name__)
+    app.register_blueprint(sse, url_prefix='/')
+    app.register_blueprint(executor, url_prefix=f'/{KUWA_KERNEL_API_VERSION}/worker')
+    app.register_blueprint(chat, url_prefix=f'/{KUWA_KERNEL_API_VERSION}/chat')
+    app.register_blueprint(model, url_prefix=f'/{KUWA_KERNEL_API_VERSION}/model')
+
+    @app.route("/metrics")
+    def metrics():
+        return Response(prometheus_client.generate_latest(), mimetype=prometheus_client.CONTENT_TYPE_LATEST)
+
+    return app
+
 def main():
     parser = argparse.ArgumentParser(prog='Kuwa Kernel', description='Kuwa Kernel')
     parser.add_argument('--log_level', type=str, default="INFO", help="Log level")
     parser.add_argument('--port', type=int, default=9000, help="The port to serve")
     parser.add_argument('--host', type=str, default="0.0.0.0", help="The host IP address to serve")
+    parser.add_argument('--max_queue_wait_sec', type=float, default=0, help="How long a schedule request waits for an executor before BUSY is returned. 0 to return BUSY immediately. A waiting request occupies a server thread")
+    parser.add_argument('--max_queue_size', type=int, default=64, help="The maximum number of waiting schedule requests per access code")
+    parser.add_argument('--fair_queue', action='store_true', help="Serve the waiting schedule requests in round-robin among users")
+    parser.add_argument('--routing_policy', type=str, default="fifo", choices=ROUTING_POLICIES.keys(), help="How to choose among the idle executors of an access code")
+    parser.add_argument('--affinity_table_size', type=int, default=10000, help="The number of sessions whose last executor is remembered, 0 to disable the session affinity")
+    parser.add_argument('--coalesce_requests', action='store_true', help="Serve the identical completions in flight with a single executor")
+    parser.add_argument('--response_cache_ttl', type=str, nargs='*', default=[], metavar="ACCESS_CODE=SECONDS", help="Cache the responses of the deterministic bots for the TTL. Use * as the access code for every bot")
+    parser.add_argument('--response_cache_max_mb', type=float, default=256, help="The maximum size of the cached responses")
+    parser.add_argument('--response_cache_embedder', type=str, default=None, help="The URL of an OpenAI-compatible embeddings API, e.g. http://localhost:8080/v1/embeddings, to reuse the responses of similar chat histories")
+    parser.add_argument('--response_cache_embedder_model', type=str, default=None, help="The model name passed to the embeddings API")
+    parser.add_argument('--response_cache_similarity', type=float, default=0.95, help="The minimal cosine similarity of the chat histories to reuse a response")
+    parser.add_argument('--download_max_workers', type=int, default=8, help="The number of files of a model downloaded concurrently")
+    parser.add_argument('--download_max_mb_per_sec', type=float, default=0, help="The bandwidth cap shared by the model downloads, 0 for unlimited")
+    parser.add_argument('--state_backend', type=str, default="memory", help="Where the executor records are kept, \"memory\" or the URL of a Redis server (redis://host:port/db) shared by several kernels")
+    parser.add_argument('--safety_guard_pool_size', type=int, default=8, help="The number of Safety Guard instances initialized in advance and kept for reuse")
+    parser.add_argument('--safety_guard_check_mode', type=str, default="inline", choices=["inline", "windowed"], help="Check the streamed output chunk by chunk, or read the output in background and check the chunks arrived meanwhile as a window")
+    parser.add_argument('--asgi', action='store_true', help="Serve with asyncio and relay the chat completions through pooled connections. Required by the executors connecting through --kernel_channel")
+    parser.add_argument('--pool_size_per_endpoint', type=int, default=100, help="The maximum number of connections kept to an executor in ASGI mode")
+    parser.add_argument('--wsgi_workers', type=int, default=256, help="The number of threads serving the routes other than the relayed completions in ASGI mode. The waiting schedule requests occupy a thread each")
     args = parser.parse_args()
     logging.config.dictConfig(KernelLoggerFactory(level=args.log_level).get_config())
+    scheduler.max_wait_sec = args.max_queue_wait_sec
+    scheduler.max_queue_size = args.max_queue_size
+    scheduler.fair_queue = args.fair_queue
+    scheduler.routing_policy = ROUTING_POLICIES[args.routing_policy]()
+    scheduler.affinity_table_size = args.affinity_table_size
+    completion_coalescer.enabled = args.coalesce_requests
+    response_cache.ttl_sec = {k: float(v) for k, v in (i.rsplit("=", 1) for i in args.response_cache_ttl)}
+    response_cache.max_bytes = int(args.response_cache_max_mb * MEGABYTE)
+    if args.response_cache_embedder:
+        response_cache.embedder = HttpEmbedder(args.response_cache_embedder, args.response_cache_embedder_model)
+    response_cache.similarity_threshold = args.response_cache_similarity
+    download_rate_limiter.bytes_per_sec = args.download_max_mb_per_sec * MEGABYTE
+    variable.download_max_workers = args.download_max_workers
+    variable.safety_guard_check_mode = args.safety_guard_check_mode
     
-    # Load savefile
-    if os.path.exists(record_file):
-        load_records(load_variable_from_file(record_file))
+    if args.state_backend != "memory":
+        scheduler.set_state(create_state_backend(args.state_backend, data))
+        logger.info(f"Executor records are shared through {args.state_backend}")
+    else:
+        # Load savefile
+        load_records(record_journal.load())
+    record_journal.compact(data, scheduler.lock)
 
     # Schedule background job to update the Safety Guard
     logging.getLogger('apscheduler.executors.default').setLevel(logging.WARNING)
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(
+    background_scheduler = BackgroundScheduler()
+    background_scheduler.add_job(
         func=update_safety_guard,
         trigger="interval",
         seconds=safety_guard_update_interval_sec,
         next_run_time=datetime.now()
     )
-    scheduler.start()
+    background_scheduler.add_job(
+        func=prewarm_safety_guards,
+        args=(args.safety_guard_pool_size,),
+        next_run_time=datetime.now()
+    )
+    background_scheduler.add_job(
+        func=health_monitor.run_once,
+        trigger="interval",
+        seconds=health_check_interval_sec,
+        jitter=health_check_interval_sec / 5
+    )
+    background_scheduler.add_job(
+        func=record_journal.compact_if_needed,
+        args=(data, scheduler.lock),
+        trigger="interval",
+        seconds=record_compaction_interval_sec
+    )
+    background_scheduler.add_job(
+        func=executor_leases.expire,
+        trigger="interval",
+        seconds=lease_check_interval_sec
+    )
+    background_scheduler.add_job(
+        func=model_inventory.scan,
+        trigger="interval",
+        seconds=model_inventory_scan_interval_sec,
+        next_run_time=datetime.now()
+    )
+    background_scheduler.start()
 
-    # Init Flask Apps
-    app = Flask(__name__)
-    app.config["REDIS_URL"] = "redis://localhost:6379/0"
-    app.config['MAX_CONTENT_LENGTH'] = None
-    app.config['MAX_FORM_MEMORY_SIZE'] = MAX_PART_SIZE
-    sse = ServerSentEventsBlueprint('sse', __name__)
-    app.register_blueprint(sse, url_prefix='/')
-    app.register_blueprint(executor, url_prefix=f'/{KUWA_KERNEL_API_VERSION}/worker')
-    app.register_blueprint(chat, url_prefix=f'/{KUWA_KERNEL_API_VERSION}/chat')
-    app.register_blueprint(model, url_prefix=f'/{KUWA_KERNEL_API_VERSION}/model')
+    app = create_app()
     logger.info("Route list:\n{}\n".format('\n'.join([str(i) for i in app.url_map.iter_rules()])))
     logger.info("Server started")
-    app.run(port=args.port, host=args.host, threaded=True)
-    for model_name in list(download_jobs.keys()):
-        job_details = download_jobs[model_name]
-        job_details['stop_event'].set()
-        if job_details['process']:
-            job_details['process'].terminate()
-        job_details['thread'].join()
+    if args.asgi:
+        asgi_app = AsyncCompletionsProxy(
+            app,
+            completions_path=f'/{KUWA_KERNEL_API_VERSION}/chat/completions',
+            pool_size_per_endpoint=args.pool_size_per_endpoint,
+            wsgi_workers=args.wsgi_workers,
+            channel_path=f'/{KUWA_KERNEL_API_VERSION}/worker/channel'
+        )
+        uvicorn.run(asgi_app, port=args.port, host=args.host, log_config=KernelLoggerFactory(level=args.log_level).get_config())
+    else:
+        app.run(port=args.port, host=args.host, threaded=True)
+    for job in list(download_jobs.values()):
+        job.stop()
+        job.thread.join()
     #Stopped, saving to file
-    save_variable_to_file(record_file, data)
+    record_journal.compact(data, scheduler.lock)
+    record_journal.close()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,144 @@
+import prometheus_client
+from prometheus_client.core import GaugeMetricFamily
+
+# The label of the access codes without registered executors
+UNKNOWN_ACCESS_CODE = "unknown"
+
+
+class AccessCodeLabels:
+    """
+    Wrap a metric labeled by the access code first, replacing the access codes
+    not registered with UNKNOWN_ACCESS_CODE. The access codes come from the
+    requests, so they would otherwise grow the series without bound.
+    """
+
+    def __init__(self, metric, is_registered):
+        self.metric = metric
+        self.is_registered = is_registered
+
+    def labels(self, access_code, *labelvalues):
+        if not self.is_registered(access_code):
+            access_code = UNKNOWN_ACCESS_CODE
+        return self.metric.labels(access_code, *labelvalues)
+
+
+class KernelMetrics:
+    """
+    The Prometheus metrics of the scheduling and the completions proxy,
+    labeled by the access code.
+    Arguments:
+        registry: The Prometheus registry of the metrics.
+        is_registered: Whether an access code has registered executors. The
+            other access codes are labeled as UNKNOWN_ACCESS_CODE. None to
+            label all the access codes as they are.
+    """
+
+    name_space = "kuwa"
+    subsystem = "kernel"
+
+    metrics_template = {
+        "schedule": {
+            "type": "Counter",
+            "description": "Number of schedule requests by result, which is READY, BUSY or NOMACHINE.",
+            "labelnames": ("access_code", "result"),
+        },
+        "schedule_wait_seconds": {
+            "type": "Histogram",
+            "description": "Time a schedule request waited for an executor with unit: Seconds.",
+            "buckets": [0.001, 0.01, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf")],
+        },
+        "proxy_time_to_first_byte_seconds": {
+            "type": "Histogram",
+            "description": "Time from forwarding a completion to receiving its first byte with unit: Seconds.",
+            "buckets": [0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, float("inf")],
+        },
+        "proxy_stream_duration_seconds": {
+            "type": "Histogram",
+            "description": "Time to relay a whole completion stream with unit: Seconds.",
+            "buckets": [0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0, 600.0, float("inf")],
+        },
+        "proxy_relayed_bytes": {
+            "type": "Counter",
+            "description": "Number of bytes relayed from the executors.",
+        },
+        "proxy_coalesced": {
+            "type": "Counter",
+            "description": "Number of completions served by the stream of an identical completion in flight.",
+        },
+        "response_cache_lookups": {
+            "type": "Counter",
+            "description": "Number of response cache lookups by result, which is hit or miss.",
+            "labelnames": ("access_code", "result"),
+        },
+        "proxy_failed": {
+            "type": "Counter",
+            "description": "Number of completions failed to be forwarded or relayed.",
+        },
+        "safety_guard_prefilter_seconds": {
+            "type": "Histogram",
+            "description": "Time the Safety Guard took to check a request before forwarding it with unit: Seconds.",
+            "buckets": [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float("inf")],
+        },
+        "safety_guard_added_latency_seconds": {
+            "type": "Histogram",
+            "description": "Time the first chunk of a completion was held back by the Safety Guard with unit: Seconds.",
+            "buckets": [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float("inf")],
+        },
+        "lease_expired": {
+            "type": "Counter",
+            "description": "Number of executors unregistered since their lease expired.",
+            # Counted right after the executor is unregistered
+            "bounded": False,
+        },
+    }
+
+    def __init__(self, registry=prometheus_client.REGISTRY, is_registered=None):
+        for name, spec in self.metrics_template.items():
+            spec = dict(spec)
+            type_class = getattr(prometheus_client, spec.pop("type"))
+            description = spec.pop("description", "")
+            labelnames = spec.pop("labelnames", ("access_code",))
+            bounded = spec.pop("bounded", True)
+            metric = type_class(
+                namespace=self.name_space,
+                subsystem=self.subsystem,
+                name=name,
+                labelnames=labelnames,
+                documentation=description,
+                registry=registry,
+                **spec,
+            )
+            if bounded and is_registered is not None:
+                metric = AccessCodeLabels(metric, is_registered)
+            setattr(self, name, metric)
+
+    def observe_schedule(self, access_code, result, wait_sec):
+        self.schedule.labels(access_code, result).inc()
+        self.schedule_wait_seconds.labels(access_code).observe(wait_sec)
+
+
+class SchedulerCollector:
+    """
+    Report the executor slots and the wait queues of the scheduler at scrape time.
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    def collect(self):
+        executors = GaugeMetricFamily(
+            "kuwa_kernel_executors",
+            "Number of registered executors by state, which is idle, reserved, busy or suspended.",
+            labels=["access_code", "state"],
+        )
+        waiting = GaugeMetricFamily(
+            "kuwa_kernel_queue_length",
+            "Number of schedule requests waiting for an executor.",
+            labels=["access_code"],
+        )
+        for access_code, counts in self.scheduler.slots().items():
+            for state in ["idle", "reserved", "busy", "suspended"]:
+                executors.add_metric([access_code, state], counts[state])
+            waiting.add_metric([access_code], counts["waiting"])
+        yield executors
+        yield waiting
@@ -0,0 +1,230 @@
+import json
+import math
+import time
+import hashlib
+import logging
+import threading
+import itertools
+import requests
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+def normalize_history(input):
+    """
+    Reduce the chat history to the fields affecting the response, with the
+    whitespaces in the messages collapsed.
+    """
+    try:
+        history = json.loads(input)
+        return json.dumps(
+            [[bool(r.get("isbot")), " ".join(str(r.get("msg", "")).split())] for r in history],
+            ensure_ascii=False,
+        )
+    except (json.JSONDecodeError, TypeError, AttributeError):
+        return " ".join(str(input).split())
+
+def normalize_modelfile(modelfile):
+    try:
+        return json.dumps(json.loads(modelfile), sort_keys=True, ensure_ascii=False)
+    except (json.JSONDecodeError, TypeError):
+        return modelfile or ""
+
+def completed(chunks):
+    """
+    Whether the SSE stream of an executor finished with the OK exit code.
+    """
+    text = "".join(c.decode("utf-8", errors="ignore") if isinstance(c, bytes) else c for c in chunks)
+    lines = [l for l in text.splitlines() if l.startswith("data: ")]
+    if not lines:
+        return False
+    try:
+        last = json.loads(lines[-1][len("data: "):])
+    except json.JSONDecodeError:
+        return False
+    exit_codes = [d.get("exit_code") for d in last.get("delta", []) if isinstance(d, dict) and d.get("type") == "exit_code"]
+    return last.get("finish_reason") == "stop" and exit_codes in ([], [0])
+
+def cosine_similarity(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm > 0 else 0.0
+
+class HttpEmbedder:
+    """
+    Embed the text with an OpenAI-compatible embeddings API.
+    Arguments:
+        url: The URL of the embeddings API, e.g. http://localhost:8080/v1/embeddings.
+        model: The model name passed to the API, if required.
+        timeout_sec: The timeout of a request.
+    """
+
+    def __init__(self, url, model=None, timeout_sec=5):
+        self.url = url
+        self.model = model
+        self.timeout_sec = timeout_sec
+
+    def __call__(self, text):
+        payload = {"input": text}
+        if self.model:
+            payload["model"] = self.model
+        response = requests.post(self.url, json=payload, timeout=self.timeout_sec)
+        response.raise_for_status()
+        return response.json()["data"][0]["embedding"]
+
+class CacheRequest:
+    """
+    The cache keys of a completion.
+    """
+
+    def __init__(self, access_code, history, modelfile, ttl_sec):
+        self.access_code = access_code
+        self.history = history
+        self.ttl_sec = ttl_sec
+        # Only the completions with the same modelfile are compared by similarity
+        self.group = hashlib.sha256(f"{access_code}\0{modelfile}".encode("utf-8")).hexdigest()
+        self.key = hashlib.sha256(f"{self.group}\0{history}".encode("utf-8")).hexdigest()
+        self.embedding = None
+
+class CacheEntry:
+    def __init__(self, request, chunks, size):
+        self.access_code = request.access_code
+        self.group = request.group
+        self.embedding = request.embedding
+        self.chunks = chunks
+        self.size = size
+        self.expires_at = time.monotonic() + request.ttl_sec
+
+class ResponseCache:
+    """
+    Cache the completed responses of the deterministic bots.
+    Only the access codes configured with a TTL are cached. A response is
+    found by the hash of the normalized chat history and modelfile first,
+    then by the similarity of the embedding of the history if an embedder
+    is provided. The similarity is only compared with the latest entries of
+    the same access code and modelfile. The entries are evicted in LRU order
+    to keep the total size of the cached chunks under max_bytes.
+    Arguments:
+        ttl_sec: The TTL of each access code in seconds. The key "*" applies to the others.
+        max_bytes: The maximum total size of the cached responses.
+        embedder: A function mapping the normalized chat history to a vector.
+        similarity_threshold: The minimal cosine similarity to reuse a response.
+        max_similarity_candidates: The number of the latest entries compared by similarity.
+    """
+
+    def __init__(self, ttl_sec=None, max_bytes=256 * 2**20, embedder=None, similarity_threshold=0.95, max_similarity_candidates=256):
+        self.ttl_sec = ttl_sec or {}
+        self.max_bytes = max_bytes
+        self.embedder = embedder
+        self.similarity_threshold = similarity_threshold
+        self.max_similarity_candidates = max_similarity_candidates
+        self.lock = threading.Lock()
+        self._entries = OrderedDict()
+        # The keys of the entries with an embedding in the order of insertion, by group
+        self._groups = {}
+        self._size = 0
+
+    def enabled(self):
+        return len(self.ttl_sec) > 0
+
+    def prepare(self, form, headers=None):
+        """
+        Compute the cache keys of a completion form.
+        Return None if the completion shouldn't be cached.
+        """
+        access_code = form.get("name")
+        ttl_sec = self.ttl_sec.get(access_code, self.ttl_sec.get("*", 0))
+        if not ttl_sec or ttl_sec <= 0:
+            return None
+        cache_control = (headers or {}).get("Cache-Control", "")
+        if "no-cache" in cache_control or "no-store" in cache_control:
+            return None
+        return CacheRequest(
+            access_code,
+            normalize_history(form.get("input", "")),
+            normalize_modelfile(form.get("modelfile")),
+            ttl_sec,
+        )
+
+    def get(self, request):
+        """
+        Return the cached chunks of the request, or None on miss.
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self._entries.get(request.key)
+            if entry is not None and entry.expires_at <= now:
+                self._remove(request.key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(request.key)
+                return entry.chunks
+        if self.embedder is None:
+            return None
+        return self._get_similar(request, now)
+
+    def _get_similar(self, request, now):
+        try:
+            request.embedding = self.embedder(request.history)
+        except Exception as e:
+            logger.warning(f"Failed to embed the chat history: {e}")
+            return None
+        with self.lock:
+            keys = reversed(self._groups.get(request.group, {}).keys())
+            candidates = [
+                (key, self._entries[key].embedding)
+                for key in itertools.islice(keys, self.max_similarity_candidates)
+                if self._entries[key].expires_at > now
+            ]
+        # Compared without holding the lock
+        best_key, best_similarity = None, self.similarity_threshold
+        for key, embedding in candidates:
+            similarity = cosine_similarity(request.embedding, embedding)
+            if similarity >= best_similarity:
+                best_key, best_similarity = key, similarity
+        if best_key is None:
+            return None
+        with self.lock:
+            entry = self._entries.get(best_key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(best_key)
+            return entry.chunks
+
+    def put(self, request, chunks):
+        size = sum(len(c.encode("utf-8")) if isinstance(c, str) else len(c) for c in chunks)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if request.key in self._entries:
+                self._remove(request.key)
+            self._entries[request.key] = CacheEntry(request, chunks, size)
+            if request.embedding is not None:
+                self._groups.setdefault(request.group, {})[request.key] = None
+            self._size += size
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def record(self, request, chunks):
+        """
+        Relay the chunks and cache them if the stream completes successfully.
+        """
+        recorded = []
+        for c in chunks:
+            recorded.append(c)
+            yield c
+        if completed(recorded):
+            self.put(request, recorded)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._size -= entry.size
+        group = self._groups.get(entry.group)
+        if group is not None:
+            group.pop(key, None)
+            if not group:
+                del self._groups[entry.group]
+
+    def size(self):
+        with self.lock:
+            return self._size
@@ -1,8 +1,16 @@
+import json
+import time
+import logging
+import asyncio
+import threading
 import requests
 from typing import List, Optional
-from flask import Blueprint, request, Response
+from flask import Blueprint, request, Response, jsonify
 from ..variable import *
+from ..functions import abort_all
+from ..channel import is_channel_endpoint
 from ..safety_middleware import safety_middleware
+logger = logging.getLogger(__name__)
 chat = Blueprint('chat', __name__)
 
 @chat.route("/completions", methods=["POST"])
@@ -10,16 +18,24 @@ def completions():
     # Forward SSE stream to the READY state LLM API, If no exist then return empty message
     # Parameters: name, input, history_id, user_id
     llm_name = request.form.get("name")
-    if data.get(llm_name):
-        dest = [i for i in data[llm_name] if i[1] == "READY" and i[2] == request.form.get("history_id") and i[3] == request.form.get("user_id")]
-        if len(dest) > 0:
-            dest = dest[0]
-            result = completions_backend(
-                form=request.form,
-                headers=request.headers,
-                dest=dest
-            )
-            return result
+    dest = scheduler.lookup(llm_name, request.form.get("history_id"), request.form.get("user_id"))
+    if dest is not None:
+        cache_request = response_cache.prepare(request.form, request.headers)
+        if cache_request is not None:
+            cached = response_cache.get(cache_request)
+            kernel_metrics.response_cache_lookups.labels(llm_name, "miss" if cached is None else "hit").inc()
+            if cached is not None:
+                # Replay the cached response and free the reserved LLM
+                scheduler.release(llm_name, dest)
+                return iter(cached), {'Content-Type': 'text/plain'}
+        result = completions_backend(
+            form=request.form,
+            headers=request.headers,
+            dest=dest
+        )
+        if cache_request is not None and isinstance(result, tuple):
+            return response_cache.record(cache_request, result[0]), result[1]
+        return result
     return ""
 
 @safety_middleware
@@ -40,34 +56,105 @@ def completions_backend(form: dict, headers: dict, dest:list):
     """
 
     llm_name = form.get("name")
+    if completion_coalescer.enabled:
+        key = completion_coalescer.digest(form)
+        stream, leader = completion_coalescer.join(key)
+        if not leader:
+            # Replay the identical completion in flight and free the reserved LLM
+            scheduler.release(llm_name, dest)
+            kernel_metrics.proxy_coalesced.labels(llm_name).inc()
+            return stream.replay(), {'Content-Type': 'text/plain'}
     try:
-        response = requests.post(dest[0], headers=headers, data=form, stream=True, timeout=5000)
-        def event_stream(dest, response):
-            dest[1] = "BUSY"
+        start_time = time.monotonic()
+        if is_channel_endpoint(dest[0]):
+            channel = executor_channels.get(dest[0])
+            if channel is None:
+                raise requests.exceptions.ConnectionError(f"The channel {dest[0]} is closed")
+            response = None
+            chunks = channel.stream_sync(dict(form), dict(headers))
+        else:
+            response = requests.post(dest[0], headers=headers, data=form, stream=True, timeout=5000)
+            chunks = response.iter_content(chunk_size=None, decode_unicode=True)
+        def event_stream(dest, chunks):
+            scheduler.occupy(dest)
+            first_chunk = True
             try:
-                for c in response.iter_content(chunk_size=None, decode_unicode=True):
+                for c in chunks:
+                    if first_chunk:
+                        kernel_metrics.proxy_time_to_first_byte_seconds.labels(llm_name).observe(time.monotonic() - start_time)
+                        first_chunk = False
+                    kernel_metrics.proxy_relayed_bytes.labels(llm_name).inc(len(c.encode("utf-8")) if isinstance(c, str) else len(c))
                     yield c
             except Exception as e:
+                kernel_metrics.proxy_failed.labels(llm_name).inc()
                 print('Error: {0}'.format(str(e)))
             finally:
-                dest[3] = -1
-                dest[2] = -1
-                dest[1] = "READY"
+                if response is None:
+                    chunks.close()
+                kernel_metrics.proxy_stream_duration_seconds.labels(llm_name).observe(time.monotonic() - start_time)
+                scheduler.release(llm_name, dest)
                 print("Done")
-        return event_stream(dest, response), {'Content-Type': 'text/plain'}
+        if completion_coalescer.enabled:
+            # Relay in background so that the subscribers won't be interrupted by the first client leaving
+            threading.Thread(target=fill_stream, args=(event_stream(dest, chunks), response, stream, key), daemon=True).start()
+            return stream.replay(), {'Content-Type': 'text/plain'}
+        return event_stream(dest, chunks), {'Content-Type': 'text/plain'}
     except requests.exceptions.ConnectionError as e:
         #POST Failed, unregister this LLM
-        data[llm_name] = [i for i in data[llm_name] if i[0] != dest[0]]
-        if data[llm_name] == []: del data[llm_name]
+        if completion_coalescer.enabled:
+            completion_coalescer.finish(key, stream)
+        kernel_metrics.proxy_failed.labels(llm_name).inc()
+        scheduler.unregister(llm_name, endpoint=dest[0])
+        record_journal.unregister(llm_name, endpoint=dest[0])
         return ""
+    except Exception as e:
+        # Free the reservation and the subscribers on any other failure
+        if completion_coalescer.enabled:
+            completion_coalescer.finish(key, stream)
+        kernel_metrics.proxy_failed.labels(llm_name).inc()
+        scheduler.release(llm_name, dest)
+        logger.warning(f"Failed to forward the completion to {dest[0]}: {e}")
+        return ""
+
+def fill_stream(chunks, response, stream, key):
+    """
+    Relay the upstream chunks to the shared stream until every subscriber leaves.
+    """
+    try:
+        for c in chunks:
+            if not stream.append(c):
+                break
+    finally:
+        chunks.close()
+        if response is not None:
+            response.close()
+        completion_coalescer.finish(key, stream)
 
 @chat.route("/abort", methods=["POST"])
 def abort():
+    # Abort the jobs of a user on the LLMs serving them concurrently
+    # Parameters: history_id (JSON list), user_id
+    # Return: The result of each job, which is "aborted", "failed", "timeout" or "not_found"
     history_id, user_id = request.form.get("history_id"), request.form.get("user_id")
+    results = {}
     if history_id and user_id:
-        history_id = eval(history_id)
-        for i, o in data.items():
-            dest = [k for k in o if int(k[2]) in history_id and k[3] == user_id]
-            for d in dest:
-                requests.get(d[0] + "/abort", timeout=10)
-    return "Success"
+        try:
+            history_ids = json.loads(history_id)
+        except json.JSONDecodeError:
+            return jsonify({"status": "error", "message": "history_id should be a JSON list"}), 400
+        if isinstance(history_ids, dict):
+            # PHP encodes an array with non-sequential keys as an object
+            history_ids = list(history_ids.values())
+        elif not isinstance(history_ids, list):
+            history_ids = [history_ids]
+        jobs = {}
+        for i in history_ids:
+            found = scheduler.find_job(i, user_id)
+            if found is None:
+                results[str(i)] = "not_found"
+            else:
+                jobs[str(i)] = found[1][0]
+        if jobs:
+            aborted = asyncio.run(abort_all(set(jobs.values()), timeout=abort_timeout_sec))
+            results.update({i: aborted[endpoint] for i, endpoint in jobs.items()})
+    return jsonify({"status": "success", "results": results})
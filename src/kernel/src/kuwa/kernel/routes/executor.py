@@ -6,66 +6,137 @@ from datetime import datetime
 from urllib.parse import urlparse
 from flask import Blueprint, request, json, redirect, url_for, jsonify, Response, stream_with_context
 from ..variable import *
-from ..functions import save_variable_to_file, endpoint_formatter, get_base_url, load_records
+from ..health_monitor import health_monitor
+from ..functions import endpoint_formatter, get_base_url, load_records
 executor = Blueprint('executor', __name__)
 
 logger = logging.getLogger(__name__)
 
 @executor.route("/schedule", methods=["POST"])
 def status():
-    # This will check if any LLM that is READY, then return "READY", if every is busy, return "BUSY"
-    # Parameters: name, history_id, user_id
+    # This will check if any LLM that is READY, then return "READY", if every is busy, wait in the
+    # queue for a while and return "BUSY" if still no LLM is released
+    # The LLM that served the same session last time is preferred to reuse its prompt cache.
+    # Parameters: name, history_id, user_id, session_id (optional, defaults to history_id)
     llm_name, history_id, user_id = request.form.get("name"), request.form.get("history_id"), request.form.get("user_id")
+    session_id = request.form.get("session_id")
     if llm_name and history_id:
-        if data.get(llm_name):
-            for i in data[llm_name]:
-                if i[1] == "READY" and i[2] == -1 and i[3] == -1:
-                    i[2] = history_id
-                    i[3] = user_id
-                    logger.info(f"Scheduled {llm_name},{i[0]} for {history_id},{user_id}")
-                    return "READY"
-        else:
+        start_time = time.monotonic()
+        result = scheduler.reserve(llm_name, history_id, user_id, session_id=session_id)
+        kernel_metrics.observe_schedule(llm_name, result, time.monotonic() - start_time)
+        if result == "NOMACHINE":
             logger.warning(f"No machine for {llm_name} has founded, returning NOMACHINE code")
             return "NOMACHINE"
+        if result == "READY":
+            return "READY"
     logger.warning(f"No READY machine for {llm_name}, returning BUSY code")
     return "BUSY"
    
+@executor.route("/queue", methods=["GET"])
+def queue_status():
+    # Report the waiting queue of an access code, so the client can show the
+    # position of a job instead of polling /schedule.
+    # Parameters: name, history_id (optional), user_id (optional)
+    llm_name, history_id, user_id = request.args.get("name"), request.args.get("history_id"), request.args.get("user_id")
+    if not llm_name:
+        return jsonify({"status": "error", "message": "name parameter is required"}), 400
+    return jsonify(scheduler.queue_status(llm_name, history_id, user_id)), 200
+
+@executor.route("/health", methods=["GET"])
+def health_status():
+    # Report the result of the background health checks of each endpoint
+    return jsonify(health_monitor.status()), 200
+
+def parse_lease(form):
+    """
+    Parse the optional lease TTL and the load reported by an executor.
+    """
+    lease_sec = float(form.get("lease_sec", 0) or 0)
+    load = {
+        k: int(form[k]) for k in ("concurrent_requests", "concurrent_req_limit", "queue_depth")
+        if form.get(k) is not None
+    }
+    return lease_sec, load
+
 @executor.route("/register", methods=["POST"])
 def register():
     # For Online LLM register themself
-    # Parameters: name, endpoint
+    # Parameters: name, endpoint, lease_sec (optional, the registration expires
+    # unless renewed through /heartbeat within lease_sec seconds), pid
+    # (optional, matching the executors started by the kernel)
     llm_name, endpoint = request.form.get("name"), request.form.get("endpoint")
-    if endpoint == None or llm_name == None or endpoint_formatter(endpoint) in [j[0] for j in data.get(llm_name, [])]: return "Failed"
-    data.setdefault(llm_name, []).append([endpoint_formatter(endpoint), "READY", -1, -1])
-    save_variable_to_file(record_file, data)
+    try:
+        lease_sec, load = parse_lease(request.form)
+        pid = int(request.form["pid"]) if request.form.get("pid") else None
+    except ValueError:
+        return "Failed"
+    if endpoint == None or llm_name == None or not executor_launcher.register(llm_name, endpoint_formatter(endpoint), pid): return "Failed"
+    record_journal.register(llm_name, endpoint_formatter(endpoint))
+    if lease_sec > 0:
+        executor_leases.renew(llm_name, endpoint_formatter(endpoint), lease_sec, load)
     logger.info(f"A new {llm_name} is registered at {endpoint}")
     return "Success"
 
+@executor.route("/heartbeat", methods=["POST"])
+def heartbeat():
+    # Renew the lease of a registered executor and report its load.
+    # "Failed" is returned if the executor isn't registered, e.g. the lease
+    # expired, and the executor should register again.
+    # Parameters: name, endpoint, lease_sec, concurrent_requests, concurrent_req_limit, queue_depth
+    llm_name, endpoint = request.form.get("name"), request.form.get("endpoint")
+    try:
+        lease_sec, load = parse_lease(request.form)
+    except ValueError:
+        return "Failed"
+    if endpoint == None or llm_name == None or lease_sec <= 0: return "Failed"
+    if not executor_leases.renew(llm_name, endpoint_formatter(endpoint), lease_sec, load):
+        logger.info(f"Heartbeat from the unregistered {llm_name} at {endpoint}")
+        return "Failed"
+    return "Success"
+
+@executor.route("/leases", methods=["GET"])
+def leases():
+    # Report the leases of the executors and their last reported load
+    return jsonify(executor_leases.list()), 200
+
 @executor.route("/unregister", methods=["POST"])
 def unregister():
     # For Offline LLM to unregister themself
     # Parameters: name, endpoint
     llm_name, endpoint = request.form.get("name"), get_base_url(request.form.get("endpoint"))
-    if llm_name in data:
-        old = len(data[llm_name])
-        data[llm_name] = [i for i in data[llm_name] if get_base_url(i[0]) != endpoint]
-        if data[llm_name] == []: del data[llm_name]
-        if data.get(llm_name) == None or old != len(data[llm_name]):
-            save_variable_to_file(record_file, data)
-            logger.info(f"{llm_name} , {endpoint} just unregistered from agent")
-            return "Success"
+    removed = scheduler.unregister(llm_name, base_url=endpoint)
+    if removed:
+        record_journal.unregister(llm_name, base_url=endpoint)
+        for record in removed:
+            executor_leases.revoke(llm_name, record[0])
+        logger.info(f"{llm_name} , {endpoint} just unregistered from agent")
+        return "Success"
     logger.warning(f"{llm_name} , {endpoint} failed to unregister")
     return "Failed"
     
+def local_state_error():
+    """
+    The error response of the routes editing the local records directly,
+    which would bypass a shared state backend. None with the in-memory state.
+    """
+    if not scheduler.state.shared:
+        return None
+    return jsonify({"status": "error", "message": "Editing the records is not supported with a shared state backend"}), 409
+
 @executor.route("/debug", methods=["GET", "POST"])
 def debug():
     # This route is for debugging
     if request.method == 'POST':
+        error = local_state_error()
+        if error is not None:
+            return error
         load_records(json.loads(request.form.get('data')), True)
+        # Persist the replaced records, which aren't in the journal
+        record_journal.compact(data, scheduler.lock)
         return redirect(url_for('executor.debug'))
     if request.headers.get("Accept") == "application/json":
         exported_data = {}
-        for access_code, group in data.items():
+        for access_code, group in scheduler.records.items():
             exported_group = []
             for executor in group:
                 exported_group.append({
@@ -85,11 +156,11 @@ def debug():
             document.querySelector("textarea").style.height = 'auto';
             document.querySelector("textarea").style.height = (document.querySelector("textarea").scrollHeight) + 'px';
         </script>
-        """).format(str(json.dumps(data, indent=2)))
+        """).format(str(json.dumps(scheduler.records, indent=2)))
 
 @executor.route("/list", methods=["GET"])
 def list_executor():
-    return jsonify(list(data.keys()))
+    return jsonify(list(scheduler.records.keys()))
 
 @executor.route("/shutdown", methods=["POST"])
 def shutdown_executor():
@@ -116,26 +187,35 @@ def shutdown_executor():
 
 @executor.route("/read", methods=["GET"])
 def read_executor():
-    return jsonify(data), 200
+    return jsonify(scheduler.records), 200
 
 def find_and_pop_record(access_code, endpoint, status, history_id, user_id, pop=False):
     """
     Find the first record in the data for the given access code and endpoint.
-    If pop is True, delete the record from the data before returning it.
+    If pop is True, delete the record from the data before returning it,
+    which is only supported with the in-memory state.
     """
-    if access_code in data:
-        for index, record in enumerate(data[access_code]):
-            if record == [endpoint, status, history_id, user_id]:
-                # Found the record
-                if pop:
-                    # Delete the record if pop is True
-                    return data[access_code].pop(index)  # This deletes the record and returns it
-                return record  # Just return the record without deleting
+    if pop and scheduler.state.shared:
+        raise RuntimeError("Editing the records is not supported with a shared state backend")
+    with scheduler.lock:
+        records = scheduler.records
+        if access_code in records:
+            for index, record in enumerate(records[access_code]):
+                if record == [endpoint, status, history_id, user_id]:
+                    # Found the record
+                    if pop:
+                        # Delete the record if pop is True. The list is replaced since the readers don't hold the lock.
+                        data[access_code] = data[access_code][:index] + data[access_code][index + 1:]
+                        scheduler.rebuild()
+                    return record  # Just return the record without deleting
     return None  # Return None if no record was found
 
 
 @executor.route("/update", methods=["POST"])
 def update_executor():
+    error = local_state_error()
+    if error is not None:
+        return error
     try:
         request_data = request.get_json()
         
@@ -156,13 +236,13 @@ def update_executor():
 
         # If record was found and deleted
         if original_record is not None:
-            # If the new access code doesn't exist, create it
-            if new_access_code not in data:
-                data[new_access_code] = []
-
-            # Insert the new record into the correct access code
-            new_record = [new_endpoint, new_status, int(new_history_id), int(new_user_id)]
-            data[new_access_code].append(new_record)
+            with scheduler.lock:
+                # Insert the new record into the correct access code, creating it if not exist
+                new_record = [new_endpoint, new_status, int(new_history_id), int(new_user_id)]
+                data[new_access_code] = data.get(new_access_code, []) + [new_record]
+                scheduler.rebuild()
+            record_journal.unregister(original_access_code, endpoint=original_endpoint)
+            record_journal.register(new_access_code, new_endpoint)
 
             return jsonify({"status": "success", "message": "Record updated successfully"}), 200
         else:
@@ -1,19 +1,26 @@
 import os
-import threading
+import queue
 import time
 import subprocess
 import shutil
-from datetime import datetime
+import logging
 from flask import Blueprint, request, jsonify, Response, stream_with_context
+from .. import variable
+from ..variable import executor_launcher, download_jobs, download_rate_limiter, model_inventory, scheduler
+from ..downloader import DownloadJob
+
+logger = logging.getLogger(__name__)
 
 model = Blueprint('model', __name__)
-download_jobs = {}
 
 def ensure_cache_directory():
     cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "huggingface", "hub")
     os.makedirs(cache_dir, exist_ok=True)
     return cache_dir
 
+def model_folder_name(model_name):
+    return "models--" + model_name.replace("/", "--")
+
 def clean_up_partial_download(model_name):
     time.sleep(1)
     base_model_dir = os.path.join(os.path.expanduser("~"), ".cache", "huggingface", "hub", "models--" + model_name.replace("/", "--"))
@@ -21,58 +28,32 @@ def clean_up_partial_download(model_name):
         shutil.rmtree(base_model_dir)
         shutil.rmtree(os.path.join(os.path.expanduser("~"), ".cache", "huggingface", "hub", ".locks", "models--" + model_name.replace("/", "--")))
     except Exception as e:
-        print(f"Error during cleanup: {e}")
-
-def capture_output(pipe, output_list, stop_event):
-    for line in iter(pipe.readline, ""):
-        if stop_event.is_set():
-            pipe.close()
-            break
-        output_list.append(line.strip())
-    pipe.close()
-
-def download_model_cli(model_name, result_list, stop_event):
-    cache_dir = ensure_cache_directory()
-    command = ["huggingface-cli", "download", model_name, "--cache-dir", cache_dir]
-    result_list.append("Executing: " + " ".join(command))
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=1)
-    download_jobs[model_name]['process'] = process
-
-    stdout_thread = threading.Thread(target=capture_output, args=(process.stdout, result_list, stop_event))
-    stderr_thread = threading.Thread(target=capture_output, args=(process.stderr, result_list, stop_event))
-    stdout_thread.start()
-    stderr_thread.start()
+        logger.warning(f"Error during cleanup: {e}")
 
+def run_download(job):
     try:
-        process.wait()
-    except Exception as e:
-        result_list.append(f"Process error: {e}")
-
-    stdout_thread.join()
-    stderr_thread.join()
-
-    if not stop_event.is_set():
-        result_list.append(f"Model downloaded and cached at: {cache_dir}")
-    else:
-        clean_up_partial_download(model_name)
-
-    del download_jobs[model_name]
+        job.run()
+    finally:
+        download_jobs.pop(job.model_name, None)
+        model_inventory.refresh(model_folder_name(job.model_name))
 
 @model.route("/abort", methods=["POST"])
 def stop_download():
+    # The partial files are kept to resume the download later, unless clean_up is true
     model_name = request.json.get("model_name")
     if not model_name or model_name not in download_jobs:
         return jsonify({"error": "Valid model_name parameter is required"}), 400
 
-    job_details = download_jobs[model_name]
-    job_details['stop_event'].set()
+    job = download_jobs[model_name]
+    job.stop()
 
-    if job_details['process']:
-        job_details['process'].terminate()
-
-    clean_up_partial_download(model_name)
+    if request.json.get("clean_up", False):
+        job.thread.join()
+        clean_up_partial_download(model_name)
+        model_inventory.forget(model_folder_name(model_name))
+        return jsonify({"message": f"Download job for model '{model_name}' is being stopped and cleaned up."}), 200
 
-    return jsonify({"message": f"Download job for model '{model_name}' is being stopped and cleaned up."}), 200
+    return jsonify({"message": f"Download job for model '{model_name}' is being stopped, it can be resumed later."}), 200
 
 @model.route("/remove", methods=["POST"])
 def remove_model():
@@ -88,6 +69,7 @@ def remove_model():
     
     try:
         shutil.rmtree(base_model_dir)
+        model_inventory.forget(folder_name)
         # Clean up any associated locks
         lock_dir = os.path.join(os.path.expanduser("~"), ".cache", "huggingface", "hub", ".locks", folder_name)
         if os.path.exists(lock_dir):
@@ -97,47 +79,96 @@ def remove_model():
     except Exception as e:
         return jsonify({"error": f"Failed to remove model '{folder_name}': {str(e)}"}), 500
 
+def executor_command(params):
+    """
+    Build the command to start the Hugging Face executor of a model.
+    Return the access code and the command.
+    """
+    model_path = params.get("model_path")
+    access_code = "hf/" + model_path.replace('/','--')
+    # Base command and optional parameters
+    command = ["kuwa-executor", "huggingface", "--access_code", access_code]
+    for arg in ["model_path", "visible_gpu", "limit", "timeout"]:
+        value = params.get(arg)
+        if value is not None:
+            command.extend([f"--{arg}", str(value)])
+    return access_code, command
+
 @model.route("/start", methods=["POST"])
 def start_model():
+    # Start an executor in background, or take one from the warm pool.
+    # The job becomes ready once the executor registers itself.
     model_path = request.json.get("model_path")
     if not model_path:
         return jsonify({"error": "model_path parameter is required"}), 400
 
-    # Base command and optional parameters
-    command = ["kuwa-executor", "huggingface", "--access_code", "hf/" + model_path.replace('/','--')]
-    for arg in ["model_path", "visible_gpu", "limit", "timeout"]:
-        value = request.json.get(arg)
-        if value is not None:
-            command.extend([f"--{arg}", str(value)])
-
-    # Attempt to start the process
+    access_code, command = executor_command(request.json)
+    model_inventory.touch(model_folder_name(model_path))
     try:
-        process = subprocess.Popen(
-            command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True
-        )
-        stdout, stderr = process.communicate()
-        if process.returncode != 0:
-            return jsonify({"error": f"Failed to start model '{model_path}': {stderr.decode().strip()}"}), 500
-        return jsonify({"message": f"Model '{model_path}' has been started successfully."}), 200
+        job = executor_launcher.start(access_code, command, use_warm_pool=request.json.get("use_warm_pool", True))
     except Exception as e:
-        return jsonify({"error": f"Unexpected error: {str(e)}"}), 500
+        return jsonify({"error": f"Failed to start model '{model_path}': {str(e)}"}), 500
+    if job.state == "ready":
+        return jsonify({"message": f"Model '{model_path}' has been started from the warm pool.", "job": job.to_dict()}), 200
+    return jsonify({"message": f"Model '{model_path}' is starting.", "job": job.to_dict()}), 202
+
+@model.route("/warm_pool", methods=["POST"])
+def set_warm_pool():
+    # Keep the given number of pre-loaded executors of a model
+    model_path, size = request.json.get("model_path"), request.json.get("size")
+    if not model_path or not isinstance(size, int) or size < 0:
+        return jsonify({"error": "model_path and a non-negative size are required"}), 400
+
+    access_code, command = executor_command(request.json)
+    try:
+        executor_launcher.set_warm_pool(access_code, command, size)
+    except Exception as e:
+        return jsonify({"error": f"Failed to start model '{model_path}': {str(e)}"}), 500
+    return jsonify({"message": f"Keeping {size} warm executors of model '{model_path}'."}), 200
+
+@model.route("/executors", methods=["GET"])
+def list_executors():
+    return jsonify({"executors": executor_launcher.list()}), 200
+
+@model.route("/executors/<job_id>", methods=["GET"])
+def get_executor(job_id):
+    job = executor_launcher.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Job '{job_id}' does not exist."}), 404
+    return jsonify(job.to_dict()), 200
+
+@model.route("/stop", methods=["POST"])
+def stop_model():
+    job = executor_launcher.stop(request.json.get("job_id"))
+    if job is None:
+        return jsonify({"error": "Valid job_id parameter is required"}), 400
+    return jsonify({"message": f"Executor '{job.job_id}' is being stopped.", "job": job.to_dict()}), 200
 
 @model.route("/", methods=["GET"])
 def list_models():
-    cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "huggingface", "hub")
-    cached_models = [
-        d for d in os.listdir(cache_dir) 
-        if os.path.isdir(os.path.join(cache_dir, d)) and not d.startswith('.')
-    ] if os.path.exists(cache_dir) else []
-    
-    downloading_models = {
-        "models--" + model_name.replace("/", "--") 
-        for model_name in download_jobs.keys()
-    }
+    # Served from the inventory in memory, with the size, revision and last-used time of each model
+    downloading_models = {model_folder_name(model_name) for model_name in download_jobs.keys()}
+    available_models = [m for m in model_inventory.list() if m["name"] not in downloading_models]
     
-    available_models = [model for model in cached_models if model not in downloading_models]
-    
-    return jsonify(models=sorted(available_models)), 200
+    return jsonify(models=[m["name"] for m in available_models], details=available_models), 200
+
+@model.route("/prune", methods=["POST"])
+def prune_models():
+    # Remove the least recently used models until the cache is under max_gb.
+    # The downloading models and the ones served by an executor are kept.
+    max_gb, dry_run = request.json.get("max_gb"), request.json.get("dry_run", False)
+    if not isinstance(max_gb, (int, float)) or max_gb < 0:
+        return jsonify({"error": "A non-negative max_gb parameter is required"}), 400
+
+    keep = {model_folder_name(model_name) for model_name in download_jobs.keys()}
+    for access_codes in scheduler.endpoints().values():
+        keep.update("models--" + a[len("hf/"):] for a in access_codes if a.startswith("hf/"))
+    removed = model_inventory.prune(int(max_gb * 2**30), keep=keep, dry_run=dry_run)
+    return jsonify({
+        "removed": removed,
+        "freed_bytes": sum(m["size_bytes"] for m in removed),
+        "dry_run": dry_run,
+    }), 200
 
 @model.route("/download", methods=["GET"])
 def download_model():
@@ -148,48 +179,42 @@ def download_model():
     if model_name in download_jobs:
         return jsonify({"error": f"Download for model '{model_name}' is already in progress."}), 400
 
-    result_list = []
-    stop_event = threading.Event()
-    start_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-    download_jobs[model_name] = {
-        'result_list': result_list,
-        'stop_event': stop_event,
-        'process': None,
-        'thread': None,
-        'start_time': start_time
-    }
-
-    download_thread = threading.Thread(target=download_model_cli, args=(model_name, result_list, stop_event))
-    download_jobs[model_name]['thread'] = download_thread
-    download_thread.start()
+    job = DownloadJob(
+        model_name,
+        ensure_cache_directory(),
+        max_workers=variable.download_max_workers,
+        rate_limiter=download_rate_limiter,
+    )
+    download_jobs[model_name] = job
+    job.start(target=lambda: run_download(job))
 
     def generate():
         try:
-            while download_thread.is_alive() or result_list:
-                time.sleep(0.1)
-                if result_list:
-                    yield result_list.pop(0) + "\n"
-                else:
+            while True:
+                try:
+                    event = job.events.get(timeout=1)
+                except queue.Empty:
+                    # Keep the connection alive
                     yield " "
-            if not stop_event.is_set():
+                    continue
+                if event is None:
+                    break
+                yield event + "\n"
+            if job.state == "complete":
                 yield 'Complete!\n'
+            elif job.state == "failed":
+                yield 'Failed!\n'
             else:
                 yield 'Aborted!\n'
         except GeneratorExit:
-            stop_event.set()
-            if download_jobs[model_name]['process']:
-                download_jobs[model_name]['process'].terminate()
-            download_thread.join()
+            job.stop()
+            job.thread.join()
 
     return Response(stream_with_context(generate()), mimetype='text/plain')
 
 @model.route("/jobs", methods=["GET"])
 def list_download_jobs():
-    active_jobs = [
-        {"model_name": model_name, "start_time": details['start_time']}
-        for model_name, details in download_jobs.items()
-    ]
+    active_jobs = [job.to_dict() for job in list(download_jobs.values())]
     return jsonify({"active_jobs": active_jobs}), 200
     
 
@@ -0,0 +1,135 @@
+import re
+import random
+import threading
+
+class EndpointStats:
+    """
+    The load and latency of each executor endpoint, shared by the routing policies.
+    The latency is the time to the first chunk scraped from the executors.
+    The executors not exposing it are ranked by the latency of the health
+    probes instead.
+    Arguments:
+        smoothing: The weight of the latest observation in the average latency.
+    """
+
+    def __init__(self, smoothing=0.3):
+        self.smoothing = smoothing
+        self.lock = threading.Lock()
+        self._outstanding = {}
+        self._latency = {}
+        self._probe_latency = {}
+
+    def add_outstanding(self, endpoint, delta):
+        with self.lock:
+            count = self._outstanding.get(endpoint, 0) + delta
+            if count > 0:
+                self._outstanding[endpoint] = count
+            else:
+                self._outstanding.pop(endpoint, None)
+
+    def reset_outstanding(self, endpoints):
+        """
+        Recount the jobs in progress from the endpoints serving them.
+        """
+        with self.lock:
+            self._outstanding = {}
+            for endpoint in endpoints:
+                self._outstanding[endpoint] = self._outstanding.get(endpoint, 0) + 1
+
+    def outstanding(self, endpoint):
+        return self._outstanding.get(endpoint, 0)
+
+    def observe_latency(self, endpoint, seconds):
+        self._observe(self._latency, endpoint, seconds)
+
+    def observe_probe_latency(self, endpoint, seconds):
+        self._observe(self._probe_latency, endpoint, seconds)
+
+    def _observe(self, averages, endpoint, seconds):
+        with self.lock:
+            average = averages.get(endpoint)
+            averages[endpoint] = seconds if average is None else (1 - self.smoothing) * average + self.smoothing * seconds
+
+    def latency(self, endpoint):
+        latency = self._latency.get(endpoint)
+        return latency if latency is not None else self._probe_latency.get(endpoint)
+
+    def forget(self, endpoint):
+        with self.lock:
+            self._latency.pop(endpoint, None)
+            self._probe_latency.pop(endpoint, None)
+
+class RoutingPolicy:
+    """
+    Choose one of the idle executors of an access code for a job.
+    """
+
+    def choose(self, idle, stats: EndpointStats):
+        """
+        Arguments:
+            idle: The idle records of the access code keyed by the endpoint,
+            ordered from the longest idle one.
+            stats: The statistics of the endpoints.
+        Return:
+            The endpoint to serve the job.
+        """
+        raise NotImplementedError()
+
+class FifoPolicy(RoutingPolicy):
+    """
+    The executor idle for the longest time, which rotates through the replicas.
+    """
+
+    def choose(self, idle, stats):
+        return next(iter(idle))
+
+class LeastOutstandingPolicy(RoutingPolicy):
+    """
+    The executor with the fewest jobs in progress. An executor registered
+    with several access codes is counted across all of them.
+    """
+
+    def choose(self, idle, stats):
+        return min(idle, key=stats.outstanding)
+
+class PowerOfTwoChoicesPolicy(RoutingPolicy):
+    """
+    Sample two executors and take the less loaded one, then the faster one.
+    """
+
+    def choose(self, idle, stats):
+        if len(idle) == 1:
+            return next(iter(idle))
+        candidates = random.sample(list(idle), 2)
+        return min(candidates, key=lambda e: (stats.outstanding(e), stats.latency(e) or 0))
+
+class LatencyPolicy(RoutingPolicy):
+    """
+    The executor with the lowest average latency. Executors without any
+    observation are preferred so that they get measured.
+    """
+
+    def choose(self, idle, stats):
+        return min(idle, key=lambda e: (stats.latency(e) or 0, stats.outstanding(e)))
+
+ROUTING_POLICIES = {
+    "fifo": FifoPolicy,
+    "least_outstanding": LeastOutstandingPolicy,
+    "p2c": PowerOfTwoChoicesPolicy,
+    "latency": LatencyPolicy,
+}
+
+def parse_histogram(text, name):
+    """
+    Sum the "_sum" and "_count" samples of a histogram over all label sets
+    from the Prometheus text exposition format.
+    Return:
+        A tuple of (sum, count), or None if the histogram is not found.
+    """
+    pattern = re.compile(rf"^{re.escape(name)}_(sum|count)(?:\{{[^}}]*\}})?\s+(\S+)", re.MULTILINE)
+    result = {"sum": 0.0, "count": 0.0}
+    found = False
+    for field, value in pattern.findall(text):
+        result[field] += float(value)
+        found = True
+    return (result["sum"], result["count"]) if found else None
@@ -1,36 +1,278 @@
+import time
+import queue
 import logging
 import inspect
 import json
-import requests
+import asyncio
+import threading
 from typing import List
+from . import variable
+from .variable import scheduler, kernel_metrics
+from .functions import abort_all
 
 logger = logging.getLogger(__name__)
 
+# The pools of the guarded functions, prewarmed at startup
+safety_guard_pools = []
+
 def safety_middleware(func, n_max_buffer=50, streaming=True):
-    bypass = True
     try:
         from llm_safety_guard import LlmSafetyGuard
-        bypass = False
     except ImportError:
         logger.warning('Bypassing safety middleware due to the package "llm-safety-guard" is not installed.')
+        return func
 
-    def wrap(*args, **kwargs):
-        nonlocal func
-        if bypass:
-            return func(*args, **kwargs)
-        
+    def create_guard():
         # Forward path: Flask --[Convert]--> Safety Guard --[Convert]--> Chat completion backend.
         # Normal return path:  Chat completion backend --> Safety Guard --> Flask
         # Return path under violation of pre-filter rules:  Safety Guard --> Flask
-        safety_guard = LlmSafetyGuard(n_max_buffer=n_max_buffer, streaming=streaming)
-        local_func = to_safety_guard_signature(func)
-        local_func = safety_guard.guard(local_func)
-        local_func = to_completions_backend_signature(local_func)
-        return local_func(*args, **kwargs)
-    
+        guard = PooledGuard(LlmSafetyGuard(n_max_buffer=n_max_buffer, streaming=streaming))
+        local_func = observe_backend(func, guard, n_max_buffer)
+        local_func = to_safety_guard_signature(local_func)
+        local_func = guard.instance.guard(local_func)
+        guard.chain = to_completions_backend_signature(local_func)
+        return guard
+
+    pool = SafetyGuardPool(create_guard, size=variable.safety_guard_pool_size)
+    safety_guard_pools.append(pool)
+
+    def wrap(*args, **kwargs):
+        form = kwargs["form"] if "form" in kwargs else args[0]
+        llm_name = form.get("name", "")
+        guard = pool.acquire()
+        try:
+            result = guard.chain(*args, **kwargs)
+        except Exception:
+            pool.release(guard)
+            raise
+        if isinstance(result, tuple) and is_stream(result[0]):
+            return (GuardedStream(result[0], guard, pool, llm_name), *result[1:])
+        if is_stream(result):
+            return GuardedStream(result, guard, pool, llm_name)
+        guard.observe(llm_name)
+        pool.release(guard)
+        return result
+
     wrap.__signature__ = inspect.signature(func)
     return wrap
 
+class PooledGuard:
+    """
+    A Safety Guard instance with the function chain wrapped around it, and
+    the timestamps of the request being guarded. It's used by a request at a time.
+    """
+
+    def __init__(self, instance, chain=None):
+        self.instance = instance
+        self.chain = chain
+        self.reset()
+
+    def reset(self):
+        self.started_at = time.monotonic()
+        self.backend_called_at = None
+        self.first_backend_chunk_at = None
+        self.first_chunk_at = None
+
+    def observe(self, llm_name):
+        """
+        Record the latency added by the Safety Guard to the request.
+        """
+        if self.backend_called_at is not None:
+            kernel_metrics.safety_guard_prefilter_seconds.labels(llm_name).observe(self.backend_called_at - self.started_at)
+        if self.first_backend_chunk_at is not None and self.first_chunk_at is not None:
+            kernel_metrics.safety_guard_added_latency_seconds.labels(llm_name).observe(
+                max(self.first_chunk_at - self.first_backend_chunk_at, 0)
+            )
+
+class SafetyGuardPool:
+    """
+    Keep the initialized Safety Guard instances for reuse, instead of
+    constructing the instance and wrapping the function chain per request.
+    A new instance is created if every instance is in use, and at most size
+    idle instances are kept.
+    Arguments:
+        factory: The function creating a PooledGuard.
+        size: The maximum number of idle instances.
+    """
+
+    def __init__(self, factory, size=8):
+        self.factory = factory
+        self.size = size
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def acquire(self):
+        with self.lock:
+            if self.idle:
+                guard = self.idle.pop()
+                guard.reset()
+                return guard
+        return self.factory()
+
+    def release(self, guard):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(guard)
+
+    def prewarm(self, size=None):
+        """
+        Create the instances up to the size in advance, so the first requests don't pay for it.
+        """
+        if size is not None:
+            self.size = size
+        with self.lock:
+            missing = self.size - len(self.idle)
+        guards = [self.factory() for _ in range(missing)]
+        with self.lock:
+            self.idle.extend(guards[:max(self.size - len(self.idle), 0)])
+
+class GuardedStream:
+    """
+    Relay the output of the Safety Guard, and return the guard to the pool
+    once the response is finished or closed by the client.
+    """
+
+    def __init__(self, chunks, guard, pool, llm_name):
+        self.chunks = iter(chunks)
+        self.guard = guard
+        self.pool = pool
+        self.llm_name = llm_name
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            chunk = next(self.chunks)
+        except BaseException:
+            self.close()
+            raise
+        if self.guard.first_chunk_at is None:
+            self.guard.first_chunk_at = time.monotonic()
+        return chunk
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if hasattr(self.chunks, "close"):
+                self.chunks.close()
+        finally:
+            self.guard.observe(self.llm_name)
+            self.pool.release(self.guard)
+
+class PrefetchedStream:
+    """
+    Read a stream in a background thread, so that a slow consumer, e.g.
+    the Safety Guard, checks the chunks arrived in the meantime as a single
+    window instead of one by one, and the executor isn't held back by the
+    checks. At most max_chunks chunks are read ahead of the consumer.
+    The reader stops once the stream is exhausted, closed or collected,
+    even if it's never started.
+    Arguments:
+        chunks: The stream of str or bytes chunks.
+        max_chunks: The maximum number of chunks held back.
+    """
+
+    _end = object()
+
+    def __init__(self, chunks, max_chunks=50):
+        self.queue = queue.Queue(maxsize=max(max_chunks, 1))
+        self.stopped = threading.Event()
+        self.done = False
+        self.error = None
+        # The reader doesn't reference the stream, so that an abandoned stream can be collected
+        self.thread = threading.Thread(target=self._read, args=(chunks, self.queue, self.stopped), daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def _read(chunks, chunk_queue, stopped):
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    chunk_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            for chunk in chunks:
+                if not put(chunk):
+                    break
+        except Exception as e:
+            put(e)
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+            put(PrefetchedStream._end)
+
+    def windows(self):
+        """
+        Iterate over the chunks arrived since the last window joined together.
+        """
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            self.close()
+            raise error
+        if self.done:
+            raise StopIteration
+        window = [self.queue.get()]
+        while window[-1] is not self._end and not isinstance(window[-1], Exception):
+            try:
+                window.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        end = window[-1]
+        if end is self._end or isinstance(end, Exception):
+            window.pop()
+            self.close()
+            if isinstance(end, Exception):
+                self.error = end
+        if not window:
+            return next(self)
+        return window[0][:0].join(window)
+
+    def close(self):
+        self.done = True
+        self.stopped.set()
+
+    def __del__(self):
+        self.stopped.set()
+
+def is_stream(value):
+    return inspect.isgenerator(value) or (hasattr(value, "__next__") and not isinstance(value, (str, bytes)))
+
+def observe_backend(func, guard, max_chunks):
+    """
+    Record when the backend is called and responds, and prefetch the
+    response in the windowed check mode.
+    """
+
+    def wrap(*args, **kwargs):
+        guard.backend_called_at = time.monotonic()
+        result = func(*args, **kwargs)
+        if not isinstance(result, tuple) or not is_stream(result[0]):
+            return result
+        def observed(chunks):
+            for chunk in chunks:
+                if guard.first_backend_chunk_at is None:
+                    guard.first_backend_chunk_at = time.monotonic()
+                yield chunk
+        chunks = observed(result[0])
+        if variable.safety_guard_check_mode == "windowed":
+            chunks = PrefetchedStream(chunks, max_chunks).windows()
+        return (chunks, *result[1:])
+    return wrap
+
 def to_safety_guard_signature(func):
     """
     Convert the function signature to the llm-safety-guard compatible one.
@@ -63,16 +305,36 @@ def to_completions_backend_signature(func):
         ]
         def at_exit():
             nonlocal kwargs
-            dest = kwargs['dest']
-            requests.get(dest[0] + "/abort", timeout=10)
-            dest[3] = -1
-            dest[2] = -1
-            dest[1] = "READY"
-            print("Done")
+            # Stop the executor in background, so the response isn't held back by the abort
+            threading.Thread(target=abort_and_release, args=(llm_name, kwargs['dest']), daemon=True).start()
 
         return func(chat_history=input, model_id=llm_name, at_exit=at_exit, form=form, *args, **kwargs)
     return wrap
 
+def abort_and_release(llm_name, dest):
+    asyncio.run(abort_all([dest[0]], timeout=10))
+    scheduler.release(llm_name, dest)
+    logger.debug(f"Aborted {dest[0]} after the Safety Guard stopped the output")
+
+def safety_guard_installed():
+    """
+    Whether the completions need to pass through the Safety Guard.
+    """
+
+    try:
+        import llm_safety_guard
+        return True
+    except ImportError:
+        return False
+
+def prewarm_safety_guards(size):
+    """
+    Initialize the pooled Safety Guard instances. Executed once at startup.
+    """
+
+    for pool in safety_guard_pools:
+        pool.prewarm(size)
+
 def update_safety_guard():
     """
     The cronjob to update the safety guard.
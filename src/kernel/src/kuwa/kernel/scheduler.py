@@ -0,0 +1,442 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from .routing import EndpointStats, FifoPolicy
+from .state import ENDPOINT, STATUS, HISTORY_ID, USER_ID, NO_JOB, SUSPEND_MANUAL, MemoryStateBackend, job_key, _normalize, _base_url
+
+logger = logging.getLogger(__name__)
+
+class Waiter:
+    """
+    A job waiting for an idle executor.
+    """
+
+    def __init__(self, key, affinity=None):
+        self.key = key
+        self.affinity = affinity
+        self.event = threading.Event()
+        self.result = None
+
+class WaitQueue:
+    """
+    The FIFO of the jobs waiting for an access code. If fair is True, the
+    jobs are served in round-robin among users, so that a user submitting a
+    burst of jobs can't starve the others.
+    """
+
+    def __init__(self, fair=False):
+        self.fair = fair
+        self._queues = OrderedDict()
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def _bucket(self, waiter):
+        return waiter.key[1] if self.fair else None
+
+    def push(self, waiter):
+        self._queues.setdefault(self._bucket(waiter), deque()).append(waiter)
+        self._length += 1
+
+    def peek(self):
+        return next(iter(self._queues.values()))[0]
+
+    def pop(self):
+        bucket, queue = next(iter(self._queues.items()))
+        waiter = queue.popleft()
+        if queue:
+            self._queues.move_to_end(bucket)
+        else:
+            del self._queues[bucket]
+        self._length -= 1
+        return waiter
+
+    def remove(self, waiter):
+        bucket = self._bucket(waiter)
+        queue = self._queues.get(bucket)
+        if queue is None or waiter not in queue:
+            return False
+        queue.remove(waiter)
+        if not queue:
+            del self._queues[bucket]
+        self._length -= 1
+        return True
+
+    def position(self, waiter):
+        """
+        The number of jobs that will be served before the waiter.
+        """
+        bucket = self._bucket(waiter)
+        index = self._queues[bucket].index(waiter)
+        position = index
+        preceding = True
+        for b, queue in self._queues.items():
+            if b == bucket:
+                preceding = False
+                continue
+            # The buckets before the waiter's one are served once more in the current round.
+            position += min(len(queue), index + 1 if preceding else index)
+        return position
+
+class ExecutorScheduler:
+    """
+    Schedule the jobs to the executors recorded in a state backend. The
+    default MemoryStateBackend keeps the records in the shared dictionary of
+    the shape {access_code: [[endpoint, status, history_id, user_id], ...]}
+    with the indexes to make scheduling constant time. A shared backend,
+    e.g. RedisStateBackend, lets several kernel processes schedule the same
+    executors. Next to the state, the scheduler maintains in the process:
+        - A bounded wait queue per access code. A released executor is handed
+          to the first waiting job directly. With a shared backend, the
+          waiting jobs also poll for the executors released by other kernels.
+        - A bounded LRU table of the endpoint that last served each session, so
+          that the follow-up turns land on the executor holding the prompt cache.
+    The writers are serialized by the lock of the scheduler, while the
+    readers of the records take a snapshot without the lock. Every mutation
+    of the records should go through the scheduler, or replace the lists
+    under the lock followed by rebuild() so that the indexes stay coherent.
+    Arguments:
+        records: The shared record dictionary of the in-memory state.
+        max_wait_sec: How long a job waits for an executor before "BUSY" is returned.
+        max_queue_size: The maximum number of waiting jobs per access code.
+        fair_queue: Serve the waiting jobs in round-robin among users.
+        routing_policy: The RoutingPolicy choosing among the idle executors.
+        affinity_table_size: The maximum number of remembered sessions. 0 to disable the affinity.
+        state: The state backend, defaults to a MemoryStateBackend of the records.
+    """
+
+    # The interval for the waiting jobs to check the executors released by other kernels
+    poll_interval_sec = 0.1
+
+    def __init__(self, records: dict, max_wait_sec=0, max_queue_size=0, fair_queue=False, routing_policy=None, affinity_table_size=10000, state=None):
+        self.state = state or MemoryStateBackend(records)
+        self.max_wait_sec = max_wait_sec
+        self.max_queue_size = max_queue_size
+        self.fair_queue = fair_queue
+        self.routing_policy = routing_policy or FifoPolicy()
+        self.affinity_table_size = affinity_table_size
+        self.stats = EndpointStats()
+        self.lock = threading.RLock()
+        self._queues = {}
+        self._waiting = {}
+        self._reserved_at = {}
+        self._service_time = {}
+        self._affinity = OrderedDict()
+        self.affinity_hits = 0
+        self.affinity_misses = 0
+        self.rebuild()
+
+    @property
+    def records(self):
+        """
+        A snapshot of the records of every access code, taken without the
+        lock. The records in the snapshot are read-only.
+        """
+        return self.state.snapshot()
+
+    def set_state(self, state):
+        """
+        Switch to another state backend, e.g. a shared one configured at startup.
+        """
+        with self.lock:
+            self.state = state
+            self.rebuild()
+
+    def rebuild(self):
+        """
+        Recompute all the indexes from the records.
+        """
+        with self.lock:
+            self.state.rebuild()
+            self.stats.reset_outstanding(r[ENDPOINT] for _, r in self.state.reservations())
+            for access_code in list(self._queues.keys()):
+                self._dispatch(access_code)
+
+    def register(self, access_code, endpoint, suspend_reason=None):
+        """
+        Add a new idle executor. Return False if the endpoint is already registered.
+        Arguments:
+            suspend_reason: Register the executor suspended for the reason,
+            so that no job is dispatched to it in between.
+        """
+        with self.lock:
+            if not self.state.register(access_code, endpoint, suspend_reason):
+                return False
+            self._dispatch(access_code)
+            return True
+
+    def is_registered(self, access_code, endpoint):
+        with self.lock:
+            return self.state.is_registered(access_code, endpoint)
+
+    def has_executors(self, access_code):
+        """
+        Whether any executor of the access code is registered, read without the lock.
+        """
+        return self.state.count(access_code) > 0
+
+    def unregister(self, access_code, base_url=None, endpoint=None):
+        """
+        Remove the executors of an access code by either the base URL or the
+        exact endpoint. Return the removed records.
+        """
+        def matched(e):
+            if endpoint is not None:
+                return e == endpoint
+            return _base_url(e) == base_url
+        with self.lock:
+            removed = self.state.unregister(access_code, matched)
+            for record in removed:
+                self._forget(access_code, record)
+            if removed and self.state.count(access_code) == 0:
+                self._dispatch(access_code)
+            return removed
+
+    def reserve(self, access_code, history_id, user_id, timeout=None, session_id=None):
+        """
+        Reserve an idle executor for the job. If every executor is occupied,
+        the job waits in the queue of the access code for at most timeout
+        seconds, which defaults to max_wait_sec.
+        The executor that last served the session, which defaults to the
+        history_id, is preferred if it's idle. Otherwise the routing policy
+        chooses one of the idle executors.
+        Return "READY" if reserved, "BUSY" if every executor is occupied and
+        "NOMACHINE" if no executor of the access code is registered.
+        """
+        key = job_key(history_id, user_id)
+        affinity = _normalize(history_id if session_id is None else session_id)
+        timeout = self.max_wait_sec if timeout is None else timeout
+        with self.lock:
+            if self.state.count(access_code) == 0:
+                return "NOMACHINE"
+            reserved = self.state.lookup(key)
+            if reserved is not None and reserved[0] == access_code:
+                # Rescheduling the same job is idempotent.
+                return "READY"
+            if self._claim(access_code, key, affinity) is not None:
+                return "READY"
+            queue = self._queues.setdefault(access_code, WaitQueue(fair=self.fair_queue))
+            if timeout <= 0 or key in self._waiting or len(queue) >= self.max_queue_size:
+                return "BUSY"
+            waiter = Waiter(key, affinity)
+            queue.push(waiter)
+            self._waiting[key] = (access_code, waiter)
+
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if waiter.event.wait(min(remaining, self.poll_interval_sec) if self.state.shared else remaining):
+                break
+            if self.state.shared:
+                # The executors released by other kernels are not notified.
+                with self.lock:
+                    self._dispatch(access_code)
+
+        with self.lock:
+            if waiter.result is None:
+                # Timed out. The executor might be handed over right before
+                # acquiring the lock, so the result is checked again here.
+                queue.remove(waiter)
+                self._waiting.pop(key, None)
+                return "BUSY"
+            return waiter.result
+
+    def queue_status(self, access_code, history_id=None, user_id=None):
+        """
+        Report the state of the wait queue of an access code. If the job is
+        specified, its position and estimated waiting time are included.
+        """
+        with self.lock:
+            queue = self._queues.get(access_code)
+            status = {
+                "queue_length": len(queue) if queue else 0,
+                "executors": self.state.count(access_code),
+                "idle_executors": len(self.state.idle(access_code)),
+                "average_service_time_sec": self._service_time.get(access_code),
+            }
+            if history_id is None:
+                return status
+            key = job_key(history_id, user_id)
+            reserved = self.state.lookup(key)
+            waiting = self._waiting.get(key)
+            if reserved is not None and reserved[0] == access_code:
+                status["status"] = "READY"
+            elif waiting is not None and waiting[0] == access_code:
+                position = queue.position(waiting[1])
+                status["status"] = "WAITING"
+                status["position"] = position
+                status["estimated_wait_sec"] = self._estimate_wait(access_code, position)
+            else:
+                status["status"] = "UNKNOWN"
+            return status
+
+    def lookup(self, access_code, history_id, user_id):
+        """
+        Find the record reserved for the job, or None if there's no reservation.
+        """
+        with self.lock:
+            reserved = self.state.lookup(job_key(history_id, user_id))
+            if reserved is None or reserved[0] != access_code or reserved[1][STATUS] != "READY":
+                return None
+            return reserved[1]
+
+    def find_job(self, history_id, user_id):
+        """
+        Find the access code and the record serving the job.
+        """
+        with self.lock:
+            return self.state.lookup(job_key(history_id, user_id))
+
+    def occupy(self, record):
+        """
+        Mark a reserved executor as processing the job.
+        """
+        with self.lock:
+            self.state.occupy(record)
+
+    def release(self, access_code, record):
+        """
+        Clear the job of an executor and hand it to the next waiting job or
+        put it back to the idle queue. Releasing an outdated record, e.g.
+        twice for the same job, doesn't affect the job served afterwards.
+        """
+        with self.lock:
+            key = job_key(record[HISTORY_ID], record[USER_ID])
+            if self.state.release(access_code, record):
+                self._update_service_time(access_code, key)
+                self.stats.add_outstanding(record[ENDPOINT], -1)
+            self._dispatch(access_code)
+
+    def slots(self):
+        """
+        Count the executors of each access code by state, which is "idle",
+        "reserved" (scheduled but not started), "busy" or "suspended", along
+        with the length of the wait queue.
+        """
+        with self.lock:
+            suspended = self.state.suspended()
+            result = {}
+            for access_code, records in self.state.snapshot().items():
+                counts = dict.fromkeys(["idle", "reserved", "busy", "suspended"], 0)
+                for record in records:
+                    if record[STATUS] == "BUSY":
+                        counts["busy"] += 1
+                    elif str(record[HISTORY_ID]) != str(NO_JOB):
+                        counts["reserved"] += 1
+                    elif record[ENDPOINT] in suspended:
+                        counts["suspended"] += 1
+                    else:
+                        counts["idle"] += 1
+                queue = self._queues.get(access_code)
+                counts["waiting"] = len(queue) if queue else 0
+                result[access_code] = counts
+            return result
+
+    def endpoints(self):
+        """
+        Return the registered endpoints and their access codes.
+        """
+        with self.lock:
+            return self.state.endpoints()
+
+    def suspend(self, endpoint, reason=SUSPEND_MANUAL):
+        """
+        Stop scheduling jobs to an endpoint for the reason. The running jobs are not affected.
+        """
+        with self.lock:
+            self.state.suspend(endpoint, reason)
+
+    def resume(self, endpoint, reason=SUSPEND_MANUAL):
+        """
+        Lift a reason of suspending an endpoint. The endpoint is scheduled
+        again once no reason is left.
+        """
+        with self.lock:
+            for access_code in self.state.resume(endpoint, reason):
+                self._dispatch(access_code)
+
+    def _claim(self, access_code, key, affinity=None):
+        """
+        Reserve one of the idle executors for the job. Return the record or
+        None if there's no idle executor.
+        """
+        # Other kernels sharing the state might take the chosen executor
+        # first, then try again with the rest.
+        idle = self.state.idle(access_code)
+        while idle:
+            record = self.state.claim(access_code, self._choose(access_code, idle, affinity), key)
+            if record is not None:
+                self._assign(access_code, record, key, affinity)
+                return record
+            if self.state.lookup(key) is not None:
+                # The same job is reserved by another kernel at the same time
+                return None
+            idle = self.state.idle(access_code)
+        return None
+
+    def _choose(self, access_code, idle, affinity=None):
+        """
+        Choose the idle endpoint that last served the session, or the one
+        chosen by the routing policy.
+        """
+        if affinity is not None and self.affinity_table_size > 0:
+            endpoint = self._affinity.get((access_code, affinity))
+            if endpoint in idle:
+                self.affinity_hits += 1
+                return endpoint
+            if endpoint is not None:
+                # The previous executor is busy or gone.
+                self.affinity_misses += 1
+        return self.routing_policy.choose(idle, self.stats)
+
+    def _assign(self, access_code, record, key, affinity=None):
+        self._reserved_at[key] = time.monotonic()
+        self.stats.add_outstanding(record[ENDPOINT], 1)
+        if affinity is not None and self.affinity_table_size > 0:
+            self._affinity[(access_code, affinity)] = record[ENDPOINT]
+            self._affinity.move_to_end((access_code, affinity))
+            while len(self._affinity) > self.affinity_table_size:
+                self._affinity.popitem(last=False)
+        logger.info(f"Scheduled {access_code},{record[ENDPOINT]} for {key[0]},{key[1]}")
+
+    def _dispatch(self, access_code):
+        """
+        Hand the idle executors to the waiting jobs.
+        """
+        queue = self._queues.get(access_code)
+        while queue:
+            waiter = queue.peek()
+            if self.state.count(access_code) == 0:
+                waiter.result = "NOMACHINE"
+            elif self._claim(access_code, waiter.key, waiter.affinity) is not None:
+                waiter.result = "READY"
+            else:
+                return
+            queue.pop()
+            self._waiting.pop(waiter.key, None)
+            waiter.event.set()
+
+    def _update_service_time(self, access_code, key, alpha=0.2):
+        reserved_at = self._reserved_at.pop(key, None)
+        if reserved_at is None:
+            return
+        duration = time.monotonic() - reserved_at
+        average = self._service_time.get(access_code)
+        self._service_time[access_code] = duration if average is None else (1 - alpha) * average + alpha * duration
+
+    def _estimate_wait(self, access_code, position):
+        average = self._service_time.get(access_code)
+        executors = self.state.count(access_code)
+        if average is None or executors == 0:
+            return None
+        return (position // executors + 1) * average
+
+    def _forget(self, access_code, record):
+        # The job of the removed executor
+        if str(record[HISTORY_ID]) != str(NO_JOB):
+            self._reserved_at.pop(job_key(record[HISTORY_ID], record[USER_ID]), None)
+            self.stats.add_outstanding(record[ENDPOINT], -1)
@@ -0,0 +1,536 @@
+import json
+import time
+import logging
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# Fields of an executor record, which is a list of [endpoint, status, history_id, user_id]
+ENDPOINT, STATUS, HISTORY_ID, USER_ID = range(4)
+NO_JOB = -1
+
+# The reasons to suspend an endpoint. An endpoint is scheduled again once
+# every reason is lifted, so e.g. a warm executor taken from the pool stays
+# suspended while its circuit breaker is open.
+SUSPEND_MANUAL = "manual"
+SUSPEND_HEALTH = "health"
+SUSPEND_WARM = "warm"
+
+def _normalize(value):
+    try:
+        return str(int(value))
+    except (TypeError, ValueError):
+        return str(value)
+
+def job_key(history_id, user_id):
+    """
+    Normalize the identifiers of a job. The form fields are strings while
+    some callers pass integers, so both are reduced to the same key.
+    """
+    return (_normalize(history_id), _normalize(user_id))
+
+def _base_url(url):
+    parsed_url = urlparse(url)
+    return f"{parsed_url.scheme}://{parsed_url.netloc}"
+
+def _is_idle(record):
+    return record[STATUS] == "READY" and str(record[HISTORY_ID]) == str(NO_JOB) and str(record[USER_ID]) == str(NO_JOB)
+
+class MemoryStateBackend:
+    """
+    Keep the executor records in the dictionary of the process, of the shape
+    {access_code: [[endpoint, status, history_id, user_id], ...]}, with the
+    indexes to make scheduling constant time:
+        - A FIFO of idle records per access code.
+        - A (history_id, user_id) -> (access_code, record) reservation index.
+        - A (access_code, endpoint) -> record lookup table.
+        - The suspended endpoints with the reasons, which are kept registered but not scheduled.
+    The records are copy-on-write. A changed record or group of records is
+    replaced by a new list instead of being modified in place, so the
+    readers can take a snapshot without the lock and the callers holding
+    an outdated record can't change the job currently served.
+    The methods are called with the lock of the scheduler held. Every
+    mutation of the records should go through the backend or be followed
+    by rebuild() so that the indexes stay coherent.
+    Arguments:
+        records: The shared record dictionary.
+    """
+
+    shared = False
+
+    def __init__(self, records: dict):
+        self.records = records
+        self._idle = {}
+        self._reservations = {}
+        self._endpoints = {}
+        self._suspended = {}
+        self._leases = {}
+        self.rebuild()
+
+    def rebuild(self):
+        """
+        Recompute all the indexes from the records.
+        """
+        self._idle = {}
+        self._reservations = {}
+        self._endpoints = {}
+        for access_code, records in self.records.items():
+            idle = self._idle.setdefault(access_code, OrderedDict())
+            for record in records:
+                self._endpoints[(access_code, record[ENDPOINT])] = record
+                if _is_idle(record) and record[ENDPOINT] not in self._suspended:
+                    idle[record[ENDPOINT]] = record
+                elif str(record[HISTORY_ID]) != str(NO_JOB):
+                    self._reservations[job_key(record[HISTORY_ID], record[USER_ID])] = (access_code, record)
+
+    def snapshot(self):
+        """
+        A shallow copy of the records. Copying a dictionary is atomic and the
+        published lists are never modified, so it's safe without the lock.
+        """
+        return self.records.copy()
+
+    def _replace(self, access_code, old, new):
+        self.records[access_code] = [new if r is old else r for r in self.records[access_code]]
+        self._endpoints[(access_code, new[ENDPOINT])] = new
+
+    def count(self, access_code):
+        return len(self.records.get(access_code, []))
+
+    def register(self, access_code, endpoint, suspend_reason=None):
+        """
+        Add an idle executor, suspended for the reason if given.
+        """
+        if (access_code, endpoint) in self._endpoints:
+            return False
+        if suspend_reason is not None:
+            self._suspended.setdefault(endpoint, set()).add(suspend_reason)
+        record = [endpoint, "READY", NO_JOB, NO_JOB]
+        self.records[access_code] = self.records.get(access_code, []) + [record]
+        self._endpoints[(access_code, endpoint)] = record
+        if endpoint not in self._suspended:
+            self._idle.setdefault(access_code, OrderedDict())[endpoint] = record
+        return True
+
+    def is_registered(self, access_code, endpoint):
+        return (access_code, endpoint) in self._endpoints
+
+    def unregister(self, access_code, matched):
+        """
+        Remove the records of an access code whose endpoint is matched. Return the removed records.
+        """
+        if access_code not in self.records:
+            return []
+        removed = [r for r in self.records[access_code] if matched(r[ENDPOINT])]
+        if not removed:
+            return []
+        self.records[access_code] = [r for r in self.records[access_code] if not matched(r[ENDPOINT])]
+        for record in removed:
+            self._endpoints.pop((access_code, record[ENDPOINT]), None)
+            self._idle.get(access_code, {}).pop(record[ENDPOINT], None)
+            key = job_key(record[HISTORY_ID], record[USER_ID])
+            reserved = self._reservations.get(key)
+            if reserved is not None and reserved[1] is record:
+                del self._reservations[key]
+            if self._suspended and not any(e == record[ENDPOINT] for _, e in self._endpoints):
+                self._suspended.pop(record[ENDPOINT], None)
+        if self.records[access_code] == []:
+            del self.records[access_code]
+            self._idle.pop(access_code, None)
+        return removed
+
+    def idle(self, access_code):
+        """
+        The idle records of the access code keyed by the endpoint, ordered from the longest idle one.
+        """
+        return self._idle.get(access_code) or {}
+
+    def claim(self, access_code, endpoint, key):
+        """
+        Reserve an idle executor for the job. Return the record, or None if it's not idle anymore.
+        """
+        idle = self._idle.get(access_code)
+        current = idle.pop(endpoint, None) if idle else None
+        if current is None:
+            return None
+        record = [endpoint, current[STATUS], *key]
+        self._replace(access_code, current, record)
+        self._reservations[key] = (access_code, record)
+        return record
+
+    def lookup(self, key):
+        return self._reservations.get(key)
+
+    def reservations(self):
+        return list(self._reservations.values())
+
+    def occupy(self, record):
+        """
+        Mark the executor as busy if it's still reserved for the job of the record.
+        """
+        key = job_key(record[HISTORY_ID], record[USER_ID])
+        reserved = self._reservations.get(key)
+        if reserved is None or reserved[1][ENDPOINT] != record[ENDPOINT]:
+            return
+        access_code, current = reserved
+        busy = [current[ENDPOINT], "BUSY", current[HISTORY_ID], current[USER_ID]]
+        self._replace(access_code, current, busy)
+        self._reservations[key] = (access_code, busy)
+
+    def release(self, access_code, record):
+        """
+        Clear the job of an executor and put it back to the idle queue.
+        Nothing is changed if the executor serves another job already, e.g.
+        the same record is released twice. Return whether the reservation
+        was held by the record.
+        """
+        endpoint = record[ENDPOINT]
+        key = job_key(record[HISTORY_ID], record[USER_ID])
+        current = self._endpoints.get((access_code, endpoint))
+        reserved = self._reservations.get(key)
+        owned = reserved is not None and reserved[0] == access_code and reserved[1][ENDPOINT] == endpoint
+        if owned:
+            del self._reservations[key]
+        elif current is not record:
+            # Released already, or the executor was unregistered during the job
+            return False
+        if current is None:
+            return owned
+        idle = [endpoint, "READY", NO_JOB, NO_JOB]
+        self._replace(access_code, current, idle)
+        if endpoint not in self._suspended:
+            self._idle.setdefault(access_code, OrderedDict())[endpoint] = idle
+        return owned
+
+    def endpoints(self):
+        result = {}
+        for access_code, endpoint in self._endpoints.keys():
+            result.setdefault(endpoint, []).append(access_code)
+        return result
+
+    def suspended(self):
+        """
+        The suspended endpoints mapped to the reasons.
+        """
+        return self._suspended
+
+    def suspend(self, endpoint, reason):
+        self._suspended.setdefault(endpoint, set()).add(reason)
+        for idle in self._idle.values():
+            idle.pop(endpoint, None)
+
+    def resume(self, endpoint, reason):
+        """
+        Lift a reason of suspending the endpoint.
+        Return the access codes whose idle executors increased.
+        """
+        reasons = self._suspended.get(endpoint)
+        if reasons is None or reason not in reasons:
+            return []
+        reasons.discard(reason)
+        if reasons:
+            return []
+        del self._suspended[endpoint]
+        resumed = []
+        for (access_code, e), record in self._endpoints.items():
+            if e == endpoint and _is_idle(record):
+                self._idle.setdefault(access_code, OrderedDict())[endpoint] = record
+                resumed.append(access_code)
+        return resumed
+
+    def renew_lease(self, access_code, endpoint, expires_at):
+        self._leases[(access_code, endpoint)] = expires_at
+
+    def revoke_lease(self, access_code, endpoint):
+        self._leases.pop((access_code, endpoint), None)
+
+    def expire_leases(self, now):
+        """
+        Remove and return the (access_code, endpoint) of the leases expired before now.
+        """
+        expired = [k for k, expires_at in self._leases.items() if expires_at <= now]
+        for k in expired:
+            del self._leases[k]
+        return expired
+
+class RedisStateBackend:
+    """
+    Keep the executor records in a Redis server shared by several kernel
+    processes, so that they can schedule the same executors behind a load
+    balancer. The operations changing more than a key are done in
+    WATCH/MULTI/EXEC transactions, which are retried on conflicts, so an
+    executor is never reserved by two kernels.
+    The keys, under the prefix:
+        access_codes: The set of the registered access codes.
+        executors:<access code>: The hash of endpoint -> [status, history_id, user_id].
+        idle:<access code>: The sorted set of the idle endpoints scored by the time they became idle.
+        job:<history_id>:<user_id>: The [access_code, endpoint] reserved for a job.
+        suspensions: The hash of suspended endpoint -> [reasons].
+        leases: The sorted set of [access_code, endpoint] scored by the expiration time.
+    Arguments:
+        url: The URL of the Redis server, e.g. redis://localhost:6379/0.
+        prefix: The prefix of the keys.
+    """
+
+    shared = True
+
+    def __init__(self, url, prefix="kuwa:kernel:"):
+        try:
+            import redis
+        except ImportError as e:
+            raise ImportError("The Redis state backend requires the redis package. Install it with \"pip install kuwa-kernel[redis]\".") from e
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+
+    def _access_codes(self):
+        return f"{self.prefix}access_codes"
+
+    def _executors(self, access_code):
+        return f"{self.prefix}executors:{access_code}"
+
+    def _idle(self, access_code):
+        return f"{self.prefix}idle:{access_code}"
+
+    def _job(self, key):
+        return f"{self.prefix}job:{key[0]}:{key[1]}"
+
+    def _suspended(self):
+        return f"{self.prefix}suspensions"
+
+    def _leases(self):
+        return f"{self.prefix}leases"
+
+    def _transaction(self, func, *watches):
+        return self.client.transaction(func, *watches, value_from_callable=True)
+
+    def rebuild(self):
+        """
+        Repair the idle indexes from the records, e.g. after a kernel crashed during a transaction.
+        """
+        suspended = self.suspended()
+        for access_code, records in self.snapshot().items():
+            def repair(pipe):
+                idle = set(pipe.zrange(self._idle(access_code), 0, -1))
+                pipe.multi()
+                for record in records:
+                    if _is_idle(record) and record[ENDPOINT] not in suspended and record[ENDPOINT] not in idle:
+                        pipe.zadd(self._idle(access_code), {record[ENDPOINT]: time.time()})
+                ghosts = idle - {r[ENDPOINT] for r in records if _is_idle(r)}
+                if ghosts:
+                    pipe.zrem(self._idle(access_code), *ghosts)
+            self._transaction(repair, self._idle(access_code))
+
+    def snapshot(self):
+        result = {}
+        for access_code in sorted(self.client.smembers(self._access_codes())):
+            executors = self.client.hgetall(self._executors(access_code))
+            if executors:
+                result[access_code] = [[e, *json.loads(v)] for e, v in executors.items()]
+        return result
+
+    def count(self, access_code):
+        return self.client.hlen(self._executors(access_code))
+
+    def register(self, access_code, endpoint, suspend_reason=None):
+        def register(pipe):
+            if pipe.hexists(self._executors(access_code), endpoint):
+                return False
+            reasons = json.loads(pipe.hget(self._suspended(), endpoint) or "[]")
+            pipe.multi()
+            if suspend_reason is not None and suspend_reason not in reasons:
+                reasons.append(suspend_reason)
+                pipe.hset(self._suspended(), endpoint, json.dumps(reasons))
+            pipe.sadd(self._access_codes(), access_code)
+            pipe.hset(self._executors(access_code), endpoint, json.dumps(["READY", NO_JOB, NO_JOB]))
+            if not reasons:
+                pipe.zadd(self._idle(access_code), {endpoint: time.time()})
+            return True
+        return self._transaction(register, self._executors(access_code), self._suspended())
+
+    def is_registered(self, access_code, endpoint):
+        return bool(self.client.hexists(self._executors(access_code), endpoint))
+
+    def unregister(self, access_code, matched):
+        def unregister(pipe):
+            executors = pipe.hgetall(self._executors(access_code))
+            removed = [[e, *json.loads(v)] for e, v in executors.items() if matched(e)]
+            if not removed:
+                return []
+            endpoints = [r[ENDPOINT] for r in removed]
+            jobs = {
+                self._job(job_key(r[HISTORY_ID], r[USER_ID])): r[ENDPOINT]
+                for r in removed if str(r[HISTORY_ID]) != str(NO_JOB)
+            }
+            if jobs:
+                pipe.watch(*jobs.keys())
+            owned_jobs = [k for k, e in jobs.items() if json.loads(pipe.get(k) or "null") == [access_code, e]]
+            # Forget the suspension of the endpoints not registered with other access codes
+            other_access_codes = [a for a in pipe.smembers(self._access_codes()) if a != access_code]
+            unshared = [e for e in endpoints if not any(pipe.hexists(self._executors(a), e) for a in other_access_codes)]
+            pipe.multi()
+            pipe.hdel(self._executors(access_code), *endpoints)
+            pipe.zrem(self._idle(access_code), *endpoints)
+            if owned_jobs:
+                pipe.delete(*owned_jobs)
+            if unshared:
+                pipe.hdel(self._suspended(), *unshared)
+            if len(removed) == len(executors):
+                pipe.srem(self._access_codes(), access_code)
+            return removed
+        return self._transaction(unregister, self._executors(access_code), self._access_codes())
+
+    def idle(self, access_code):
+        return OrderedDict.fromkeys(self.client.zrange(self._idle(access_code), 0, -1))
+
+    def claim(self, access_code, endpoint, key):
+        def claim(pipe):
+            if pipe.zscore(self._idle(access_code), endpoint) is None:
+                # Taken by another kernel
+                return None
+            if pipe.exists(self._job(key)):
+                return None
+            registered = pipe.hexists(self._executors(access_code), endpoint)
+            suspended = pipe.hexists(self._suspended(), endpoint)
+            pipe.multi()
+            pipe.zrem(self._idle(access_code), endpoint)
+            if not registered or suspended:
+                return None
+            pipe.hset(self._executors(access_code), endpoint, json.dumps(["READY", key[0], key[1]]))
+            pipe.set(self._job(key), json.dumps([access_code, endpoint]))
+            return [endpoint, "READY", key[0], key[1]]
+        return self._transaction(
+            claim, self._idle(access_code), self._executors(access_code), self._job(key), self._suspended()
+        )
+
+    def lookup(self, key):
+        job = self.client.get(self._job(key))
+        if job is None:
+            return None
+        access_code, endpoint = json.loads(job)
+        executor = self.client.hget(self._executors(access_code), endpoint)
+        if executor is None:
+            return None
+        record = [endpoint, *json.loads(executor)]
+        if job_key(record[HISTORY_ID], record[USER_ID]) != key:
+            return None
+        return access_code, record
+
+    def reservations(self):
+        return [
+            (access_code, record)
+            for access_code, records in self.snapshot().items()
+            for record in records
+            if str(record[HISTORY_ID]) != str(NO_JOB)
+        ]
+
+    def occupy(self, record):
+        key = job_key(record[HISTORY_ID], record[USER_ID])
+        def occupy(pipe):
+            job = pipe.get(self._job(key))
+            if job is None:
+                return
+            access_code, endpoint = json.loads(job)
+            pipe.watch(self._executors(access_code))
+            executor = pipe.hget(self._executors(access_code), endpoint)
+            if executor is None or job_key(*json.loads(executor)[1:]) != key:
+                return
+            pipe.multi()
+            pipe.hset(self._executors(access_code), endpoint, json.dumps(["BUSY", key[0], key[1]]))
+        self._transaction(occupy, self._job(key))
+
+    def release(self, access_code, record):
+        key = job_key(record[HISTORY_ID], record[USER_ID])
+        endpoint = record[ENDPOINT]
+        def release(pipe):
+            job = pipe.get(self._job(key))
+            owned = job is not None and json.loads(job) == [access_code, endpoint]
+            executor = pipe.hget(self._executors(access_code), endpoint)
+            # The executor might be unregistered or serving another job already.
+            serving = executor is not None and job_key(*json.loads(executor)[1:]) == key
+            suspended = pipe.hexists(self._suspended(), endpoint)
+            pipe.multi()
+            if owned:
+                pipe.delete(self._job(key))
+            if serving:
+                pipe.hset(self._executors(access_code), endpoint, json.dumps(["READY", NO_JOB, NO_JOB]))
+                if not suspended:
+                    pipe.zadd(self._idle(access_code), {endpoint: time.time()})
+            return owned
+        return self._transaction(release, self._job(key), self._executors(access_code), self._suspended())
+
+    def endpoints(self):
+        result = {}
+        for access_code in self.client.smembers(self._access_codes()):
+            for endpoint in self.client.hkeys(self._executors(access_code)):
+                result.setdefault(endpoint, []).append(access_code)
+        return result
+
+    def suspended(self):
+        return {e: set(json.loads(v)) for e, v in self.client.hgetall(self._suspended()).items()}
+
+    def suspend(self, endpoint, reason):
+        def suspend(pipe):
+            reasons = json.loads(pipe.hget(self._suspended(), endpoint) or "[]")
+            pipe.multi()
+            pipe.hset(self._suspended(), endpoint, json.dumps(sorted({*reasons, reason})))
+        self._transaction(suspend, self._suspended())
+        for access_code in self.client.smembers(self._access_codes()):
+            self.client.zrem(self._idle(access_code), endpoint)
+
+    def resume(self, endpoint, reason):
+        def lift(pipe):
+            reasons = json.loads(pipe.hget(self._suspended(), endpoint) or "null")
+            if reasons is None or reason not in reasons:
+                return False
+            reasons.remove(reason)
+            pipe.multi()
+            if reasons:
+                pipe.hset(self._suspended(), endpoint, json.dumps(reasons))
+            else:
+                pipe.hdel(self._suspended(), endpoint)
+            return not reasons
+        if not self._transaction(lift, self._suspended()):
+            return []
+        resumed = []
+        for access_code in self.client.smembers(self._access_codes()):
+            def resume(pipe):
+                executor = pipe.hget(self._executors(access_code), endpoint)
+                if executor is None or not _is_idle([endpoint, *json.loads(executor)]):
+                    return False
+                pipe.multi()
+                pipe.zadd(self._idle(access_code), {endpoint: time.time()})
+                return True
+            if self._transaction(resume, self._executors(access_code)):
+                resumed.append(access_code)
+        return resumed
+
+    def renew_lease(self, access_code, endpoint, expires_at):
+        self.client.zadd(self._leases(), {json.dumps([access_code, endpoint]): expires_at})
+
+    def revoke_lease(self, access_code, endpoint):
+        self.client.zrem(self._leases(), json.dumps([access_code, endpoint]))
+
+    def expire_leases(self, now):
+        # Only the kernel removing a lease reports it, so it's unregistered once.
+        return [
+            tuple(json.loads(lease))
+            for lease in self.client.zrangebyscore(self._leases(), "-inf", now)
+            if self.client.zrem(self._leases(), lease)
+        ]
+
+STATE_BACKENDS = {
+    "redis": RedisStateBackend,
+    "rediss": RedisStateBackend,
+}
+
+def create_state_backend(url, records):
+    """
+    Create the state backend from its URL, which is "memory" or redis://host:port/db.
+    """
+    if url == "memory":
+        return MemoryStateBackend(records)
+    scheme = urlparse(url).scheme
+    if scheme not in STATE_BACKENDS:
+        raise ValueError(f"Unsupported state backend: {url}")
+    return STATE_BACKENDS[scheme](url)
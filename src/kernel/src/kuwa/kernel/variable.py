@@ -1,10 +1,44 @@
 import os
+import prometheus_client
+from .scheduler import ExecutorScheduler
+from .journal import RecordJournal
+from .metrics import KernelMetrics, SchedulerCollector
+from .coalescer import StreamCoalescer
+from .response_cache import ResponseCache
+from .launcher import ExecutorLauncher
+from .downloader import RateLimiter
+from .inventory import ModelInventory
+from .channel import ChannelRegistry
+from .lease import LeaseTable
 
 download_jobs = {}
 data = {}
+scheduler = ExecutorScheduler(data)
+kernel_metrics = KernelMetrics(is_registered=scheduler.has_executors)
+prometheus_client.REGISTRY.register(SchedulerCollector(scheduler))
 record_file = "records.pickle"
+journal_file = "records.journal"
+record_journal = RecordJournal(record_file, journal_file)
+record_compaction_interval_sec = 60
+health_check_interval_sec = 10
+abort_timeout_sec = 3
+completion_coalescer = StreamCoalescer()
+response_cache = ResponseCache()
+executor_launcher = ExecutorLauncher(scheduler)
+executor_leases = LeaseTable(scheduler, record_journal, kernel_metrics)
+lease_check_interval_sec = 1
+executor_channels = ChannelRegistry(scheduler, executor_leases)
+download_max_workers = 8
+download_rate_limiter = RateLimiter()
+model_inventory = ModelInventory(
+    os.path.join(os.path.expanduser("~"), ".cache", "huggingface", "hub"),
+    usage_file="model_usage.json"
+)
+model_inventory_scan_interval_sec = 300
 
 # Set following environment variable before importing the Safety Guard client
 os.environ['SAFETY_GUARD_MANAGER_URL'] = 'http://localhost:8000'
 os.environ['SAFETY_GUARD_DETECTOR_URL'] = 'grpc://localhost:50051'
-safety_guard_update_interval_sec = 30
\ No newline at end of file
+safety_guard_update_interval_sec = 30
+safety_guard_pool_size = 8
+safety_guard_check_mode = "inline"
\ No newline at end of file
@@ -0,0 +1,43 @@
+import time
+import asyncio
+import unittest
+import logging
+from aiohttp import web
+from kuwa.kernel.functions import abort_all
+
+
+class TestAbortAll(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        async def abort(request):
+            return web.json_response({"msg": "Aborted"})
+        async def slow_abort(request):
+            await asyncio.sleep(2)
+            return web.json_response({"msg": "Aborted"})
+        app = web.Application()
+        app.router.add_get("/chat/abort", abort)
+        app.router.add_get("/slow/abort", slow_abort)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.base_url = f"http://127.0.0.1:{port}"
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+
+    async def test_abort_all(self):
+        endpoints = [f"{self.base_url}/chat", f"{self.base_url}/slow", f"{self.base_url}/missing"]
+        start_time = time.monotonic()
+        results = await abort_all(endpoints, timeout=0.5)
+        self.assertLess(time.monotonic() - start_time, 2)
+        self.assertEqual(results, {
+            f"{self.base_url}/chat": "aborted",
+            f"{self.base_url}/slow": "timeout",
+            f"{self.base_url}/missing": "failed",
+        })
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
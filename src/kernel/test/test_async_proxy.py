@@ -0,0 +1,117 @@
+import os
+import time
+import asyncio
+import tempfile
+import unittest
+import logging
+from urllib.parse import urlencode
+from aiohttp import web
+from flask import Flask
+from kuwa.kernel.variable import scheduler, record_journal
+from kuwa.kernel.async_proxy import AsyncCompletionsProxy
+
+
+class TestAsyncCompletionsProxy(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        async def chat(request):
+            response = web.StreamResponse()
+            await response.prepare(request)
+            for chunk in [b"data: a\n", b"data: b\n"]:
+                await response.write(chunk)
+            return response
+        async def slow_chat(request):
+            response = web.StreamResponse()
+            await response.prepare(request)
+            for _ in range(20):
+                await response.write(b"data: a\n")
+                await asyncio.sleep(0.1)
+            return response
+        app = web.Application()
+        app.router.add_post("/chat", chat)
+        app.router.add_post("/slow", slow_chat)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.base_url = f"http://127.0.0.1:{port}"
+
+        self.endpoints = []
+        self.temp_dir = tempfile.TemporaryDirectory()
+        record_journal.journal_file = os.path.join(self.temp_dir.name, "records.journal")
+        self.proxy = AsyncCompletionsProxy(Flask(__name__), completions_path="/v1.0/chat/completions")
+        self.proxy.relay_natively = True
+
+    async def asyncTearDown(self):
+        for endpoint in self.endpoints:
+            scheduler.unregister("model", endpoint=endpoint)
+        record_journal.close()
+        if self.proxy.session is not None:
+            await self.proxy.session.close()
+        await self.runner.cleanup()
+        self.temp_dir.cleanup()
+
+    async def request(self, form, disconnect_after_body=False):
+        """
+        Send a completion request to the proxy and collect the sent messages.
+        """
+        messages = []
+        requested = asyncio.Event()
+        disconnected = asyncio.Event()
+        async def receive():
+            if not requested.is_set():
+                requested.set()
+                return {"type": "http.request", "body": urlencode(form).encode("utf-8"), "more_body": False}
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+        async def send(message):
+            messages.append(message)
+            if disconnect_after_body and message["type"] == "http.response.body":
+                disconnected.set()
+        scope = {
+            "type": "http",
+            "method": "POST",
+            "path": "/v1.0/chat/completions",
+            "headers": [(b"content-type", b"application/x-www-form-urlencoded")],
+        }
+        await asyncio.wait_for(self.proxy(scope, receive, send), timeout=5)
+        return messages
+
+    def reserve(self, endpoint):
+        scheduler.register("model", endpoint)
+        self.endpoints.append(endpoint)
+        self.assertEqual(scheduler.reserve("model", 1, 1), "READY")
+        return {"name": "model", "input": "[]", "history_id": 1, "user_id": 1}
+
+    async def test_relay(self):
+        form = self.reserve(f"{self.base_url}/chat")
+        messages = await self.request(form)
+        self.assertEqual(messages[0]["status"], 200)
+        self.assertEqual(b"".join(m.get("body", b"") for m in messages[1:]), b"data: a\ndata: b\n")
+        self.assertIsNone(scheduler.find_job(1, 1))
+
+    async def test_client_disconnect(self):
+        form = self.reserve(f"{self.base_url}/slow")
+        start_time = time.monotonic()
+        await self.request(form, disconnect_after_body=True)
+        # Stopped without waiting for the rest of the stream
+        self.assertLess(time.monotonic() - start_time, 1)
+        self.assertIsNone(scheduler.find_job(1, 1))
+        self.assertEqual(scheduler.reserve("model", 2, 2), "READY")
+
+    async def test_connection_error(self):
+        # Nothing is listening on the port of a stopped server
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        endpoint = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/chat"
+        await site.stop()
+        form = self.reserve(endpoint)
+        messages = await self.request(form)
+        self.assertEqual(b"".join(m.get("body", b"") for m in messages[1:]), b"")
+        self.assertIsNone(scheduler.find_job(1, 1))
+        self.assertEqual(scheduler.reserve("model", 2, 2), "NOMACHINE")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
@@ -0,0 +1,118 @@
+import json
+import asyncio
+import unittest
+import logging
+from kuwa.kernel.scheduler import ExecutorScheduler
+from kuwa.kernel.channel import ChannelRegistry, ChannelClosedError, is_channel_endpoint
+
+
+class FakeWebSocket:
+    """
+    The ASGI receive and send functions of a WebSocket connection.
+    """
+
+    def __init__(self):
+        self.incoming = asyncio.Queue()
+        self.outgoing = asyncio.Queue()
+        self.incoming.put_nowait({"type": "websocket.connect"})
+
+    async def receive(self):
+        return await self.incoming.get()
+
+    async def send(self, message):
+        await self.outgoing.put(message)
+
+    def push(self, message):
+        self.incoming.put_nowait({"type": "websocket.receive", "text": json.dumps(message)})
+
+    async def pop(self):
+        message = await asyncio.wait_for(self.outgoing.get(), timeout=5)
+        return json.loads(message["text"]) if "text" in message else message
+
+
+class TestChannelRegistry(unittest.TestCase):
+    def setUp(self):
+        self.data = {}
+        self.scheduler = ExecutorScheduler(self.data)
+        self.registry = ChannelRegistry(self.scheduler)
+
+    async def connect(self):
+        websocket = FakeWebSocket()
+        server = asyncio.create_task(self.registry.serve({"type": "websocket"}, websocket.receive, websocket.send))
+        self.assertEqual((await websocket.pop())["type"], "websocket.accept")
+        websocket.push({"type": "register", "access_codes": ["model"]})
+        registered = await websocket.pop()
+        self.assertEqual(registered["type"], "registered")
+        return websocket, server, registered["endpoint"]
+
+    def test_register_and_close(self):
+        async def run():
+            websocket, server, endpoint = await self.connect()
+            self.assertTrue(is_channel_endpoint(endpoint))
+            self.assertEqual(self.data["model"], [[endpoint, "READY", -1, -1]])
+            self.assertIsNotNone(self.registry.get(endpoint))
+
+            websocket.incoming.put_nowait({"type": "websocket.disconnect"})
+            await server
+            self.assertNotIn("model", self.data)
+            self.assertIsNone(self.registry.get(endpoint))
+        asyncio.run(run())
+
+    def test_stream(self):
+        async def run():
+            websocket, server, endpoint = await self.connect()
+            channel = self.registry.get(endpoint)
+            chunks = []
+            async def consume():
+                async for c in channel.stream({"name": "model"}, {}):
+                    chunks.append(c)
+            consumer = asyncio.create_task(consume())
+            request = await websocket.pop()
+            self.assertEqual(request["type"], "request")
+            self.assertEqual(request["form"], {"name": "model"})
+            websocket.push({"type": "chunk", "request_id": request["request_id"], "data": "data: a\n"})
+            websocket.push({"type": "chunk", "request_id": request["request_id"], "data": "data: b\n"})
+            websocket.push({"type": "end", "request_id": request["request_id"]})
+            await asyncio.wait_for(consumer, timeout=5)
+            self.assertEqual(chunks, ["data: a\n", "data: b\n"])
+
+            websocket.incoming.put_nowait({"type": "websocket.disconnect"})
+            await server
+        asyncio.run(run())
+
+    def test_stream_sync_on_close(self):
+        async def run():
+            websocket, server, endpoint = await self.connect()
+            channel = self.registry.get(endpoint)
+            def consume():
+                return list(channel.stream_sync({"name": "model"}, {}))
+            consumer = asyncio.get_running_loop().run_in_executor(None, consume)
+            request = await websocket.pop()
+            websocket.push({"type": "chunk", "request_id": request["request_id"], "data": "data: a\n"})
+            websocket.incoming.put_nowait({"type": "websocket.disconnect"})
+            await server
+            with self.assertRaises(ChannelClosedError):
+                await asyncio.wait_for(consumer, timeout=5)
+        asyncio.run(run())
+
+    def test_cancel(self):
+        async def run():
+            websocket, server, endpoint = await self.connect()
+            channel = self.registry.get(endpoint)
+            stream = channel.stream({"name": "model"}, {})
+            consumer = asyncio.create_task(stream.__anext__())
+            request = await websocket.pop()
+            websocket.push({"type": "chunk", "request_id": request["request_id"], "data": "data: a\n"})
+            self.assertEqual(await asyncio.wait_for(consumer, timeout=5), "data: a\n")
+            # The client left before the end of the stream
+            await stream.aclose()
+            self.assertEqual(await websocket.pop(), {"type": "cancel", "request_id": request["request_id"]})
+
+            websocket.incoming.put_nowait({"type": "websocket.disconnect"})
+            await server
+        asyncio.run(run())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
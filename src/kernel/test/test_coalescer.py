@@ -0,0 +1,60 @@
+import time
+import unittest
+import logging
+import threading
+from kuwa.kernel.coalescer import StreamCoalescer
+
+
+class TestStreamCoalescer(unittest.TestCase):
+    def setUp(self):
+        self.coalescer = StreamCoalescer(enabled=True)
+        self.form = {"name": "model", "input": '[{"msg": "Hi", "isbot": false}]', "user_id": "1"}
+
+    def test_digest(self):
+        other_user = dict(self.form, user_id="2", history_id="3")
+        self.assertEqual(self.coalescer.digest(self.form), self.coalescer.digest(other_user))
+        self.assertNotEqual(self.coalescer.digest(self.form), self.coalescer.digest(dict(self.form, modelfile="[]")))
+        self.assertNotEqual(self.coalescer.digest(self.form), self.coalescer.digest(dict(self.form, name="other")))
+
+    def test_replay(self):
+        key = self.coalescer.digest(self.form)
+        stream, leader = self.coalescer.join(key)
+        self.assertTrue(leader)
+        first = stream.replay()
+        stream.append("a")
+        stream.append("b")
+
+        follower_stream, leader = self.coalescer.join(key)
+        self.assertFalse(leader)
+        self.assertIs(follower_stream, stream)
+        results = []
+        follower = threading.Thread(target=lambda: results.extend(follower_stream.replay()))
+        follower.start()
+        time.sleep(0.1)
+        stream.append("c")
+        self.coalescer.finish(key, stream)
+        follower.join(timeout=5)
+
+        self.assertEqual(results, ["a", "b", "c"])
+        self.assertEqual(list(first), ["a", "b", "c"])
+        self.assertEqual(self.coalescer.inflight(), 0)
+        self.assertTrue(self.coalescer.join(key)[1])
+
+    def test_all_subscribers_left(self):
+        stream, _ = self.coalescer.join("key")
+        replay = stream.replay()
+        self.assertTrue(stream.append("a"))
+        self.assertEqual(next(replay), "a")
+        replay.close()
+        self.assertFalse(stream.append("b"))
+
+    def test_closed_before_start(self):
+        stream, _ = self.coalescer.join("key")
+        stream.replay().close()
+        self.assertEqual(stream.subscribers, 0)
+        self.assertFalse(stream.append("a"))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
@@ -0,0 +1,132 @@
+import os
+import time
+import tempfile
+import unittest
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from kuwa.kernel.downloader import DownloadJob, RateLimiter
+
+FILES = {"config.json": b"{}" * 10, "model.bin": bytes(range(256)) * 64}
+COMMIT = "0" * 40
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    ranges = []
+
+    def do_GET(self):
+        content = FILES[self.path.lstrip("/")]
+        start = 0
+        if "Range" in self.headers:
+            start = int(self.headers["Range"].split("=")[1].rstrip("-"))
+            FileHandler.ranges.append(start)
+        if start >= len(content):
+            self.send_response(416)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(206 if start else 200)
+        self.send_header("Content-Length", str(len(content) - start))
+        self.end_headers()
+        self.wfile.write(content[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeDownloadJob(DownloadJob):
+    def __init__(self, base_url, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.base_url = base_url
+
+    def list_files(self):
+        return COMMIT, [(name, len(content)) for name, content in FILES.items()]
+
+    def file_location(self, commit, filename):
+        return f"{self.base_url}/{filename}", f"etag-{filename}"
+
+
+class TestDownloadJob(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), FileHandler)
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_port}"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.job = FakeDownloadJob(self.base_url, "org/model", self.tmp_dir.name, max_workers=2, progress_interval_sec=0)
+        FileHandler.ranges = []
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def events(self):
+        events = []
+        while (event := self.job.events.get(timeout=5)) is not None:
+            events.append(event)
+        return events
+
+    def test_download(self):
+        self.job.run()
+        self.assertEqual(self.job.state, "complete")
+        self.assertEqual(self.job.downloaded_bytes, sum(len(c) for c in FILES.values()))
+        snapshot = os.path.join(self.tmp_dir.name, "models--org--model", "snapshots", COMMIT)
+        for name, content in FILES.items():
+            with open(os.path.join(snapshot, name), "rb") as f:
+                self.assertEqual(f.read(), content)
+        with open(os.path.join(self.tmp_dir.name, "models--org--model", "refs", "main")) as f:
+            self.assertEqual(f.read(), COMMIT)
+        events = self.events()
+        self.assertTrue(any(e.startswith("Progress: ") for e in events))
+        self.assertTrue(events[-1].startswith("Model downloaded"))
+
+    def test_resume(self):
+        blobs = os.path.join(self.tmp_dir.name, "models--org--model", "blobs")
+        os.makedirs(blobs)
+        with open(os.path.join(blobs, "etag-model.bin.incomplete"), "wb") as f:
+            f.write(FILES["model.bin"][:1000])
+        self.job.run()
+        self.assertEqual(self.job.state, "complete")
+        self.assertEqual(FileHandler.ranges, [1000])
+        with open(os.path.join(blobs, "etag-model.bin"), "rb") as f:
+            self.assertEqual(f.read(), FILES["model.bin"])
+
+    def test_resume_complete(self):
+        blobs = os.path.join(self.tmp_dir.name, "models--org--model", "blobs")
+        os.makedirs(blobs)
+        with open(os.path.join(blobs, "etag-model.bin.incomplete"), "wb") as f:
+            f.write(FILES["model.bin"])
+        with open(os.path.join(blobs, "etag-config.json.incomplete"), "wb") as f:
+            f.write(FILES["config.json"] * 2)
+        self.job.run()
+        self.assertEqual(self.job.state, "complete")
+        self.assertEqual(sorted(FileHandler.ranges), sorted([len(FILES["model.bin"]), len(FILES["config.json"]) * 2]))
+        for name, content in FILES.items():
+            with open(os.path.join(blobs, f"etag-{name}"), "rb") as f:
+                self.assertEqual(f.read(), content)
+        self.assertEqual(self.job.downloaded_bytes, sum(len(c) for c in FILES.values()))
+
+    def test_stop(self):
+        self.job.stop()
+        self.job.run()
+        self.assertEqual(self.job.state, "aborted")
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir.name, "models--org--model", "refs")))
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_consume(self):
+        limiter = RateLimiter(bytes_per_sec=1000)
+        start_time = time.monotonic()
+        for _ in range(5):
+            limiter.consume(100)
+        self.assertGreaterEqual(time.monotonic() - start_time, 0.4)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+import logging
+from kuwa.kernel.scheduler import ExecutorScheduler
+from kuwa.kernel.health_monitor import HealthMonitor
+
+
+class FakeHealthMonitor(HealthMonitor):
+    def __init__(self, scheduler, **kwargs):
+        super().__init__(scheduler, **kwargs)
+        self.results = {}
+
+    async def probe(self, endpoint, session):
+        return self.results[endpoint]
+
+
+class TestHealthMonitor(unittest.TestCase):
+    endpoint = "http://127.0.0.1:8000/chat"
+
+    def setUp(self):
+        self.data = {}
+        self.scheduler = ExecutorScheduler(self.data)
+        self.scheduler.register("model", self.endpoint)
+        self.monitor = FakeHealthMonitor(
+            self.scheduler,
+            slow_threshold_sec=1,
+            failure_threshold=2,
+            recovery_threshold=2,
+            latency_smoothing=0.5,
+        )
+
+    def probe(self, healthy, latency=0.1, histogram=None):
+        self.monitor.results[self.endpoint] = (healthy, latency, histogram)
+        self.monitor.run_once()
+        return self.monitor.status()[self.endpoint]["state"]
+
+    def test_circuit(self):
+        self.assertEqual(self.probe(True), "healthy")
+        self.assertEqual(self.probe(False), "healthy")
+        self.assertEqual(self.probe(False), "open")
+        self.assertEqual(self.scheduler.reserve("model", "1", "1"), "BUSY")
+        self.assertEqual(self.probe(True), "open")
+        self.assertEqual(self.probe(True), "healthy")
+        self.assertEqual(self.scheduler.reserve("model", "1", "1"), "READY")
+
+    def test_latency(self):
+        self.assertEqual(self.probe(True, latency=0.5), "healthy")
+        self.assertEqual(self.probe(True, latency=2.5), "degraded")
+        self.assertAlmostEqual(self.monitor.latency(self.endpoint), 1.5)
+        self.assertEqual(self.scheduler.reserve("model", "1", "1"), "READY")
+
+    def test_scraped_latency(self):
+        self.probe(True, latency=0.5, histogram=(10.0, 5))
+        # Routed by the probe latency until the time to the first chunk is observed
+        self.assertAlmostEqual(self.scheduler.stats.latency(self.endpoint), 0.5)
+        self.probe(True, histogram=(16.0, 7))
+        self.assertAlmostEqual(self.scheduler.stats.latency(self.endpoint), 3.0)
+        # The executor restarted
+        self.probe(True, histogram=(1.0, 1))
+        self.assertAlmostEqual(self.scheduler.stats.latency(self.endpoint), 3.0)
+
+    def test_remove(self):
+        self.monitor.remove_after_sec = 0
+        self.probe(False)
+        self.probe(False)
+        self.monitor.run_once()
+        self.assertEqual(self.data, {})
+        self.assertEqual(self.monitor.status(), {})
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import time
+import tempfile
+import unittest
+import logging
+from kuwa.kernel.inventory import ModelInventory
+
+
+class TestModelInventory(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp_dir.name, "hub")
+        self.usage_file = os.path.join(self.tmp_dir.name, "model_usage.json")
+        self.inventory = ModelInventory(self.cache_dir, usage_file=self.usage_file)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def create_model(self, name, size):
+        path = os.path.join(self.cache_dir, name)
+        os.makedirs(os.path.join(path, "blobs"))
+        os.makedirs(os.path.join(path, "snapshots", "abc"))
+        os.makedirs(os.path.join(path, "refs"))
+        with open(os.path.join(path, "blobs", "etag"), "wb") as f:
+            f.write(b"0" * size)
+        os.symlink(os.path.join("..", "..", "blobs", "etag"), os.path.join(path, "snapshots", "abc", "model.bin"))
+        with open(os.path.join(path, "refs", "main"), "w") as f:
+            f.write("abc")
+
+    def test_scan(self):
+        self.assertEqual(self.inventory.list(), [])
+        self.create_model("models--a--b", 100)
+        self.assertEqual(self.inventory.list(), [])
+        self.inventory.scan()
+        [model] = self.inventory.list()
+        self.assertEqual(model["name"], "models--a--b")
+        # The blob and the ref
+        self.assertEqual(model["size_bytes"], 100 + len("abc"))
+        self.assertEqual(model["revision"], "abc")
+
+    def test_refresh_and_forget(self):
+        self.inventory.scan()
+        self.create_model("models--a--b", 100)
+        self.inventory.refresh("models--a--b")
+        self.assertEqual(len(self.inventory.list()), 1)
+        self.inventory.forget("models--a--b")
+        self.assertEqual(self.inventory.list(), [])
+
+    def test_prune(self):
+        for name in ["models--a--old", "models--a--used", "models--a--new"]:
+            self.create_model(name, 100)
+        self.inventory.scan()
+        self.inventory.touch("models--a--used")
+        self.assertGreater(ModelInventory(self.cache_dir, usage_file=self.usage_file)._last_used["models--a--used"], 0)
+        time.sleep(0.01)
+        self.inventory.touch("models--a--new")
+
+        removed = self.inventory.prune(150, dry_run=True)
+        self.assertEqual([m["name"] for m in removed], ["models--a--old", "models--a--used"])
+        self.assertEqual(len(self.inventory.list()), 3)
+
+        removed = self.inventory.prune(150, keep={"models--a--old"})
+        self.assertEqual([m["name"] for m in removed], ["models--a--used", "models--a--new"])
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ["models--a--old"])
+        self.assertEqual([m["name"] for m in self.inventory.list()], ["models--a--old"])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
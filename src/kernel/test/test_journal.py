@@ -0,0 +1,76 @@
+import os
+import unittest
+import logging
+import tempfile
+from kuwa.kernel.journal import RecordJournal
+
+
+class TestRecordJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.snapshot_file = os.path.join(self.tmp_dir.name, "records.pickle")
+        self.journal_file = os.path.join(self.tmp_dir.name, "records.journal")
+        self.journal = RecordJournal(self.snapshot_file, self.journal_file)
+
+    def tearDown(self):
+        self.journal.close()
+        self.tmp_dir.cleanup()
+
+    def reopen(self):
+        self.journal.close()
+        return RecordJournal(self.snapshot_file, self.journal_file)
+
+    def test_replay(self):
+        self.journal.register("a", "http://127.0.0.1:8000/chat")
+        self.journal.register("a", "http://127.0.0.1:8001/chat")
+        self.journal.register("a", "http://127.0.0.1:8001/chat")
+        self.journal.register("b", "http://127.0.0.1:8002/chat")
+        self.journal.unregister("a", base_url="http://127.0.0.1:8000")
+        self.journal.unregister("b", endpoint="http://127.0.0.1:8002/chat")
+        self.assertEqual(
+            self.reopen().load(),
+            {"a": [["http://127.0.0.1:8001/chat", "READY", -1, -1]]},
+        )
+
+    def test_broken_entry(self):
+        self.journal.register("a", "http://127.0.0.1:8000/chat")
+        self.journal.close()
+        with open(self.journal_file, "a") as f:
+            f.write('{"op": "regis')
+        self.assertEqual(
+            self.reopen().load(),
+            {"a": [["http://127.0.0.1:8000/chat", "READY", -1, -1]]},
+        )
+
+    def test_compact(self):
+        records = {"a": [["http://127.0.0.1:8000/chat", "BUSY", "1", "1"]]}
+        self.journal.register("a", "http://127.0.0.1:8000/chat")
+        self.journal.compact(records)
+        self.assertEqual(self.journal.pending_events, 0)
+        self.assertFalse(os.path.exists(self.journal_file))
+        self.journal.register("b", "http://127.0.0.1:8001/chat")
+        self.assertEqual(
+            self.reopen().load(),
+            {
+                "a": [["http://127.0.0.1:8000/chat", "BUSY", "1", "1"]],
+                "b": [["http://127.0.0.1:8001/chat", "READY", -1, -1]],
+            },
+        )
+
+    def test_interrupted_compaction(self):
+        self.journal.register("a", "http://127.0.0.1:8000/chat")
+        self.journal.close()
+        os.replace(self.journal_file, self.journal.rotated_journal_file)
+        self.journal.register("b", "http://127.0.0.1:8001/chat")
+        self.assertEqual(
+            self.reopen().load(),
+            {
+                "a": [["http://127.0.0.1:8000/chat", "READY", -1, -1]],
+                "b": [["http://127.0.0.1:8001/chat", "READY", -1, -1]],
+            },
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
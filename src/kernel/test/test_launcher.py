@@ -0,0 +1,93 @@
+import sys
+import time
+import threading
+import unittest
+import logging
+from kuwa.kernel.scheduler import ExecutorScheduler
+from kuwa.kernel.launcher import ExecutorLauncher
+from kuwa.kernel.state import SUSPEND_HEALTH
+
+COMMAND = [sys.executable, "-c", "import time; print('Loading', flush=True); time.sleep(10)"]
+
+
+class TestExecutorLauncher(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = ExecutorScheduler({})
+        self.launcher = ExecutorLauncher(self.scheduler)
+
+    def tearDown(self):
+        for job in self.launcher.jobs.values():
+            job.process.kill()
+            job.process.wait()
+
+    def register(self, endpoint, job):
+        return self.launcher.register("model", endpoint, job.process.pid)
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertTrue(condition())
+
+    def test_start(self):
+        job = self.launcher.start("model", COMMAND)
+        self.assertEqual(job.state, "starting")
+        self.assertIsNotNone(job.to_dict()["pid"])
+        # Not started by the job
+        self.assertTrue(self.launcher.register("model", "http://127.0.0.1:8001/chat", 1))
+        self.assertEqual(job.state, "starting")
+        self.assertTrue(self.register("http://127.0.0.1:8000/chat", job))
+        self.assertEqual(job.state, "ready")
+        self.assertEqual(job.endpoint, "http://127.0.0.1:8000/chat")
+        self.assertIsNotNone(job.startup_time_sec)
+        self.wait_for(lambda: job.output)
+        self.assertEqual(list(job.output), ["Loading"])
+
+        self.launcher.stop(job.job_id)
+        self.wait_for(lambda: job.state == "exited")
+        self.assertIsNotNone(job.returncode)
+
+    def test_warm_pool(self):
+        self.scheduler.max_queue_size = 8
+        self.launcher.set_warm_pool("model", COMMAND, 1)
+        self.assertEqual(len(self.launcher.jobs), 1)
+        warm_job = next(iter(self.launcher.jobs.values()))
+        # A waiting job isn't handed the warm executor
+        self.launcher.register("model", "http://127.0.0.1:9000/chat")
+        self.assertEqual(self.scheduler.reserve("model", "0", "1"), "READY")
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(self.scheduler.reserve("model", "0", "2", timeout=0.5)))
+        waiter.start()
+        time.sleep(0.1)
+        self.assertTrue(self.register("http://127.0.0.1:8000/chat", warm_job))
+        waiter.join()
+        self.assertEqual(results, ["BUSY"])
+        self.assertEqual(warm_job.state, "warm")
+        self.assertEqual(self.scheduler.reserve("model", "1", "1"), "BUSY")
+
+        job = self.launcher.start("model", COMMAND)
+        self.assertIs(job, warm_job)
+        self.assertEqual(job.state, "ready")
+        self.assertEqual(self.scheduler.reserve("model", "1", "1"), "READY")
+        # The pool is refilled
+        self.assertEqual(len(self.launcher.jobs), 2)
+
+        self.launcher.set_warm_pool("model", COMMAND, 0)
+        self.wait_for(lambda: len([j for j in self.launcher.jobs.values() if j.state == "exited"]) == 1)
+        self.assertEqual(job.state, "ready")
+
+    def test_warm_and_unhealthy(self):
+        self.launcher.set_warm_pool("model", COMMAND, 1)
+        warm_job = next(iter(self.launcher.jobs.values()))
+        self.register("http://127.0.0.1:8000/chat", warm_job)
+        self.scheduler.suspend("http://127.0.0.1:8000/chat", SUSPEND_HEALTH)
+        # Taking the warm executor doesn't lift the suspension of the circuit breaker
+        self.assertIs(self.launcher.start("model", COMMAND), warm_job)
+        self.assertEqual(self.scheduler.reserve("model", "1", "1"), "BUSY")
+        self.scheduler.resume("http://127.0.0.1:8000/chat", SUSPEND_HEALTH)
+        self.assertEqual(self.scheduler.reserve("model", "1", "1"), "READY")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
@@ -0,0 +1,47 @@
+import time
+import unittest
+import logging
+from kuwa.kernel.scheduler import ExecutorScheduler
+from kuwa.kernel.lease import LeaseTable
+
+
+class TestLeaseTable(unittest.TestCase):
+    def setUp(self):
+        self.data = {}
+        self.scheduler = ExecutorScheduler(self.data)
+        self.leases = LeaseTable(self.scheduler)
+        self.scheduler.register("model", "http://a/chat")
+        self.scheduler.register("model", "http://b/chat")
+
+    def test_expire(self):
+        self.assertTrue(self.leases.renew("model", "http://a/chat", 10, {"concurrent_requests": 1}))
+        self.assertEqual(self.leases.expire(), [])
+        expired = self.leases.expire(now=time.time() + 11)
+        self.assertEqual([l.endpoint for l in expired], ["http://a/chat"])
+        # The registration without a lease is kept
+        self.assertEqual([r[0] for r in self.data["model"]], ["http://b/chat"])
+        self.assertEqual(self.leases.list(), [])
+
+    def test_renew(self):
+        self.leases.renew("model", "http://a/chat", 10)
+        self.leases.renew("model", "http://a/chat", 20, {"concurrent_requests": 2})
+        self.assertEqual(self.leases.expire(now=time.time() + 15), [])
+        self.assertEqual(self.leases.list()[0]["load"], {"concurrent_requests": 2})
+
+    def test_renew_unregistered(self):
+        self.leases.renew("model", "http://a/chat", 10)
+        self.scheduler.unregister("model", endpoint="http://a/chat")
+        self.assertFalse(self.leases.renew("model", "http://a/chat", 10))
+        self.assertFalse(self.leases.renew("model", "http://c/chat", 10))
+        self.assertEqual(self.leases.list(), [])
+
+    def test_revoke(self):
+        self.leases.renew("model", "http://a/chat", 10)
+        self.leases.revoke("model", "http://a/chat")
+        self.assertEqual(self.leases.expire(now=time.time() + 11), [])
+        self.assertEqual(len(self.data["model"]), 2)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+import logging
+import prometheus_client
+from kuwa.kernel.scheduler import ExecutorScheduler
+from kuwa.kernel.metrics import KernelMetrics, SchedulerCollector
+
+
+class TestKernelMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = prometheus_client.CollectorRegistry()
+        self.scheduler = ExecutorScheduler({})
+        self.metrics = KernelMetrics(registry=self.registry, is_registered=self.scheduler.has_executors)
+        self.registry.register(SchedulerCollector(self.scheduler))
+
+    def sample(self, name, **labels):
+        return self.registry.get_sample_value(name, labels)
+
+    def test_schedule(self):
+        self.scheduler.register("model", "http://127.0.0.1:8000/chat")
+        self.metrics.observe_schedule("model", "READY", 0.1)
+        self.metrics.observe_schedule("model", "READY", 0.2)
+        self.metrics.observe_schedule("model", "BUSY", 10)
+        self.assertEqual(self.sample("kuwa_kernel_schedule_total", access_code="model", result="READY"), 2)
+        self.assertEqual(self.sample("kuwa_kernel_schedule_total", access_code="model", result="BUSY"), 1)
+        self.assertEqual(self.sample("kuwa_kernel_schedule_wait_seconds_count", access_code="model"), 3)
+
+    def test_unknown_access_code(self):
+        self.metrics.observe_schedule("random-1", "NOMACHINE", 0)
+        self.metrics.observe_schedule("random-2", "NOMACHINE", 0)
+        self.metrics.lease_expired.labels("expired").inc()
+        self.assertEqual(self.sample("kuwa_kernel_schedule_total", access_code="unknown", result="NOMACHINE"), 2)
+        self.assertIsNone(self.sample("kuwa_kernel_schedule_total", access_code="random-1", result="NOMACHINE"))
+        self.assertEqual(self.sample("kuwa_kernel_lease_expired_total", access_code="expired"), 1)
+
+    def test_slots(self):
+        self.scheduler.register("model", "http://127.0.0.1:8000/chat")
+        self.scheduler.register("model", "http://127.0.0.1:8001/chat")
+        self.scheduler.register("model", "http://127.0.0.1:8002/chat")
+        self.scheduler.register("model", "http://127.0.0.1:8003/chat")
+        self.scheduler.reserve("model", "1", "1")
+        self.scheduler.reserve("model", "2", "1")
+        self.scheduler.occupy(self.scheduler.lookup("model", "2", "1"))
+        self.scheduler.suspend("http://127.0.0.1:8003/chat")
+        for state, count in [("idle", 1), ("reserved", 1), ("busy", 1), ("suspended", 1)]:
+            self.assertEqual(self.sample("kuwa_kernel_executors", access_code="model", state=state), count)
+        self.assertEqual(self.sample("kuwa_kernel_queue_length", access_code="model"), 0)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
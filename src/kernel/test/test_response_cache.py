@@ -0,0 +1,108 @@
+import json
+import time
+import unittest
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from kuwa.kernel.response_cache import ResponseCache, HttpEmbedder, completed
+
+def sse(data):
+    return f"data: {json.dumps(data)}\n"
+
+def history(*msgs):
+    return json.dumps([{"msg": m, "isbot": i % 2 == 1} for i, m in enumerate(msgs)])
+
+class EmbeddingHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        body = json.dumps({"data": [{"embedding": [len(request["input"]), len(request.get("model", ""))]}]}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+STREAM = [
+    sse({"finish_reason": None, "delta": [{"type": "text", "text": "Hello"}]}),
+    sse({"finish_reason": "stop", "delta": [{"type": "exit_code", "exit_code": 0}]}),
+]
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = ResponseCache(ttl_sec={"faq": 60}, max_bytes=1024)
+
+    def form(self, *msgs, name="faq", modelfile="[]"):
+        return {"name": name, "input": history(*msgs), "modelfile": modelfile}
+
+    def fill(self, form, chunks=STREAM):
+        request = self.cache.prepare(form)
+        self.assertIsNone(self.cache.get(request))
+        self.assertEqual(list(self.cache.record(request, iter(chunks))), chunks)
+
+    def test_hit(self):
+        self.fill(self.form("What is Kuwa?"))
+        self.assertEqual(self.cache.get(self.cache.prepare(self.form("  What is   Kuwa? "))), STREAM)
+        self.assertIsNone(self.cache.get(self.cache.prepare(self.form("What is Kuwa?", modelfile='[{"name": "system"}]'))))
+
+    def test_not_cached(self):
+        self.assertIsNone(self.cache.prepare(self.form("Hi", name="chat")))
+        self.assertIsNone(self.cache.prepare(self.form("Hi"), headers={"Cache-Control": "no-cache"}))
+        failed = STREAM[:1] + [sse({"finish_reason": "exception", "delta": [{"type": "exit_code", "exit_code": 1024}]})]
+        self.assertFalse(completed(failed))
+        self.assertFalse(completed(STREAM[:1]))
+        self.fill(self.form("Hi"), failed)
+        self.assertEqual(self.cache.size(), 0)
+
+    def test_ttl(self):
+        self.cache.ttl_sec = {"*": 0.1}
+        self.fill(self.form("Hi", name="other"))
+        time.sleep(0.15)
+        self.assertIsNone(self.cache.get(self.cache.prepare(self.form("Hi", name="other"))))
+        self.assertEqual(self.cache.size(), 0)
+
+    def test_lru_by_size(self):
+        size = sum(len(c) for c in STREAM)
+        self.cache.max_bytes = size * 2
+        self.fill(self.form("A"))
+        self.fill(self.form("B"))
+        self.cache.get(self.cache.prepare(self.form("A")))
+        self.fill(self.form("C"))
+        self.assertEqual(self.cache.size(), size * 2)
+        self.assertIsNone(self.cache.get(self.cache.prepare(self.form("B"))))
+        self.assertIsNotNone(self.cache.get(self.cache.prepare(self.form("A"))))
+
+    def test_similarity(self):
+        self.cache.embedder = lambda text: [text.count("Kuwa"), text.count("weather"), 1]
+        self.fill(self.form("What is Kuwa?"))
+        self.assertEqual(self.cache.get(self.cache.prepare(self.form("Tell me about Kuwa"))), STREAM)
+        self.assertIsNone(self.cache.get(self.cache.prepare(self.form("How is the weather?"))))
+
+    def test_similarity_candidates(self):
+        self.cache.embedder = lambda text: [text.count("Kuwa"), text.count("weather"), 1]
+        self.cache.max_similarity_candidates = 1
+        self.fill(self.form("What is Kuwa?"))
+        self.fill(self.form("What is Kuwa?", modelfile='[{"name": "system"}]'))
+        self.assertEqual(self.cache.get(self.cache.prepare(self.form("Tell me about Kuwa"))), STREAM)
+        # Only the latest entry of the group is compared
+        self.fill(self.form("How is the weather?"))
+        self.assertIsNone(self.cache.get(self.cache.prepare(self.form("Tell me about Kuwa"))))
+
+    def test_http_embedder(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), EmbeddingHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}/v1/embeddings"
+            self.assertEqual(HttpEmbedder(url)("Hello"), [5, 0])
+            self.assertEqual(HttpEmbedder(url, model="bge")("Hi"), [2, 3])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
@@ -0,0 +1,137 @@
+import unittest
+import logging
+from collections import OrderedDict
+from kuwa.kernel.scheduler import ExecutorScheduler
+from kuwa.kernel.routing import (
+    EndpointStats,
+    FifoPolicy,
+    LeastOutstandingPolicy,
+    PowerOfTwoChoicesPolicy,
+    LatencyPolicy,
+    parse_histogram,
+)
+
+METRICS = """# HELP executor_framework_time_to_first_chunk_seconds Time from starting to process a request to the first output text
+# TYPE executor_framework_time_to_first_chunk_seconds histogram
+executor_framework_time_to_first_chunk_seconds_bucket{executor_name="a",le="1.0"} 2.0
+executor_framework_time_to_first_chunk_seconds_count{executor_name="a"} 3.0
+executor_framework_time_to_first_chunk_seconds_sum{executor_name="a"} 4.5
+executor_framework_time_to_first_chunk_seconds_count{executor_name="b"} 1.0
+executor_framework_time_to_first_chunk_seconds_sum{executor_name="b"} 0.5
+executor_framework_time_to_first_chunk_seconds_created{executor_name="a"} 1.7e+09
+"""
+
+
+class TestRoutingPolicy(unittest.TestCase):
+    def setUp(self):
+        self.stats = EndpointStats(smoothing=0.5)
+        self.idle = OrderedDict((e, None) for e in ["a", "b", "c"])
+
+    def test_fifo(self):
+        self.assertEqual(FifoPolicy().choose(self.idle, self.stats), "a")
+
+    def test_least_outstanding(self):
+        self.stats.add_outstanding("a", 2)
+        self.stats.add_outstanding("b", 1)
+        self.stats.add_outstanding("c", 1)
+        self.stats.add_outstanding("c", -1)
+        self.assertEqual(LeastOutstandingPolicy().choose(self.idle, self.stats), "c")
+
+    def test_p2c(self):
+        self.stats.add_outstanding("a", 1)
+        self.stats.add_outstanding("b", 1)
+        policy = PowerOfTwoChoicesPolicy()
+        for _ in range(20):
+            self.assertIn(policy.choose(self.idle, self.stats), self.idle)
+        self.assertEqual(policy.choose(OrderedDict(b=None), self.stats), "b")
+        self.assertEqual(policy.choose(OrderedDict(a=None, c=None), self.stats), "c")
+
+    def test_latency(self):
+        self.stats.observe_latency("a", 2.0)
+        self.stats.observe_latency("b", 1.0)
+        self.stats.observe_latency("c", 1.0)
+        self.stats.observe_latency("c", 3.0)
+        self.assertEqual(self.stats.latency("c"), 2.0)
+        self.assertEqual(LatencyPolicy().choose(self.idle, self.stats), "b")
+        self.stats.forget("a")
+        self.assertEqual(LatencyPolicy().choose(self.idle, self.stats), "a")
+
+    def test_probe_latency(self):
+        self.stats.observe_probe_latency("a", 0.5)
+        self.stats.observe_probe_latency("b", 0.1)
+        self.stats.observe_probe_latency("c", 0.2)
+        self.assertEqual(LatencyPolicy().choose(self.idle, self.stats), "b")
+        # The time to the first chunk takes the place of the probe latency
+        self.stats.observe_latency("b", 1.0)
+        self.assertEqual(self.stats.latency("b"), 1.0)
+        self.assertEqual(LatencyPolicy().choose(self.idle, self.stats), "c")
+
+    def test_parse_histogram(self):
+        self.assertEqual(parse_histogram(METRICS, "executor_framework_time_to_first_chunk_seconds"), (5.0, 4.0))
+        self.assertIsNone(parse_histogram(METRICS, "executor_framework_process_time_seconds"))
+
+
+class TestSchedulerRouting(unittest.TestCase):
+    def setUp(self):
+        self.data = {}
+        self.scheduler = ExecutorScheduler(self.data, routing_policy=LeastOutstandingPolicy())
+        self.scheduler.register("model", "http://127.0.0.1:8000/chat")
+        self.scheduler.register("model", "http://127.0.0.1:8001/chat")
+        self.scheduler.register("other", "http://127.0.0.1:8000/chat")
+
+    def test_outstanding_across_access_codes(self):
+        self.assertEqual(self.scheduler.reserve("other", "1", "1"), "READY")
+        self.assertEqual(self.scheduler.stats.outstanding("http://127.0.0.1:8000/chat"), 1)
+        # The executor at 8000 is busy serving the other access code.
+        self.assertEqual(self.scheduler.reserve("model", "2", "1"), "READY")
+        self.assertEqual(self.data["model"][1][2:], ["2", "1"])
+
+        self.scheduler.release("other", self.scheduler.lookup("other", "1", "1"))
+        self.assertEqual(self.scheduler.stats.outstanding("http://127.0.0.1:8000/chat"), 0)
+        self.scheduler.rebuild()
+        self.assertEqual(self.scheduler.stats.outstanding("http://127.0.0.1:8001/chat"), 1)
+
+
+class TestSessionAffinity(unittest.TestCase):
+    def setUp(self):
+        self.data = {}
+        self.scheduler = ExecutorScheduler(self.data, affinity_table_size=2)
+        self.scheduler.register("model", "http://127.0.0.1:8000/chat")
+        self.scheduler.register("model", "http://127.0.0.1:8001/chat")
+
+    def serve(self, history_id, session_id=None):
+        self.assertEqual(self.scheduler.reserve("model", history_id, "1", session_id=session_id), "READY")
+        record = self.scheduler.lookup("model", history_id, "1")
+        endpoint = record[0]
+        self.scheduler.release("model", record)
+        return endpoint
+
+    def test_same_session(self):
+        first = self.serve("1", session_id="chat")
+        # The FIFO policy would rotate to the other executor.
+        self.assertEqual(self.serve("2", session_id="chat"), first)
+        self.assertEqual(self.serve("3", session_id="chat"), first)
+        self.assertEqual(self.scheduler.affinity_hits, 2)
+
+    def test_default_to_history_id(self):
+        first = self.serve("1")
+        self.assertEqual(self.serve("1"), first)
+
+    def test_fallback_when_busy(self):
+        first = self.serve("1", session_id="chat")
+        self.assertEqual(self.scheduler.reserve("model", "2", "2", session_id="chat"), "READY")
+        self.assertEqual(self.scheduler.lookup("model", "2", "2")[0], first)
+        self.assertNotEqual(self.serve("3", session_id="chat"), first)
+        self.assertEqual(self.scheduler.affinity_misses, 1)
+
+    def test_bounded(self):
+        self.serve("1", session_id="a")
+        self.serve("2", session_id="b")
+        self.serve("3", session_id="c")
+        self.assertEqual(len(self.scheduler._affinity), 2)
+        self.assertNotIn(("model", "a"), self.scheduler._affinity)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
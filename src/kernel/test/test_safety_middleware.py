@@ -0,0 +1,115 @@
+import time
+import unittest
+import logging
+import threading
+from kuwa.kernel.safety_middleware import SafetyGuardPool, PooledGuard, GuardedStream, PrefetchedStream
+
+
+class TestSafetyGuardPool(unittest.TestCase):
+    def setUp(self):
+        self.created = 0
+        self.pool = SafetyGuardPool(self.create_guard, size=2)
+
+    def create_guard(self):
+        self.created += 1
+        return PooledGuard(object())
+
+    def test_reuse(self):
+        self.pool.prewarm()
+        self.assertEqual(self.created, 2)
+        first = self.pool.acquire()
+        self.pool.release(first)
+        self.assertIs(self.pool.acquire(), first)
+        self.assertEqual(self.created, 2)
+
+    def test_overflow(self):
+        guards = [self.pool.acquire() for _ in range(3)]
+        self.assertEqual(self.created, 3)
+        for guard in guards:
+            self.pool.release(guard)
+        # Only the size of the pool is kept
+        self.assertEqual(len(self.pool.idle), 2)
+
+    def test_release_after_stream(self):
+        guard = self.pool.acquire()
+        stream = GuardedStream(iter(["a", "b"]), guard, self.pool, "model")
+        self.assertEqual(next(stream), "a")
+        self.assertEqual(self.pool.idle, [])
+        self.assertEqual(list(stream), ["b"])
+        self.assertEqual(self.pool.idle, [guard])
+        self.assertIsNotNone(guard.first_chunk_at)
+
+    def test_release_on_close(self):
+        guard = self.pool.acquire()
+        stream = GuardedStream(iter(["a", "b"]), guard, self.pool, "model")
+        stream.close()
+        stream.close()
+        self.assertEqual(self.pool.idle, [guard])
+
+
+class TestPrefetchedStream(unittest.TestCase):
+    def test_windows(self):
+        released = threading.Event()
+        def chunks():
+            yield "a"
+            released.wait(timeout=5)
+            yield "b"
+            yield "c"
+        windows = PrefetchedStream(chunks(), max_chunks=10).windows()
+        self.assertEqual(next(windows), "a")
+        released.set()
+        # The chunks arrived while the consumer was busy are checked together
+        time.sleep(0.1)
+        self.assertEqual(list(windows), ["bc"])
+
+    def test_hold_back(self):
+        read = []
+        def chunks():
+            for i in range(10):
+                read.append(i)
+                yield b"x"
+        windows = PrefetchedStream(chunks(), max_chunks=2).windows()
+        time.sleep(0.1)
+        self.assertLessEqual(len(read), 4)
+        self.assertEqual(b"".join(windows), b"x" * 10)
+
+    def test_close(self):
+        closed = threading.Event()
+        def chunks():
+            try:
+                while True:
+                    yield "x"
+            finally:
+                closed.set()
+        windows = PrefetchedStream(chunks(), max_chunks=2).windows()
+        next(windows)
+        windows.close()
+        self.assertTrue(closed.wait(timeout=5))
+
+    def test_abandoned(self):
+        closed = threading.Event()
+        def chunks():
+            try:
+                while True:
+                    yield "x"
+            finally:
+                closed.set()
+        stream = PrefetchedStream(chunks(), max_chunks=2)
+        thread = stream.thread
+        # Dropped before the first window is read
+        del stream
+        self.assertTrue(closed.wait(timeout=5))
+        thread.join(timeout=5)
+        self.assertFalse(thread.is_alive())
+
+    def test_error(self):
+        def chunks():
+            yield "a"
+            raise ValueError("broken")
+        with self.assertRaises(ValueError):
+            list(PrefetchedStream(chunks()).windows())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
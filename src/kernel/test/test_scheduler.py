@@ -0,0 +1,303 @@
+import sys
+import time
+import unittest
+import logging
+import itertools
+import threading
+from kuwa.kernel.scheduler import ExecutorScheduler, WaitQueue, Waiter
+from kuwa.kernel.state import SUSPEND_HEALTH, SUSPEND_WARM
+
+
+class TestExecutorScheduler(unittest.TestCase):
+    def setUp(self):
+        self.data = {}
+        self.scheduler = ExecutorScheduler(self.data)
+
+    def test_register(self):
+        self.assertTrue(self.scheduler.register("model", "http://127.0.0.1:8000/chat"))
+        self.assertFalse(self.scheduler.register("model", "http://127.0.0.1:8000/chat"))
+        self.assertEqual(self.data, {"model": [["http://127.0.0.1:8000/chat", "READY", -1, -1]]})
+
+    def test_no_machine(self):
+        self.assertEqual(self.scheduler.reserve("model", "1", "1"), "NOMACHINE")
+
+    def test_reserve_and_release(self):
+        self.scheduler.register("model", "http://127.0.0.1:8000/chat")
+        self.scheduler.register("model", "http://127.0.0.1:8001/chat")
+        self.assertEqual(self.scheduler.reserve("model", "1", "1"), "READY")
+        self.assertEqual(self.scheduler.reserve("model", "2", "1"), "READY")
+        self.assertEqual(self.scheduler.reserve("model", "3", "1"), "BUSY")
+        self.assertEqual(self.data["model"][0][2:], ["1", "1"])
+        self.assertEqual(self.data["model"][1][2:], ["2", "1"])
+
+        record = self.scheduler.lookup("model", 1, 1)
+        self.assertIs(record, self.data["model"][0])
+        self.assertIsNone(self.scheduler.lookup("other", "1", "1"))
+
+        self.scheduler.occupy(record)
+        self.assertEqual(self.data["model"][0][1], "BUSY")
+        self.assertIsNone(self.scheduler.lookup("model", "1", "1"))
+        self.scheduler.release("model", record)
+        self.assertEqual(self.data["model"][0], ["http://127.0.0.1:8000/chat", "READY", -1, -1])
+        self.assertEqual(self.scheduler.reserve("model", "3", "1"), "READY")
+        self.assertEqual(self.scheduler.lookup("model", "3", "1")[0], record[0])
+
+    def test_copy_on_write(self):
+        self.scheduler.register("model", "http://127.0.0.1:8000/chat")
+        snapshot = self.scheduler.records
+        self.scheduler.reserve("model", "1", "1")
+        record = self.scheduler.lookup("model", "1", "1")
+        self.assertEqual(snapshot, {"model": [["http://127.0.0.1:8000/chat", "READY", -1, -1]]})
+        self.assertEqual(record, ["http://127.0.0.1:8000/chat", "READY", "1", "1"])
+
+    def test_release_twice(self):
+        self.scheduler.register("model", "http://127.0.0.1:8000/chat")
+        self.scheduler.reserve("model", "1", "1")
+        record = self.scheduler.lookup("model", "1", "1")
+        self.scheduler.release("model", record)
+        self.assertEqual(self.scheduler.reserve("model", "2", "1"), "READY")
+        # The outdated record doesn't release the next job
+        self.scheduler.release("model", record)
+        self.assertEqual(self.scheduler.find_job("2", "1")[1][0], "http://127.0.0.1:8000/chat")
+        self.assertEqual(self.scheduler.reserve("model", "3", "1"), "BUSY")
+
+    def test_reschedule_is_idempotent(self):
+        self.scheduler.register("model", "http://127.0.0.1:8000/chat")
+        self.scheduler.register("model", "http://127.0.0.1:8001/chat")
+        self.assertEqual(self.scheduler.reserve("model", "1", "1"), "READY")
+        self.assertEqual(self.scheduler.reserve("model", "1", "1"), "READY")
+        self.assertEqual(self.scheduler.reserve("model", "2", "1"), "READY")
+
+    def test_unregister(self):
+        self.scheduler.register("model", "http://127.0.0.1:8000/chat")
+        self.scheduler.register("model", "http://127.0.0.1:8000/v2/chat")
+        self.scheduler.register("model", "http://127.0.0.1:8001/chat")
+        self.scheduler.reserve("model", "1", "1")
+        removed = self.scheduler.unregister("model", base_url="http://127.0.0.1:8000")
+        self.assertEqual(len(removed), 2)
+        self.assertIsNone(self.scheduler.find_job("1", "1"))
+        self.assertEqual(self.scheduler.reserve("model", "2", "1"), "READY")
+        self.assertEqual(self.scheduler.reserve("model", "3", "1"), "BUSY")
+        self.scheduler.unregister("model", endpoint="http://127.0.0.1:8001/chat")
+        self.assertEqual(self.data, {})
+        self.assertEqual(self.scheduler.reserve("model", "3", "1"), "NOMACHINE")
+
+    def test_release_after_unregister(self):
+        self.scheduler.register("model", "http://127.0.0.1:8000/chat")
+        self.scheduler.reserve("model", "1", "1")
+        record = self.scheduler.lookup("model", "1", "1")
+        self.scheduler.unregister("model", endpoint="http://127.0.0.1:8000/chat")
+        self.scheduler.release("model", record)
+        self.assertEqual(self.scheduler.reserve("model", "2", "1"), "NOMACHINE")
+
+    def test_rebuild(self):
+        self.data["model"] = [
+            ["http://127.0.0.1:8000/chat", "READY", "1", "1"],
+            ["http://127.0.0.1:8001/chat", "BUSY", -1, -1],
+            ["http://127.0.0.1:8002/chat", "READY", -1, -1],
+        ]
+        self.scheduler.rebuild()
+        self.assertIs(self.scheduler.lookup("model", "1", "1"), self.data["model"][0])
+        self.assertEqual(self.scheduler.reserve("model", "2", "1"), "READY")
+        self.assertIs(self.scheduler.lookup("model", "2", "1"), self.data["model"][2])
+        self.assertEqual(self.scheduler.reserve("model", "3", "1"), "BUSY")
+
+    def test_suspend(self):
+        self.scheduler.register("a", "http://127.0.0.1:8000/chat")
+        self.scheduler.register("b", "http://127.0.0.1:8000/chat")
+        self.scheduler.register("a", "http://127.0.0.1:8001/chat")
+        self.scheduler.suspend("http://127.0.0.1:8000/chat")
+        self.assertEqual(self.scheduler.reserve("b", "1", "1"), "BUSY")
+        self.assertEqual(self.scheduler.reserve("a", "1", "1"), "READY")
+        self.assertEqual(self.scheduler.lookup("a", "1", "1")[0], "http://127.0.0.1:8001/chat")
+        self.scheduler.resume("http://127.0.0.1:8000/chat")
+        self.assertEqual(self.scheduler.reserve("b", "2", "1"), "READY")
+        self.assertEqual(self.scheduler.reserve("a", "3", "1"), "READY")
+        self.assertEqual(
+            self.scheduler.endpoints(),
+            {"http://127.0.0.1:8000/chat": ["a", "b"], "http://127.0.0.1:8001/chat": ["a"]},
+        )
+
+    def test_suspend_reasons(self):
+        self.scheduler.register("a", "http://127.0.0.1:8000/chat", suspend_reason=SUSPEND_WARM)
+        self.assertEqual(self.scheduler.reserve("a", "1", "1"), "BUSY")
+        self.scheduler.suspend("http://127.0.0.1:8000/chat", SUSPEND_HEALTH)
+        self.scheduler.resume("http://127.0.0.1:8000/chat", SUSPEND_WARM)
+        self.assertEqual(self.scheduler.reserve("a", "1", "1"), "BUSY")
+        # Resuming for a reason not suspended changes nothing
+        self.scheduler.resume("http://127.0.0.1:8000/chat", SUSPEND_WARM)
+        self.assertEqual(self.scheduler.reserve("a", "1", "1"), "BUSY")
+        self.scheduler.resume("http://127.0.0.1:8000/chat", SUSPEND_HEALTH)
+        self.assertEqual(self.scheduler.reserve("a", "1", "1"), "READY")
+
+
+class TestWaitQueue(unittest.TestCase):
+    def test_fifo(self):
+        queue = WaitQueue()
+        waiters = [Waiter((str(i), "1")) for i in range(3)]
+        for w in waiters:
+            queue.push(w)
+        self.assertEqual([queue.position(w) for w in waiters], [0, 1, 2])
+        self.assertTrue(queue.remove(waiters[1]))
+        self.assertFalse(queue.remove(waiters[1]))
+        self.assertEqual([queue.pop(), queue.pop()], [waiters[0], waiters[2]])
+        self.assertEqual(len(queue), 0)
+
+    def test_fair(self):
+        queue = WaitQueue(fair=True)
+        a = [Waiter((str(i), "a")) for i in range(3)]
+        b = [Waiter((str(i + 10), "b")) for i in range(2)]
+        c = [Waiter(("20", "c"))]
+        for w in a + b + c:
+            queue.push(w)
+        expected_order = [a[0], b[0], c[0], a[1], b[1], a[2]]
+        self.assertEqual(
+            [queue.position(w) for w in expected_order], list(range(len(expected_order)))
+        )
+        self.assertEqual([queue.pop() for _ in range(len(queue))], expected_order)
+
+
+class TestSchedulerQueue(unittest.TestCase):
+    def setUp(self):
+        self.data = {}
+        self.scheduler = ExecutorScheduler(self.data, max_wait_sec=5, max_queue_size=2)
+        self.scheduler.register("model", "http://127.0.0.1:8000/chat")
+        self.assertEqual(self.scheduler.reserve("model", "1", "1"), "READY")
+        self.record = self.scheduler.lookup("model", "1", "1")
+
+    def wait_in_queue(self, history_id, results):
+        thread = threading.Thread(
+            target=lambda: results.append(self.scheduler.reserve("model", history_id, "1"))
+        )
+        thread.start()
+        while self.scheduler.queue_status("model")["queue_length"] == 0:
+            pass
+        return thread
+
+    def test_timeout(self):
+        self.assertEqual(self.scheduler.reserve("model", "2", "1", timeout=0.01), "BUSY")
+        self.assertEqual(self.scheduler.queue_status("model")["queue_length"], 0)
+
+    def test_handover(self):
+        results = []
+        thread = self.wait_in_queue("2", results)
+        status = self.scheduler.queue_status("model", "2", "1")
+        self.assertEqual(status["status"], "WAITING")
+        self.assertEqual(status["position"], 0)
+        self.scheduler.release("model", self.record)
+        thread.join()
+        self.assertEqual(results, ["READY"])
+        self.assertEqual(self.scheduler.lookup("model", "2", "1")[0], self.record[0])
+        self.assertEqual(self.scheduler.queue_status("model", "2", "1")["status"], "READY")
+        self.assertIsNotNone(self.scheduler.queue_status("model")["average_service_time_sec"])
+
+    def test_queue_full(self):
+        results = []
+        threads = [self.wait_in_queue("2", results)]
+        threads.append(threading.Thread(
+            target=lambda: results.append(self.scheduler.reserve("model", "3", "1"))
+        ))
+        threads[-1].start()
+        while self.scheduler.queue_status("model")["queue_length"] < 2:
+            pass
+        self.assertEqual(self.scheduler.reserve("model", "4", "1"), "BUSY")
+        self.scheduler.unregister("model", endpoint="http://127.0.0.1:8000/chat")
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ["NOMACHINE", "NOMACHINE"])
+
+
+class TestSchedulerStress(unittest.TestCase):
+    """
+    Schedule, complete and unregister from many threads while reading the
+    records, and check that an executor never serves two jobs at once.
+    """
+
+    workers = 16
+    jobs_per_worker = 200
+
+    def setUp(self):
+        self.switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        self.data = {}
+        self.scheduler = ExecutorScheduler(self.data, max_wait_sec=1, max_queue_size=self.workers)
+        self.endpoint_ids = itertools.count()
+        for _ in range(4):
+            self.scheduler.register("model", self.new_endpoint())
+        self.lock = threading.Lock()
+        self.serving = {}
+        self.errors = []
+        self.done = threading.Event()
+
+    def tearDown(self):
+        sys.setswitchinterval(self.switch_interval)
+
+    def new_endpoint(self):
+        # Never reuse an unregistered endpoint, so its outdated jobs are distinguishable
+        return f"http://127.0.0.1:{next(self.endpoint_ids)}/chat"
+
+    def run_jobs(self, worker):
+        for i in range(self.jobs_per_worker):
+            history_id = str(worker * self.jobs_per_worker + i)
+            if self.scheduler.reserve("model", history_id, "1") != "READY":
+                continue
+            record = self.scheduler.lookup("model", history_id, "1")
+            if record is None:
+                # The executor was unregistered right after the reservation
+                continue
+            endpoint = record[0]
+            with self.lock:
+                if endpoint in self.serving:
+                    self.errors.append(f"{endpoint} serves {self.serving[endpoint]} and {history_id}")
+                self.serving[endpoint] = history_id
+            self.scheduler.occupy(record)
+            reserved = self.scheduler.find_job(history_id, "1")
+            if reserved is None and self.scheduler.is_registered("model", endpoint):
+                self.errors.append(f"The reservation of {history_id} at {endpoint} is lost")
+            with self.lock:
+                if self.serving.get(endpoint) == history_id:
+                    del self.serving[endpoint]
+            # Released by both the stream and the exit handler
+            self.scheduler.release("model", record)
+            self.scheduler.release("model", record)
+
+    def rotate_executors(self):
+        while not self.done.is_set():
+            endpoints = [r[0] for r in self.scheduler.records.get("model", [])]
+            if endpoints:
+                self.scheduler.unregister("model", endpoint=endpoints[0])
+            self.scheduler.register("model", self.new_endpoint())
+            time.sleep(0.001)
+
+    def read_records(self):
+        while not self.done.is_set():
+            for access_code, records in self.scheduler.records.items():
+                endpoints = [r[0] for r in records]
+                if len(endpoints) != len(set(endpoints)):
+                    self.errors.append(f"Duplicated endpoints in the snapshot: {endpoints}")
+            self.scheduler.slots()
+
+    def test_stress(self):
+        background = [threading.Thread(target=self.rotate_executors), threading.Thread(target=self.read_records)]
+        workers = [threading.Thread(target=self.run_jobs, args=(i,)) for i in range(self.workers)]
+        for thread in background + workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        self.done.set()
+        for thread in background:
+            thread.join()
+
+        self.assertEqual(self.errors, [])
+        slots = self.scheduler.slots()["model"]
+        self.assertEqual((slots["reserved"], slots["busy"], slots["waiting"]), (0, 0, 0))
+        # The indexes agree with the records
+        idle = dict(self.scheduler.state.idle("model"))
+        self.scheduler.rebuild()
+        self.assertEqual(dict(self.scheduler.state.idle("model")), idle)
+        self.assertEqual(len(idle), len(self.data["model"]))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()
@@ -0,0 +1,302 @@
+import time
+import bisect
+import unittest
+import logging
+import threading
+import socketserver
+from collections import defaultdict
+from kuwa.kernel.scheduler import ExecutorScheduler
+from kuwa.kernel.state import RedisStateBackend, SUSPEND_HEALTH, SUSPEND_WARM
+
+
+class StandInRedisServer(socketserver.ThreadingTCPServer):
+    """
+    A Redis-protocol server with the commands used by RedisStateBackend,
+    including WATCH/MULTI/EXEC, so the backend can be tested without Redis.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StandInRedisHandler)
+        self.lock = threading.Lock()
+        self.data = {}
+        self.versions = defaultdict(int)
+
+    def execute(self, command, args):
+        handler = getattr(self, f"cmd_{command}", None)
+        if handler is None:
+            return Exception(f"ERR unknown command '{command}'")
+        return handler(*args)
+
+    def touch(self, *keys):
+        for key in keys:
+            self.versions[key] += 1
+
+    def _get(self, key, default):
+        return self.data.get(key, default)
+
+    def _store(self, key, value):
+        if value:
+            self.data[key] = value
+        else:
+            self.data.pop(key, None)
+        self.touch(key)
+
+    def cmd_PING(self):
+        return "PONG"
+
+    def cmd_GET(self, key):
+        return self.data.get(key)
+
+    def cmd_SET(self, key, value):
+        self._store(key, value)
+        return "OK"
+
+    def cmd_DEL(self, *keys):
+        removed = sum(1 for k in keys if k in self.data)
+        for k in keys:
+            self._store(k, None)
+        return removed
+
+    def cmd_EXISTS(self, *keys):
+        return sum(1 for k in keys if k in self.data)
+
+    def cmd_HSET(self, key, *pairs):
+        h = dict(self._get(key, {}))
+        added = sum(1 for f in pairs[::2] if f not in h)
+        h.update(zip(pairs[::2], pairs[1::2]))
+        self._store(key, h)
+        return added
+
+    def cmd_HGET(self, key, field):
+        return self._get(key, {}).get(field)
+
+    def cmd_HGETALL(self, key):
+        return [x for item in self._get(key, {}).items() for x in item]
+
+    def cmd_HKEYS(self, key):
+        return list(self._get(key, {}).keys())
+
+    def cmd_HLEN(self, key):
+        return len(self._get(key, {}))
+
+    def cmd_HEXISTS(self, key, field):
+        return int(field in self._get(key, {}))
+
+    def cmd_HDEL(self, key, *fields):
+        h = dict(self._get(key, {}))
+        removed = sum(1 for f in fields if h.pop(f, None) is not None)
+        self._store(key, h)
+        return removed
+
+    def cmd_SADD(self, key, *members):
+        s = set(self._get(key, set()))
+        added = len(set(members) - s)
+        self._store(key, s | set(members))
+        return added
+
+    def cmd_SREM(self, key, *members):
+        s = set(self._get(key, set()))
+        removed = len(s & set(members))
+        self._store(key, s - set(members))
+        return removed
+
+    def cmd_SMEMBERS(self, key):
+        return list(self._get(key, set()))
+
+    def cmd_SISMEMBER(self, key, member):
+        return int(member in self._get(key, set()))
+
+    def cmd_ZADD(self, key, *pairs):
+        z = dict(self._get(key, {}))
+        added = sum(1 for m in pairs[1::2] if m not in z)
+        z.update((m, float(s)) for s, m in zip(pairs[::2], pairs[1::2]))
+        self._store(key, z)
+        return added
+
+    def cmd_ZREM(self, key, *members):
+        z = dict(self._get(key, {}))
+        removed = sum(1 for m in members if z.pop(m, None) is not None)
+        self._store(key, z)
+        return removed
+
+    def cmd_ZSCORE(self, key, member):
+        score = self._get(key, {}).get(member)
+        return None if score is None else repr(score)
+
+    def _sorted(self, key):
+        return sorted(self._get(key, {}).items(), key=lambda i: (i[1], i[0]))
+
+    def cmd_ZRANGE(self, key, start, stop):
+        members = [m for m, _ in self._sorted(key)]
+        stop = int(stop)
+        return members[int(start):None if stop == -1 else stop + 1]
+
+    def cmd_ZRANGEBYSCORE(self, key, low, high):
+        items = self._sorted(key)
+        scores = [s for _, s in items]
+        return [m for m, _ in items[bisect.bisect_left(scores, float(low)):bisect.bisect_right(scores, float(high))]]
+
+class StandInRedisHandler(socketserver.StreamRequestHandler):
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2].decode("utf-8"))
+        return args
+
+    def encode(self, value):
+        if isinstance(value, Exception):
+            return f"-{value}\r\n".encode("utf-8")
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, int):
+            return f":{value}\r\n".encode("utf-8")
+        if isinstance(value, list):
+            return f"*{len(value)}\r\n".encode("utf-8") + b"".join(self.encode(v) for v in value)
+        if value in ("OK", "PONG", "QUEUED"):
+            return f"+{value}\r\n".encode("utf-8")
+        data = value.encode("utf-8")
+        return f"${len(data)}\r\n".encode("utf-8") + data + b"\r\n"
+
+    def handle(self):
+        server = self.server
+        watched = {}
+        queued = None
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            command, args = args[0].upper(), args[1:]
+            with server.lock:
+                if command == "WATCH":
+                    watched.update((k, server.versions[k]) for k in args)
+                    reply = "OK"
+                elif command == "UNWATCH":
+                    watched = {}
+                    reply = "OK"
+                elif command == "MULTI":
+                    queued = []
+                    reply = "OK"
+                elif command == "DISCARD":
+                    queued, watched = None, {}
+                    reply = "OK"
+                elif command == "EXEC":
+                    if any(server.versions[k] != v for k, v in watched.items()):
+                        reply = None
+                    else:
+                        reply = [server.execute(c, a) for c, a in queued]
+                    queued, watched = None, {}
+                elif queued is not None:
+                    queued.append((command, args))
+                    reply = "QUEUED"
+                else:
+                    reply = server.execute(command, args)
+            if command == "EXEC" and reply is None:
+                self.wfile.write(b"*-1\r\n")
+            else:
+                self.wfile.write(self.encode(reply))
+
+
+class TestRedisStateBackend(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInRedisServer()
+        threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+        # The stand-in server speaks RESP2 only
+        self.url = f"redis://127.0.0.1:{self.server.server_address[1]}/0?protocol=2"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def create_kernel(self, max_wait_sec=0):
+        scheduler = ExecutorScheduler({}, max_wait_sec=max_wait_sec, max_queue_size=64)
+        scheduler.set_state(RedisStateBackend(self.url))
+        return scheduler
+
+    def test_shared_records(self):
+        a, b = self.create_kernel(), self.create_kernel()
+        self.assertTrue(a.register("model", "http://e1/chat"))
+        self.assertFalse(b.register("model", "http://e1/chat"))
+        self.assertEqual(b.records, {"model": [["http://e1/chat", "READY", -1, -1]]})
+
+        # Reserved on one kernel, served and released on the other
+        self.assertEqual(a.reserve("model", 1, 1), "READY")
+        self.assertEqual(b.reserve("model", 2, 1), "BUSY")
+        record = b.lookup("model", 1, 1)
+        self.assertEqual(record[0], "http://e1/chat")
+        b.occupy(record)
+        self.assertEqual(a.slots()["model"]["busy"], 1)
+        b.release("model", record)
+        self.assertEqual(a.reserve("model", 2, 1), "READY")
+
+        self.assertEqual(len(b.unregister("model", endpoint="http://e1/chat")), 1)
+        self.assertIsNone(a.find_job(2, 1))
+        self.assertEqual(a.reserve("model", 3, 1), "NOMACHINE")
+
+    def test_suspend(self):
+        a, b = self.create_kernel(), self.create_kernel()
+        a.register("model", "http://e1/chat")
+        a.suspend("http://e1/chat")
+        self.assertEqual(b.reserve("model", 1, 1), "BUSY")
+        a.resume("http://e1/chat")
+        self.assertEqual(b.reserve("model", 1, 1), "READY")
+
+    def test_suspend_reasons(self):
+        a, b = self.create_kernel(), self.create_kernel()
+        a.register("model", "http://e1/chat", suspend_reason=SUSPEND_WARM)
+        a.suspend("http://e1/chat", SUSPEND_HEALTH)
+        self.assertEqual(b.slots()["model"]["suspended"], 1)
+        b.resume("http://e1/chat", SUSPEND_WARM)
+        self.assertEqual(a.reserve("model", 1, 1), "BUSY")
+        b.resume("http://e1/chat", SUSPEND_HEALTH)
+        self.assertEqual(a.reserve("model", 1, 1), "READY")
+
+    def test_wait_for_other_kernel(self):
+        a, b = self.create_kernel(), self.create_kernel(max_wait_sec=5)
+        a.register("model", "http://e1/chat")
+        self.assertEqual(a.reserve("model", 1, 1), "READY")
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(b.reserve("model", 2, 1)))
+        waiter.start()
+        time.sleep(0.3)
+        a.release("model", a.lookup("model", 1, 1))
+        waiter.join(timeout=5)
+        self.assertEqual(results, ["READY"])
+        self.assertEqual(a.find_job(2, 1)[1][0], "http://e1/chat")
+
+    def test_concurrent_reserve(self):
+        kernels = [self.create_kernel() for _ in range(3)]
+        for i in range(5):
+            kernels[0].register("model", f"http://e{i}/chat")
+        results = []
+        def reserve(kernel, job):
+            results.append((job, kernel.reserve("model", job, 1)))
+        threads = [threading.Thread(target=reserve, args=(kernels[i % 3], i)) for i in range(15)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(timeout=10)
+        reserved = [job for job, result in results if result == "READY"]
+        self.assertEqual(len(reserved), 5)
+        endpoints = [kernels[0].find_job(job, 1)[1][0] for job in reserved]
+        self.assertEqual(len(set(endpoints)), 5)
+
+    def test_leases(self):
+        a, b = self.create_kernel(), self.create_kernel()
+        a.register("model", "http://e1/chat")
+        a.state.renew_lease("model", "http://e1/chat", 100)
+        self.assertEqual(b.state.expire_leases(50), [])
+        self.assertEqual(b.state.expire_leases(150), [("model", "http://e1/chat")])
+        # Expired only once among the kernels
+        self.assertEqual(a.state.expire_leases(150), [])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="DEBUG")
+    unittest.main()